@@ -0,0 +1,255 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import math
+from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
+
+
+# The params of `UpdateProperties` requests are (uuid, updates), see
+# `get_property_updates`. Otherwise, they are the unpacked D-Bus parameters.
+Request = namedtuple("Request", ["method", "sender", "params", "connection",
+                                 "path", "iface", "invocation",
+                                 "arrival_time"])
+
+# The properties of a sound that can be automated by `UpdateProperties`.
+AUTOMATABLE_PROPS = ("volume", "rate")
+
+
+class InvalidArgsException(Exception):
+    INTERFACE = "org.freedesktop.DBus.Error.InvalidArgs"
+
+
+def _check_number(name, value, minimum=0, strict=False):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            math.isnan(value) or math.isinf(value):
+        raise InvalidArgsException("'{}' must be a number".format(name))
+    if value < minimum or (strict and value == minimum):
+        raise InvalidArgsException("'{}' must be {} {}".format(
+            name, "greater than" if strict else "at least", minimum))
+
+
+def _check_positive_number(name, value):
+    _check_number(name, value, strict=True)
+
+
+def _check_gain(name, value):
+    _check_number(name, value)
+    if value > 1:
+        raise InvalidArgsException("'{}' must be at most 1".format(name))
+
+
+def _check_integer(name, value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise InvalidArgsException("'{}' must be an integer".format(name))
+
+
+def _check_string(name, value):
+    if not isinstance(value, str):
+        raise InvalidArgsException("'{}' must be a string".format(name))
+
+
+def _check_curve(name, value):
+    # The points are checked like the single target of the property.
+    check_value = _OPTION_CHECKS[name[:-len("-curve")]]
+    if not isinstance(value, (list, tuple)):
+        raise InvalidArgsException(
+            "'{}' must be an array of (time_ms, value) pairs".format(name))
+    for point in value:
+        if not isinstance(point, (list, tuple)) or len(point) != 2:
+            raise InvalidArgsException(
+                "'{}' must be an array of (time_ms, value) pairs".format(name))
+        _check_number("{} time".format(name), point[0])
+        check_value("{} value".format(name), point[1])
+
+
+# Checks of the options shared by the methods taking an a{sv}. Unknown
+# options are ignored.
+_OPTION_CHECKS = {
+    "volume": _check_number,
+    "pitch": _check_positive_number,
+    "rate": _check_positive_number,
+    "rate-mode": _check_string,
+    "start-at": _check_integer,
+    "max-duration-ms": _check_positive_number,
+    "volume-curve": _check_curve,
+    "rate-curve": _check_curve,
+}
+
+
+def _check_options(options):
+    for name, value in options.items():
+        check = _OPTION_CHECKS.get(name)
+        if check is not None:
+            check(name, value)
+
+
+def get_property_updates(transition_time_ms, options):
+    """
+    Gets the property updates of an `UpdateProperties` call.
+
+    A curve replaces the single target of the same property.
+
+    Returns:
+        dict: (transition_time_ms, value) pairs by property name. The
+        transition time of curves is None, and their value is the list of
+        (time_ms, value) points.
+    """
+    updates = {}
+    for prop_name in AUTOMATABLE_PROPS:
+        curve_name = "{}-curve".format(prop_name)
+        if curve_name in options:
+            updates[prop_name] = (None, options[curve_name])
+        elif prop_name in options:
+            updates[prop_name] = (transition_time_ms, options[prop_name])
+    return updates
+
+
+def parse_params(method, params):
+    """
+    Checks the parameters of a call beyond what their D-Bus types ensure.
+
+    The options are variants, so a well-typed call can still pass values
+    the handlers cannot use.
+
+    Args:
+        method (str): The name of the method.
+        params (tuple): The unpacked parameters of the call.
+
+    Returns:
+        tuple: The params of the `Request`.
+
+    Raises:
+        InvalidArgsException: If a parameter has a wrong type or is out of
+                              range.
+    """
+    if method in ("PlayFull", "PlayGroup"):
+        _check_options(params[1])
+    elif method in ("UpdateProperties", "SetGroupProperties"):
+        _check_number("transition_time_ms", params[1])
+        _check_options(params[2])
+    if method == "SetGroupProperties" and "volume" in params[2]:
+        # The volume of a group is a gain.
+        _check_gain("volume", params[2]["volume"])
+    if method == "UpdateProperties":
+        return (params[0], get_property_updates(params[1], params[2]))
+    return params
+
+
+class RequestQueue:
+    """
+    Queues incoming D-Bus method calls and hands them out fairly.
+
+    Senders are served round-robin, one request at a time, so a client
+    flooding the server cannot delay the calls of other clients. The calls of
+    a single sender are served in arrival order. Senders whose next call is
+    an `UpdateProperties` are only served once no other sender has a
+    different call pending.
+
+    An `UpdateProperties` call that follows another one from the same sender
+    for the same sound, with no call in between, is merged into it, so only
+    the latest update of each property gets applied.
+    """
+    _LOW_PRIORITY_METHODS = ("UpdateProperties", )
+
+    def __init__(self):
+        # The queued requests of each sender, in arrival order.
+        self._requests = {}
+        # One dictionary per priority class holding the senders whose next
+        # request is of that class. The first sender of each dictionary is
+        # served next.
+        self._queues = (OrderedDict(), OrderedDict())
+        self._n_requests = 0
+
+    def __len__(self):
+        return self._n_requests
+
+    def push(self, request):
+        """
+        Queues a request.
+
+        Args:
+            request (Request): The request to queue.
+
+        Returns:
+            The `Request` superseded by `request`, if any. Otherwise, None.
+            Superseded requests will never be handed out by `pop`.
+        """
+        requests = self._requests.get(request.sender)
+        if requests is None:
+            self._requests[request.sender] = deque([request])
+            self._get_queue(request)[request.sender] = None
+            self._n_requests += 1
+            return None
+
+        previous = requests[-1]
+        if request.method in self._LOW_PRIORITY_METHODS and \
+                previous.method == request.method and \
+                previous.params[0] == request.params[0]:
+            updates = dict(previous.params[1])
+            updates.update(request.params[1])
+            requests[-1] = request._replace(
+                params=(request.params[0], updates),
+                arrival_time=previous.arrival_time)
+            return previous
+
+        requests.append(request)
+        self._n_requests += 1
+        return None
+
+    def pop(self):
+        """
+        Takes the next request to serve.
+
+        Returns:
+            The next `Request`, or None if the queue is empty.
+        """
+        for queue in self._queues:
+            if not queue:
+                continue
+            sender, unused_value = queue.popitem(last=False)
+            requests = self._requests[sender]
+            request = requests.popleft()
+            if requests:
+                self._get_queue(requests[0])[sender] = None
+            else:
+                del self._requests[sender]
+            self._n_requests -= 1
+            return request
+        return None
+
+    def drop_sender(self, sender):
+        """
+        Removes all the requests queued by `sender`.
+
+        Returns:
+            list: The removed requests.
+        """
+        dropped = list(self._requests.pop(sender, ()))
+        for queue in self._queues:
+            queue.pop(sender, None)
+        self._n_requests -= len(dropped)
+        return dropped
+
+    def _get_queue(self, request):
+        if request.method in self._LOW_PRIORITY_METHODS:
+            return self._queues[1]
+        return self._queues[0]
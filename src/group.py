@@ -0,0 +1,110 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import gi
+
+gi.require_version('GLib', '2.0')  # noqa
+gi.require_version('Gst', '1.0')   # noqa
+from gi.repository import GLib  # noqa
+from gi.repository import Gst  # noqa
+
+
+class SoundGroup:
+    """
+    Starts several sounds at once, on a shared clock.
+
+    Each sound has its own pipeline which, by default, would pick its own
+    clock and base time when set to PLAYING, so layered sounds would start
+    a few milliseconds apart and drift. Instead, the members of a group are
+    prerolled, then all of them are set to the same clock and base time and
+    played in one go.
+    """
+    # Members that are not prerolled by then are started on their own.
+    _PREROLL_TIMEOUT_S = 2
+    # Margin between the start of the group and the base time, so all the
+    # pipelines are PLAYING by then.
+    _START_LATENCY_NS = 20 * Gst.MSECOND
+
+    def __init__(self, server, sounds):
+        self.server = server
+        self._waiting = []
+        self._prerolled = []
+        self._handler_ids = []
+        self._timeout_id = None
+        for sound in sounds:
+            self._waiting.append(sound)
+            self._handler_ids.append((sound, sound.connect(
+                "prerolled", self.__sound_prerolled_cb)))
+            self._handler_ids.append((sound, sound.connect(
+                "released", self.__sound_gone_cb)))
+            self._handler_ids.append((sound, sound.connect(
+                "error", self.__sound_gone_cb)))
+
+    def start(self):
+        """
+        Starts the group once all its members are prerolled.
+        """
+        if not self._waiting:
+            self._start()
+            return
+        self._timeout_id = GLib.timeout_add_seconds(
+            self._PREROLL_TIMEOUT_S, self.__preroll_timeout_cb)
+
+    def __sound_prerolled_cb(self, sound):
+        if sound not in self._waiting:
+            return
+        self._waiting.remove(sound)
+        self._prerolled.append(sound)
+        self._maybe_start()
+
+    def __sound_gone_cb(self, sound, *unused_args):
+        if sound in self._waiting:
+            self._waiting.remove(sound)
+        elif sound in self._prerolled:
+            self._prerolled.remove(sound)
+        self._maybe_start()
+
+    def __preroll_timeout_cb(self):
+        self._timeout_id = None
+        self.server.logger.warning("%d sounds of a group could not be "
+                                   "prerolled in time.", len(self._waiting))
+        self._start()
+        return GLib.SOURCE_REMOVE
+
+    def _maybe_start(self):
+        if self._timeout_id is None or self._waiting:
+            return
+        GLib.Source.remove(self._timeout_id)
+        self._timeout_id = None
+        self._start()
+
+    def _start(self):
+        for sound, handler_id in self._handler_ids:
+            sound.disconnect(handler_id)
+        self._handler_ids = []
+
+        clock = Gst.SystemClock.obtain()
+        base_time = clock.get_time() + self._START_LATENCY_NS
+        for sound in self._prerolled:
+            sound.sync_to_clock(clock, base_time)
+        for sound in self._prerolled + self._waiting:
+            sound.play()
+        self._prerolled = []
+        self._waiting = []
@@ -0,0 +1,421 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import bisect
+import os
+from hack_sound_server.utils.memory import format_size
+from hack_sound_server.utils.memory import get_rss
+
+
+# Latencies measured for each sound, in microseconds: from the arrival of the
+# D-Bus call (or the start time of a scheduled sound) to the PLAYING state
+# and to the first buffer reaching the audio sink, and the latency reported
+# by the pipeline once prerolled.
+ARRIVAL_TO_PLAYING = "arrival-to-playing"
+ARRIVAL_TO_FIRST_BUFFER = "arrival-to-first-buffer"
+PIPELINE_LATENCY = "pipeline-latency"
+
+_THREAD_SELF_PATH = "/proc/thread-self"
+_THREAD_STAT_PATH = "/proc/self/task/{}/stat"
+
+
+def _get_current_thread_id():
+    # The kernel id of the calling thread, which is not exposed by Python
+    # before 3.8. Returns None if it is not available.
+    try:
+        return int(os.readlink(_THREAD_SELF_PATH).rsplit("/", 1)[-1])
+    except (OSError, ValueError):
+        return None
+
+
+def _get_thread_cpu_ns(thread_id):
+    # The user and system CPU time of a thread of the process, in
+    # nanoseconds, or None if it is not available.
+    try:
+        with open(_THREAD_STAT_PATH.format(thread_id)) as stat_file:
+            stat = stat_file.read()
+        # The command name may contain spaces, the fields after it do not.
+        fields = stat[stat.rindex(")") + 2:].split()
+        ticks = int(fields[11]) + int(fields[12])
+        return ticks * 10 ** 9 // os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in buckets whose width doubles, from 1 millisecond.
+    """
+    # Upper bounds of the buckets in microseconds, up to about 8 seconds.
+    # Longer latencies go to an extra bucket.
+    BOUNDS_US = tuple(1000 * 2 ** i for i in range(14))
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BOUNDS_US) + 1)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def add(self, latency_us):
+        self._counts[bisect.bisect_left(self.BOUNDS_US, latency_us)] += 1
+        self.count += 1
+        self.total_us += latency_us
+        self.max_us = max(self.max_us, latency_us)
+
+    def get_percentile(self, ratio):
+        """
+        Gets an upper bound of a percentile of the latencies.
+
+        Returns:
+            int: The upper bound of the bucket of the percentile, or the
+            maximum latency if lower, in microseconds.
+        """
+        rank = ratio * self.count
+        n_latencies = 0
+        for bound_us, count in zip(self.BOUNDS_US, self._counts):
+            n_latencies += count
+            if n_latencies >= rank:
+                return min(bound_us, self.max_us)
+        return self.max_us
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean-us": self.total_us // self.count if self.count else 0,
+            "max-us": self.max_us,
+            "p50-us": self.get_percentile(0.5),
+            "p90-us": self.get_percentile(0.9),
+            "p99-us": self.get_percentile(0.99),
+            # Pairs of (upper bound, count), the last bound being None.
+            "buckets": [(bound_us, count) for bound_us, count in
+                        zip(self.BOUNDS_US + (None, ), self._counts)
+                        if count],
+        }
+
+
+class SoundUsage:
+    """
+    Accounts the resources used by a sound, and its latencies.
+
+    Times are in microseconds of the clock of the `ResourceAccounting`. The
+    CPU time is the one of the streaming thread of the pipeline, measured
+    between the moment the decoder exposes its pads and the moment the
+    pipeline is handed off, so it is only approximate and not available on
+    systems without `/proc`.
+    """
+    __slots__ = ("sound_event_id", "bus_name", "type_", "created_time",
+                 "playing_us", "paused_us", "cpu_ns", "buffer_bytes",
+                 "n_elements", "request_time", "latencies_us", "_accounting",
+                 "_time_func", "_state", "_state_time", "_streaming_thread")
+
+    PLAYING = "playing"
+    PAUSED = "paused"
+
+    def __init__(self, sound_event_id, bus_name, type_, accounting):
+        self.sound_event_id = sound_event_id
+        self.bus_name = bus_name
+        self.type_ = type_
+        self._accounting = accounting
+        self._time_func = accounting.time_func
+        self.created_time = self._time_func()
+        self.playing_us = 0
+        self.paused_us = 0
+        self.cpu_ns = None
+        self.buffer_bytes = None
+        self.n_elements = None
+        # The time the latencies of the sound are measured from.
+        self.request_time = None
+        self.latencies_us = {}
+        self._state = None
+        self._state_time = None
+        # Kernel id and CPU time of the streaming thread when it was seen.
+        self._streaming_thread = None
+
+    def set_state(self, state):
+        """
+        Sets the state of the sound: `PLAYING`, `PAUSED` or None.
+        """
+        now = self._time_func()
+        if self._state == self.PLAYING:
+            self.playing_us += now - self._state_time
+        elif self._state == self.PAUSED:
+            self.paused_us += now - self._state_time
+        self._state = state
+        self._state_time = now
+        if state == self.PLAYING and self.request_time is not None:
+            self.add_latency(ARRIVAL_TO_PLAYING, now - self.request_time)
+
+    def add_latency(self, name, latency_us):
+        """
+        Records a latency of the sound, unless it was already known.
+        """
+        if name in self.latencies_us:
+            return
+        self.latencies_us[name] = latency_us
+        self._accounting.add_latency(self.type_, name, latency_us)
+
+    def start_streaming_thread(self):
+        """
+        Starts accounting the CPU time of the calling streaming thread.
+        """
+        if self._streaming_thread is not None:
+            return
+        thread_id = _get_current_thread_id()
+        if thread_id is None:
+            return
+        cpu_ns = _get_thread_cpu_ns(thread_id)
+        if cpu_ns is not None:
+            self._streaming_thread = (thread_id, cpu_ns)
+
+    def stop_streaming_thread(self):
+        """
+        Stops accounting the CPU time of the streaming thread.
+        """
+        cpu_ns = self._get_streaming_thread_cpu_ns()
+        self._streaming_thread = None
+        if cpu_ns is not None:
+            self.cpu_ns = (self.cpu_ns or 0) + cpu_ns
+
+    def _get_streaming_thread_cpu_ns(self):
+        streaming_thread = self._streaming_thread
+        if streaming_thread is None:
+            return None
+        thread_id, start_cpu_ns = streaming_thread
+        cpu_ns = _get_thread_cpu_ns(thread_id)
+        if cpu_ns is None:
+            return None
+        return max(cpu_ns - start_cpu_ns, 0)
+
+    def to_dict(self):
+        now = self._time_func()
+        playing_us = self.playing_us
+        paused_us = self.paused_us
+        if self._state == self.PLAYING:
+            playing_us += now - self._state_time
+        elif self._state == self.PAUSED:
+            paused_us += now - self._state_time
+        cpu_ns = self.cpu_ns
+        streaming_cpu_ns = self._get_streaming_thread_cpu_ns()
+        if streaming_cpu_ns is not None:
+            cpu_ns = (cpu_ns or 0) + streaming_cpu_ns
+        return {
+            "sound-event-id": self.sound_event_id,
+            "bus-name": self.bus_name,
+            "alive-us": now - self.created_time,
+            "playing-us": playing_us,
+            "paused-us": paused_us,
+            "cpu-ns": cpu_ns,
+            "buffer-bytes": self.buffer_bytes,
+            "n-elements": self.n_elements,
+            "latencies-us": dict(self.latencies_us),
+        }
+
+
+def _new_totals():
+    return {
+        "sounds": 0,
+        "alive-us": 0,
+        "playing-us": 0,
+        "paused-us": 0,
+        "cpu-ns": 0,
+        "max-buffer-bytes": 0,
+        "max-elements": 0,
+    }
+
+
+def _add_to_totals(totals, usage):
+    totals["sounds"] += 1
+    for key in ("alive-us", "playing-us", "paused-us", "cpu-ns"):
+        totals[key] += usage[key] or 0
+    totals["max-buffer-bytes"] = max(totals["max-buffer-bytes"],
+                                     usage["buffer-bytes"] or 0)
+    totals["max-elements"] = max(totals["max-elements"],
+                                 usage["n-elements"] or 0)
+
+
+def _merge_totals(totals, other):
+    for key in ("sounds", "alive-us", "playing-us", "paused-us", "cpu-ns"):
+        totals[key] += other[key]
+    for key in ("max-buffer-bytes", "max-elements"):
+        totals[key] = max(totals[key], other[key])
+
+
+class ResourceAccounting:
+    """
+    Accounts the resources used by the sounds, by sound event id and by bus
+    name of the client that created them.
+
+    The usage of the released sounds is folded into the totals, so the cost
+    of a sound event id is known over the whole life of the server. The
+    totals of the clients that left the bus are folded into a single
+    `EXITED` entry, so they do not pile up as clients come and go.
+    """
+    _SUMMARY_ROWS = 10
+    EXITED = "exited"
+
+    def __init__(self, time_func):
+        """
+        Args:
+            time_func (callable): Gets the current time in microseconds.
+        """
+        self.time_func = time_func
+        self._start_time = time_func()
+        self._live = {}
+        # Latency histograms by sound type and latency name.
+        self._latencies = {}
+        self._by_sound_event_id = {}
+        self._by_bus_name = {}
+        # Bus names that left the bus while some of their sounds were alive.
+        self._exited_bus_names = set()
+
+    def track(self, sound):
+        """
+        Starts accounting a new sound.
+
+        Returns:
+            SoundUsage: The usage the sound has to keep up to date.
+        """
+        usage = SoundUsage(sound.sound_event_id, sound.bus_name, sound.type_,
+                           self)
+        self._live[sound.uuid] = usage
+        return usage
+
+    def untrack(self, sound):
+        """
+        Stops accounting a released sound and adds its usage to the totals.
+        """
+        usage = self._live.pop(sound.uuid, None)
+        if usage is None:
+            return
+        usage.set_state(None)
+        usage.stop_streaming_thread()
+        usage = usage.to_dict()
+        _add_to_totals(self._get_totals(self._by_sound_event_id,
+                                        usage["sound-event-id"]), usage)
+        bus_name = usage["bus-name"]
+        if bus_name in self._exited_bus_names:
+            if not self._has_live_sounds(bus_name):
+                self._exited_bus_names.discard(bus_name)
+            bus_name = self.EXITED
+        _add_to_totals(self._get_totals(self._by_bus_name, bus_name), usage)
+
+    def bus_name_vanished(self, bus_name):
+        """
+        Folds the totals of a client that left the bus into the `EXITED`
+        totals, together with the sounds of the client released later.
+        """
+        totals = self._by_bus_name.pop(bus_name, None)
+        if totals is not None:
+            _merge_totals(self._get_totals(self._by_bus_name, self.EXITED),
+                          totals)
+        if self._has_live_sounds(bus_name):
+            self._exited_bus_names.add(bus_name)
+
+    def _has_live_sounds(self, bus_name):
+        return any(usage.bus_name == bus_name
+                   for usage in self._live.values())
+
+    def add_latency(self, type_, name, latency_us):
+        histograms = self._latencies.setdefault(type_, {})
+        if name not in histograms:
+            histograms[name] = LatencyHistogram()
+        histograms[name].add(latency_us)
+
+    @staticmethod
+    def _get_totals(totals_by_key, key):
+        if key not in totals_by_key:
+            totals_by_key[key] = _new_totals()
+        return totals_by_key[key]
+
+    def get_usage(self):
+        """
+        Gets the resource usage of the process and of the sounds.
+
+        Returns:
+            dict: The usage of the "process", of the live "sounds" by uuid,
+            the totals, including the live sounds, by "sound-event-id" and
+            by "bus-name", and the "latency" histograms by sound type.
+        """
+        sounds = {str(uuid): usage.to_dict()
+                  for uuid, usage in self._live.items()}
+        by_sound_event_id = {key: dict(totals) for key, totals in
+                             self._by_sound_event_id.items()}
+        by_bus_name = {key: dict(totals) for key, totals in
+                       self._by_bus_name.items()}
+        for usage in sounds.values():
+            _add_to_totals(self._get_totals(by_sound_event_id,
+                                            usage["sound-event-id"]), usage)
+            bus_name = usage["bus-name"]
+            if bus_name in self._exited_bus_names:
+                bus_name = self.EXITED
+            _add_to_totals(self._get_totals(by_bus_name, bus_name), usage)
+        times = os.times()
+        return {
+            "process": {
+                "uptime-us": self.time_func() - self._start_time,
+                "cpu-ns": int((times.user + times.system) * 10 ** 9),
+                "rss-bytes": get_rss(),
+                "live-sounds": len(sounds),
+            },
+            "sounds": sounds,
+            "sound-event-id": by_sound_event_id,
+            "bus-name": by_bus_name,
+            "latency": {type_: {name: histogram.to_dict()
+                                for name, histogram in histograms.items()}
+                        for type_, histograms in self._latencies.items()},
+        }
+
+    def format_summary(self):
+        """
+        Formats a summary of the usage, with the most expensive sound event
+        ids first.
+
+        Returns:
+            list: The lines of the summary.
+        """
+        usage = self.get_usage()
+        process = usage["process"]
+        lines = ["Process: up {:.1f} s, CPU {:.2f} s, RSS {}".format(
+            process["uptime-us"] / 10 ** 6, process["cpu-ns"] / 10 ** 9,
+            format_size(process["rss-bytes"]))]
+        by_cost = sorted(usage["sound-event-id"].items(),
+                         key=lambda item: (item[1]["cpu-ns"],
+                                           item[1]["alive-us"]),
+                         reverse=True)
+        for sound_event_id, totals in by_cost[:self._SUMMARY_ROWS]:
+            lines.append(
+                "{}: {} sounds, alive {:.1f} s, playing {:.1f} s, paused "
+                "{:.1f} s, CPU {:.3f} s, up to {} elements and {} KiB of "
+                "buffers".format(sound_event_id, totals["sounds"],
+                                 totals["alive-us"] / 10 ** 6,
+                                 totals["playing-us"] / 10 ** 6,
+                                 totals["paused-us"] / 10 ** 6,
+                                 totals["cpu-ns"] / 10 ** 9,
+                                 totals["max-elements"],
+                                 totals["max-buffer-bytes"] // 1024))
+        for type_, histograms in sorted(usage["latency"].items()):
+            for name, histogram in sorted(histograms.items()):
+                lines.append(
+                    "Latency {} of {} sounds: p50 <= {:.1f} ms, p90 <= "
+                    "{:.1f} ms, max {:.1f} ms over {} sounds".format(
+                        name, type_, histogram["p50-us"] / 1000,
+                        histogram["p90-us"] / 1000,
+                        histogram["max-us"] / 1000, histogram["count"]))
+        return lines
@@ -0,0 +1,159 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import gi
+
+gi.require_version('GLib', '2.0')  # noqa
+gi.require_version('GstController', '1.0')  # noqa
+from gi.repository import GLib  # noqa
+from gi.repository import GstController  # noqa
+
+
+class MixGroup:
+    """
+    A gain stage shared by all the sounds of a group.
+
+    Each sound pipeline has a "group-volume" element whose volume is bound to
+    the control source of its group. The control source is a flat LFO (no
+    amplitude) whose offset is the gain of the group, so it does not depend
+    on the position of each pipeline, and changing the offset changes the
+    volume of all the sounds of the group at once.
+    """
+    _DEFAULT_VOLUME = 1.0
+    _RAMP_INTERVAL_MS = 20
+
+    def __init__(self, name):
+        self.name = name
+        self._control = GstController.LFOControlSource(
+            amplitude=0.0, offset=self._DEFAULT_VOLUME)
+        # The volume set by clients, and the ducking gain applied on top.
+        self.volume = self._DEFAULT_VOLUME
+        self.duck_gain = 1.0
+        self._ramp_id = None
+        self._ramp = None
+
+    @property
+    def gain(self):
+        return self._control.props.offset
+
+    def bind(self, element):
+        """
+        Binds the volume of a "group-volume" element to the group.
+
+        The element may be bound to another group, when its pipeline was
+        recycled.
+        """
+        binding = element.get_control_binding("volume")
+        if binding is not None:
+            if binding.props.control_source == self._control:
+                return
+            element.remove_control_binding(binding)
+        binding = GstController.DirectControlBinding.new_absolute(
+            element, "volume", self._control)
+        if not element.add_control_binding(binding):
+            raise ValueError('bad control binding')
+
+    def set_volume(self, volume, transition_time_ms=0):
+        self.volume = volume
+        self._ramp_to(self.volume * self.duck_gain, transition_time_ms)
+
+    def set_duck_gain(self, duck_gain, transition_time_ms=0):
+        self.duck_gain = duck_gain
+        self._ramp_to(self.volume * self.duck_gain, transition_time_ms)
+
+    def _ramp_to(self, gain, transition_time_ms):
+        if self._ramp_id is not None:
+            GLib.Source.remove(self._ramp_id)
+            self._ramp_id = None
+        if transition_time_ms <= 0:
+            self._control.props.offset = gain
+            return
+        start_time = GLib.get_monotonic_time()
+        self._ramp = (start_time, self.gain,
+                      start_time + transition_time_ms * 1000, gain)
+        self._ramp_id = GLib.timeout_add(self._RAMP_INTERVAL_MS,
+                                         self.__ramp_cb)
+
+    def __ramp_cb(self):
+        start_time, start_gain, end_time, end_gain = self._ramp
+        now = GLib.get_monotonic_time()
+        if now >= end_time:
+            self._control.props.offset = end_gain
+            self._ramp_id = None
+            self._ramp = None
+            return GLib.SOURCE_REMOVE
+        progress = (now - start_time) / (end_time - start_time)
+        self._control.props.offset = \
+            start_gain + (end_gain - start_gain) * progress
+        return GLib.SOURCE_CONTINUE
+
+
+class Mixer:
+    """
+    Keeps the mix groups and ducks the background sounds.
+
+    Sounds with a "duck-bg" gain lower the "bg" group by that gain while they
+    are in the registry. If several of them are, the lowest gain is applied.
+
+    Args:
+        group_names (iterable): The names of the mix groups of the metadata,
+                                on top of the "sfx" and "bg" default groups.
+    """
+    DUCKED_GROUP = "bg"
+    _DEFAULT_GROUP_NAMES = ("sfx", "bg")
+    _DUCK_TRANSITION_MS = 200
+
+    def __init__(self, group_names=()):
+        # Clients can only change these groups, so they cannot create
+        # groups without bound.
+        self.group_names = frozenset(self._DEFAULT_GROUP_NAMES).union(
+            group_names)
+        self._groups = {}
+        # Ducking gains by sound uuid.
+        self._duck_gains = {}
+
+    def get_group(self, name):
+        """
+        Gets a mix group, creating it if needed.
+
+        Raises:
+            KeyError: If the name is not one of `group_names`.
+        """
+        if name not in self.group_names:
+            raise KeyError(name)
+        group = self._groups.get(name)
+        if group is None:
+            group = MixGroup(name)
+            self._groups[name] = group
+        return group
+
+    def duck(self, uuid, gain):
+        self._duck_gains[uuid] = gain
+        self._update_ducking()
+
+    def unduck(self, uuid):
+        if self._duck_gains.pop(uuid, None) is not None:
+            self._update_ducking()
+
+    def _update_ducking(self):
+        duck_gain = min(self._duck_gains.values(), default=1.0)
+        group = self.get_group(self.DUCKED_GROUP)
+        if duck_gain != group.duck_gain:
+            group.set_duck_gain(duck_gain, self._DUCK_TRANSITION_MS)
@@ -0,0 +1,168 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import gi
+from collections import deque
+
+gi.require_version('GLib', '2.0')  # noqa
+gi.require_version('Gst', '1.0')   # noqa
+from gi.repository import GLib  # noqa
+from gi.repository import Gst  # noqa
+
+
+class PipelinePool:
+    """
+    Keeps the pipelines of released sounds to be reused by new sounds.
+
+    Pipelines are classified by sound event id and kept in the READY state,
+    so reusing one just requires to point its source to the file to play.
+    There is a limited number of pipelines per sound event id and pipelines
+    that have not been reused for a while are torn down, unless their sound
+    event id is pinned.
+    """
+    _MAX_PIPELINES_PER_EVENT = 2
+    IDLE_EXPIRY_S = 30
+    _EXPIRY_CHECK_S = 5
+
+    def __init__(self, teardown):
+        self._teardown = teardown
+        # Maps sound event ids to deques of (pipeline, time added) pairs.
+        self._pipelines = {}
+        self._n_pipelines = 0
+        self._pinned = set()
+        self._expiry_id = None
+        self.idle_expiry_s = self.IDLE_EXPIRY_S
+
+    def __len__(self):
+        return self._n_pipelines
+
+    def recycle(self, sound_event_id, pipeline):
+        """
+        Moves a pipeline to the READY state and adds it to the pool.
+
+        If there is no room for the pipeline, it is torn down instead.
+
+        Args:
+            sound_event_id (str): The sound event id the pipeline plays.
+            pipeline (Gst.Pipeline): A pipeline without any bus watch or
+                                     signal handlers of its previous sound.
+        """
+        if not self.has_room(sound_event_id):
+            self._teardown.push(pipeline)
+            return
+
+        def ready_cb(pipeline):
+            self.add(sound_event_id, pipeline)
+            return GLib.SOURCE_REMOVE
+
+        self._teardown.push(pipeline, Gst.State.READY, ready_cb)
+
+    def has_room(self, sound_event_id):
+        """
+        Checks whether there is room in the pool for another pipeline.
+        """
+        pipelines = self._pipelines.get(sound_event_id, ())
+        return len(pipelines) < self._MAX_PIPELINES_PER_EVENT
+
+    def pin(self, sound_event_id):
+        """
+        Keeps the pipelines of a sound event id from expiring.
+        """
+        self._pinned.add(sound_event_id)
+
+    def unpin(self, sound_event_id):
+        """
+        Lets the pipelines of a sound event id expire, and tears them down.
+        """
+        self._pinned.discard(sound_event_id)
+        for pipeline, unused_time_added in \
+                self._pipelines.pop(sound_event_id, ()):
+            self._teardown.push(pipeline)
+            self._n_pipelines -= 1
+
+    def take(self, sound_event_id):
+        """
+        Takes a pipeline out of the pool.
+
+        Returns:
+            Gst.Pipeline: A pipeline in the READY state, or None if there was
+            no pipeline for `sound_event_id`.
+        """
+        pipelines = self._pipelines.get(sound_event_id)
+        if not pipelines:
+            return None
+        pipeline, unused_time_added = pipelines.pop()
+        if not pipelines:
+            del self._pipelines[sound_event_id]
+        self._n_pipelines -= 1
+        return pipeline
+
+    def clear(self):
+        """
+        Tears down all the pipelines in the pool.
+
+        Returns:
+            int: The number of pipelines torn down.
+        """
+        n_pipelines = self._n_pipelines
+        for pipelines in self._pipelines.values():
+            for pipeline, unused_time_added in pipelines:
+                self._teardown.push(pipeline)
+        self._pipelines = {}
+        self._n_pipelines = 0
+        return n_pipelines
+
+    def add(self, sound_event_id, pipeline):
+        """
+        Adds a pipeline in the READY state to the pool.
+
+        If there is no room for the pipeline, it is torn down instead.
+        """
+        if not self.has_room(sound_event_id):
+            self._teardown.push(pipeline)
+            return
+        if sound_event_id not in self._pipelines:
+            self._pipelines[sound_event_id] = deque()
+        self._pipelines[sound_event_id].append(
+            (pipeline, GLib.get_monotonic_time()))
+        self._n_pipelines += 1
+        if self._expiry_id is None:
+            self._expiry_id = GLib.timeout_add_seconds(
+                self._EXPIRY_CHECK_S, self.__expiry_cb,
+                priority=GLib.PRIORITY_LOW)
+
+    def __expiry_cb(self):
+        deadline = GLib.get_monotonic_time() - \
+            self.idle_expiry_s * GLib.USEC_PER_SEC
+        for sound_event_id in list(self._pipelines):
+            if sound_event_id in self._pinned:
+                continue
+            pipelines = self._pipelines[sound_event_id]
+            # The oldest pipelines are on the left.
+            while pipelines and pipelines[0][1] <= deadline:
+                pipeline, unused_time_added = pipelines.popleft()
+                self._teardown.push(pipeline)
+                self._n_pipelines -= 1
+            if not pipelines:
+                del self._pipelines[sound_event_id]
+        if len(self._pipelines) > len(self._pinned & self._pipelines.keys()):
+            return GLib.SOURCE_CONTINUE
+        self._expiry_id = None
+        return GLib.SOURCE_REMOVE
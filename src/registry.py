@@ -126,14 +126,91 @@ class SoundEventsRegistry:
         return sound_event_id in self.get_event_ids()
 
 
+class PreloadRegistry:
+    """
+    Refcounts the preloaded sound event ids by bus name.
+    """
+    def __init__(self):
+        # Maps bus names to dictionaries of refcounts by sound event id.
+        self._refcount_by_bus_name = {}
+        # Number of bus names referencing each preloaded sound event id.
+        self._n_bus_names = {}
+
+    def __len__(self):
+        return len(self._n_bus_names)
+
+    def add(self, bus_name, sound_event_ids):
+        """
+        References the given sound event ids on behalf of a bus name.
+
+        Returns:
+            list: The sound event ids which were not preloaded before.
+        """
+        refcount = self._refcount_by_bus_name.setdefault(bus_name, {})
+        added = []
+        for sound_event_id in sound_event_ids:
+            if sound_event_id not in refcount:
+                refcount[sound_event_id] = 0
+                if sound_event_id not in self._n_bus_names:
+                    self._n_bus_names[sound_event_id] = 0
+                    added.append(sound_event_id)
+                self._n_bus_names[sound_event_id] += 1
+            refcount[sound_event_id] += 1
+        return added
+
+    def remove(self, bus_name, sound_event_ids):
+        """
+        Unreferences the given sound event ids on behalf of a bus name.
+
+        Returns:
+            list: The sound event ids which are not preloaded anymore.
+        """
+        refcount = self._refcount_by_bus_name.get(bus_name, {})
+        removed = []
+        for sound_event_id in sound_event_ids:
+            if sound_event_id not in refcount:
+                continue
+            refcount[sound_event_id] -= 1
+            if refcount[sound_event_id] == 0:
+                del refcount[sound_event_id]
+                if self._unref_bus_name(sound_event_id):
+                    removed.append(sound_event_id)
+        if not refcount:
+            self._refcount_by_bus_name.pop(bus_name, None)
+        return removed
+
+    def remove_bus_name(self, bus_name):
+        """
+        Drops all the references of a bus name.
+
+        Returns:
+            list: The sound event ids which are not preloaded anymore.
+        """
+        refcount = self._refcount_by_bus_name.pop(bus_name, {})
+        return [sound_event_id for sound_event_id in refcount
+                if self._unref_bus_name(sound_event_id)]
+
+    def is_preloaded(self, sound_event_id):
+        return sound_event_id in self._n_bus_names
+
+    def _unref_bus_name(self, sound_event_id):
+        self._n_bus_names[sound_event_id] -= 1
+        if self._n_bus_names[sound_event_id] > 0:
+            return False
+        del self._n_bus_names[sound_event_id]
+        return True
+
+
 class Registry:
     def __init__(self):
         self.sounds = {}
         # COunts the references of a sound by UUID and by bus name.
         self.refcount = {}
+        # Sets of UUIDs classified by the bus name that requested them.
         self.watcher_by_bus_name = {}
         self.sound_events = SoundEventsRegistry()
         self.background_sounds = []
+        self.preloads = PreloadRegistry()
 
     def _try_add_bg_sound(self, sound):
         """
@@ -238,8 +315,6 @@ class Registry:
         self.sound_events.remove_sound(sound)
         del self.sounds[sound.uuid]
         if sound.bus_name in self.watcher_by_bus_name:
-            uuids = self.watcher_by_bus_name[sound.bus_name].uuids
-            if sound.uuid in uuids:
-                uuids.remove(sound.uuid)
+            self.watcher_by_bus_name[sound.bus_name].discard(sound.uuid)
         del self.refcount[sound.uuid]
         return sound_to_resume
@@ -0,0 +1,187 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import heapq
+import itertools
+
+
+class ScheduledCall:
+    """
+    A call waiting in the `Scheduler`.
+    """
+    __slots__ = ("time", "callback", "args", "cancelled")
+
+    def __init__(self, time, callback, args):
+        self.time = time
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class Scheduler:
+    """
+    Runs calls at given times of the monotonic clock.
+
+    Scheduled calls are just entries of a heap, served by a single timeout
+    of the main loop armed for the earliest one, so waiting calls hold no
+    resources.
+
+    The clock and the timeouts are given by the caller, so the scheduler
+    does not depend on GLib. The server uses `GLib.get_monotonic_time`,
+    `GLib.timeout_add` and `GLib.Source.remove`.
+    """
+    # The heap is compacted when cancelled entries are more than half of it,
+    # and at least this many.
+    _MIN_CANCELLED_TO_COMPACT = 64
+
+    def __init__(self, time_func, timeout_add, source_remove):
+        """
+        Args:
+            time_func (callable): Gives the current time in microseconds.
+            timeout_add (callable): Takes a delay in milliseconds and a
+                                    callback, calls the callback from the
+                                    main loop once the delay is elapsed
+                                    and returns an id for `source_remove`.
+                                    The callback returns False.
+            source_remove (callable): Takes the id of a timeout added by
+                                      `timeout_add` which has not run yet,
+                                      and removes it.
+        """
+        self._time_func = time_func
+        self._timeout_add = timeout_add
+        self._source_remove = source_remove
+        # (time, sequence number, ScheduledCall) triplets. The sequence
+        # number keeps calls scheduled at the same time in order.
+        self._heap = []
+        self._n_cancelled = 0
+        self._counter = itertools.count()
+        self._timeout_id = None
+        self._timeout_time = None
+
+    def __len__(self):
+        return len(self._heap) - self._n_cancelled
+
+    def now(self):
+        return self._time_func()
+
+    def add(self, time, callback, *args):
+        """
+        Schedules `callback(*args)` to be called from the main context.
+
+        Args:
+            time (int): The time in microseconds of the monotonic clock. Calls
+                        scheduled in the past are run as soon as possible.
+            callback (callable): The function to call.
+
+        Returns:
+            ScheduledCall: The scheduled call, which can be cancelled.
+        """
+        call = ScheduledCall(time, callback, args)
+        heapq.heappush(self._heap, (time, next(self._counter), call))
+        self._arm()
+        return call
+
+    def reschedule(self, call, time):
+        """
+        Moves a scheduled call that has not run yet to another time.
+
+        The call keeps its single entry in the heap, so rescheduling it often,
+        such as a lease renewed on every update, does not grow the heap.
+        """
+        if call.cancelled:
+            return
+        if time >= call.time:
+            # The entry is pushed back to its new time when it is due.
+            call.time = time
+            return
+        call.time = time
+        for i, entry in enumerate(self._heap):
+            if entry[2] is call:
+                self._heap[i] = (time, entry[1], call)
+                heapq.heapify(self._heap)
+                break
+        self._arm()
+
+    def cancel(self, call):
+        """
+        Cancels a scheduled call that has not run yet.
+        """
+        if call.cancelled:
+            return
+        # Cancelled calls are dropped from the heap when they are due. Drop
+        # their arguments right away, so they do not keep objects alive.
+        call.cancelled = True
+        call.callback = None
+        call.args = ()
+        self._n_cancelled += 1
+        if self._n_cancelled >= self._MIN_CANCELLED_TO_COMPACT and \
+                self._n_cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap
+                          if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._n_cancelled = 0
+            self._arm()
+
+    def _arm(self):
+        next_time = self._heap[0][0] if self._heap else None
+        if next_time == self._timeout_time:
+            return
+        if self._timeout_id is not None:
+            self._source_remove(self._timeout_id)
+            self._timeout_id = None
+        self._timeout_time = next_time
+        if next_time is None:
+            return
+        # Round up, so the timeout never fires before the call is due.
+        delay_ms = (max(0, next_time - self._time_func()) + 999) // 1000
+        self._timeout_id = self._timeout_add(delay_ms, self.__timeout_cb)
+
+    def _pop_due_call(self, now):
+        """
+        Takes the next call due at `now`, skipping the cancelled ones.
+
+        Returns:
+            ScheduledCall: The call, or None if no call is due.
+        """
+        while self._heap and self._heap[0][0] <= now:
+            time, unused_seq, call = heapq.heappop(self._heap)
+            if call.cancelled:
+                self._n_cancelled -= 1
+            elif call.time > time:
+                # Rescheduled to a later time.
+                heapq.heappush(self._heap,
+                               (call.time, next(self._counter), call))
+            else:
+                # Cancelled, so cancelling it once it has run is a no-op.
+                call.cancelled = True
+                return call
+        return None
+
+    def __timeout_cb(self):
+        self._timeout_id = None
+        self._timeout_time = None
+        now = self._time_func()
+        call = self._pop_due_call(now)
+        while call is not None:
+            call.callback(*call.args)
+            call = self._pop_due_call(now)
+        self._arm()
+        # Like `GLib.SOURCE_REMOVE`.
+        return False
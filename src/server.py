@@ -20,20 +20,39 @@
 #
 
 import gi
-from collections import namedtuple
+import json
+import os
+import random
+import sys
+import time
+from hack_sound_server.dispatcher import InvalidArgsException
+from hack_sound_server.dispatcher import parse_params
+from hack_sound_server.dispatcher import Request
+from hack_sound_server.dispatcher import RequestQueue
+from hack_sound_server.group import SoundGroup
+from hack_sound_server.metrics import ResourceAccounting
+from hack_sound_server.mixer import Mixer
+from hack_sound_server.pool import PipelinePool
 from hack_sound_server.registry import Registry
+from hack_sound_server.scheduler import Scheduler
 from hack_sound_server.sound import Sound
+from hack_sound_server.utils.handle import SoundHandle
 from hack_sound_server.utils.loggable import Logger
+from hack_sound_server.utils.loggable import flight_recorder
 from hack_sound_server.utils.loggable import ServerFormatter
+from hack_sound_server.utils.memory import format_size
+from hack_sound_server.utils.memory import get_rss
+from hack_sound_server.utils.negative_cache import NegativeCache
+from hack_sound_server.utils.profiler import create_profiler
+from hack_sound_server.utils.recorder import TrafficRecorder
+from hack_sound_server.utils.workers import TeardownWorker
+from hack_sound_server.utils.workers import WorkerPool
 
 gi.require_version('GLib', '2.0')  # noqa
 from gi.repository import Gio  # noqa
 from gi.repository import GLib  # noqa
 
 
-DBusWatcher = namedtuple("DBusWatcher", ["watcher_id", "uuids"])
-
-
 class UnregisteredUUID(Exception):
     pass
 
@@ -42,15 +61,49 @@ class TooManySoundsException(Exception):
     pass
 
 
+class FailingSoundFilesException(Exception):
+    pass
+
+
 class UnknownSoundEventIDException(Exception):
     INTERFACE = "com.hack_computer.HackSoundServer.UnknownSoundEventID"
 
 
+class UnknownMixGroupException(Exception):
+    INTERFACE = "com.hack_computer.HackSoundServer.UnknownMixGroup"
+
+
+class ProfilingException(Exception):
+    INTERFACE = "com.hack_computer.HackSoundServer.Debug.ProfilingError"
+
+
 class Server(Gio.Application):
     _TIMEOUT_S = 10
     _MAX_SIMULTANEOUS_SOUNDS = 5
+    _N_PIPELINE_WORKERS = 2
+    _MAX_REQUESTS_PER_ITERATION = 8
+    _PRELOAD_READ_CHUNK_SIZE = 1 << 16
+    _PRELOAD_TIMEOUT_S = 5
+    # Timeouts used while the system is critically low on memory, and how
+    # long after the last warning they are restored.
+    _LOW_MEMORY_TIMEOUT_S = 2
+    _LOW_MEMORY_POOL_EXPIRY_S = 5
+    _LOW_MEMORY_RESTORE_S = 60
+    # Minimum time between two dumps of the recent events caused by errors,
+    # so a burst of failing sounds does not flood the journal.
+    _ERROR_DUMP_INTERVAL_S = 30
     OVERLAP_BEHAVIOR_CHOICES = ("overlap", "restart", "ignore")
     _DBUS_NAME = "com.hack_computer.HackSoundServer"
+    _DEBUG_IFACE = "com.hack_computer.HackSoundServer.Debug"
+    # Path of the file to record the D-Bus traffic to, if set.
+    _RECORD_ENV_VAR = "HACK_SOUND_SERVER_RECORD"
+    # If set, the time the first buffer of each sound reaches the audio sink
+    # is measured.
+    _FIRST_BUFFER_PROBE_ENV_VAR = "HACK_SOUND_SERVER_FIRST_BUFFER_PROBE"
+    _METHODS = ("PlaySound", "PlayFull", "UpdateProperties", "StopSound",
+                "TerminateSound", "Preload", "Unload", "PlayGroup",
+                "SetGroupProperties", "Renew", "DumpRecentEvents",
+                "GetResourceUsage")
     _DBUS_XML = """
     <node>
       <interface name='com.hack_computer.HackSoundServer'>
@@ -63,36 +116,147 @@ class Server(Gio.Application):
           <arg type='a{sv}' name='options' direction='in'/>
           <arg type='s' name='uuid' direction='out'/>
         </method>
+        <method name='PlayGroup'>
+          <arg type='as' name='sound_events' direction='in'/>
+          <arg type='a{sv}' name='options' direction='in'/>
+          <arg type='as' name='uuids' direction='out'/>
+        </method>
         <method name='UpdateProperties'>
           <arg type='s' name='uuid' direction='in'/>
           <arg type='i' name='transition_time_ms' direction='in'/>
           <arg type='a{sv}' name='options' direction='in'/>
         </method>
+        <method name='SetGroupProperties'>
+          <arg type='s' name='group' direction='in'/>
+          <arg type='i' name='transition_time_ms' direction='in'/>
+          <arg type='a{sv}' name='options' direction='in'/>
+        </method>
+        <method name='Renew'>
+          <arg type='s' name='uuid' direction='in'/>
+        </method>
         <method name='StopSound'>
           <arg type='s' name='uuid' direction='in'/>
         </method>
         <method name='TerminateSound'>
           <arg type='s' name='uuid' direction='in'/>
         </method>
+        <method name='Preload'>
+          <arg type='as' name='sound_events' direction='in'/>
+        </method>
+        <method name='Unload'>
+          <arg type='as' name='sound_events' direction='in'/>
+        </method>
+        <method name='DumpRecentEvents'>
+          <arg type='u' name='max_events' direction='in'/>
+          <arg type='as' name='events' direction='out'/>
+        </method>
+        <method name='GetResourceUsage'>
+          <arg type='s' name='usage' direction='out'/>
+        </method>
+        <signal name='PreloadFinished'>
+          <arg type='as' name='sound_events'/>
+        </signal>
+      </interface>
+      <interface name='com.hack_computer.HackSoundServer.Debug'>
+        <method name='StartProfiling'>
+          <arg type='s' name='mode' direction='in'/>
+          <arg type='a{sv}' name='options' direction='in'/>
+        </method>
+        <method name='StopProfiling'>
+          <arg type='s' name='path' direction='out'/>
+        </method>
       </interface>
     </node>
     """
 
-    def __init__(self, metadata):
+    def __init__(self, metadata, sound_klass=Sound, scheduler=None,
+                 loudness_gains=None):
+        """
+        Args:
+            metadata (dict): The sound events metadata.
+
+        Optional Arguments:
+            sound_klass (type): The `BaseSound` subclass of the sounds.
+                                Defaults to the GStreamer backed `Sound`.
+            scheduler (Scheduler): The scheduler of the delayed calls.
+                                   Defaults to one on the monotonic clock.
+            loudness_gains (dict): The gain normalizing the loudness of each
+                                   sound file, by path, and of each sprite
+                                   segment, by (path, start, duration)
+                                   triplets. Files without a gain play as
+                                   they are.
+        """
         super().__init__(application_id=self._DBUS_NAME,
                          flags=Gio.ApplicationFlags.IS_SERVICE)
         self.logger = Logger(ServerFormatter, self)
+        self.sound_klass = sound_klass
         self._dbus_id = None
+        self._debug_dbus_id = None
+        self._name_owner_changed_id = None
+        self._profiler = None
+        self._profiler_holds = False
         self.metadata = metadata
+        self.loudness_gains = loudness_gains or {}
+        # The sound event ids playing segments of each sprite.
+        self._sprite_sound_event_ids = {}
+        for sound_event_id, entry in metadata.items():
+            if "sprite" in entry:
+                self._sprite_sound_event_ids.setdefault(
+                    entry["sprite"], []).append(sound_event_id)
         self._countdown_id = None
         self.registry = Registry()
+        # Builds the sound pipelines off the main context.
+        self.workers = WorkerPool(self._N_PIPELINE_WORKERS, "pipeline")
+        # Shuts the pipelines of the released sounds down off the main
+        # context.
+        self.teardown = TeardownWorker()
+        # Pipelines of released sounds, kept to be reused.
+        self.pipeline_pool = PipelinePool(self.teardown)
+        # Shared gain stages of the mix groups.
+        self.mixer = Mixer(entry["mix-group"] for entry in metadata.values()
+                           if "mix-group" in entry)
+        # Holds the sounds that start later.
+        # An empty scheduler is falsy.
+        if scheduler is None:
+            scheduler = Scheduler(GLib.get_monotonic_time, GLib.timeout_add,
+                                  GLib.Source.remove)
+        self.scheduler = scheduler
+        self.metrics = ResourceAccounting(self.scheduler.now)
+        self.first_buffer_probe = \
+            bool(os.environ.get(self._FIRST_BUFFER_PROBE_ENV_VAR))
+        # Scheduled expirations of the sound leases by uuid.
+        self._leases = {}
+        # Sound files that recently failed to play.
+        self.negative_cache = NegativeCache()
+        # Warms up preloaded sound events. A single thread, so preloading
+        # never competes with the pipelines of the sounds being played.
+        self.preload_workers = WorkerPool(1, "preload")
+        self._requests = RequestQueue()
+        self._dispatch_id = None
+        self.release_timeout_s = self._TIMEOUT_S
+        self._memory_monitor = None
+        self._low_memory_restore_id = None
+        self._setup_memory_monitor()
+        self._last_error_dump_time = None
+        self._recorder = None
+        record_path = os.environ.get(self._RECORD_ENV_VAR)
+        if record_path:
+            try:
+                self._recorder = TrafficRecorder(record_path)
+                self.logger.info("Recording the D-Bus traffic to %s.",
+                                 record_path)
+            except OSError as ex:
+                self.logger.error("Cannot record the D-Bus traffic to %s: "
+                                  "%s. Recording is disabled.", record_path,
+                                  ex)
 
     def get_sound(self, uuid=None, sound_event_id=None, bus_name=None):
         """
         Gets an existing sound given its UUID or event id and bus name.
 
         Optional Arguments:
-            uuid (str): The sound uuid or the sound to look up.
+            uuid (SoundHandle or str): The sound uuid or the sound to look
+                                       up. Strings are parsed as handles.
             sound_event_id (str): The sound event id of the sound to look up.
                                   If specified, bus_name argument should be
                                   also specified.
@@ -115,7 +279,10 @@ class Server(Gio.Application):
             raise AssertionError("bus_name argument should be specified")
 
         if uuid is not None:
-            sound = self.registry.sounds.get(uuid)
+            handle = uuid
+            if isinstance(uuid, str):
+                handle = SoundHandle.from_string(uuid)
+            sound = self.registry.sounds.get(handle)
             if sound is None:
                 raise UnregisteredUUID(
                     f"No sound with UUID {uuid} exists in the registry.")
@@ -208,13 +375,42 @@ class Server(Gio.Application):
     def do_dbus_register(self, connection, path):
         Gio.Application.do_dbus_register(self, connection, path)
         info = Gio.DBusNodeInfo.new_for_xml(self._DBUS_XML)
-        self._dbus_id = connection.register_object(path,
-                                                   info.interfaces[0],
-                                                   self.__method_called_cb)
+        self._dbus_id = connection.register_object(
+            path, info.lookup_interface(self._DBUS_NAME),
+            self.__method_called_cb)
+        self._debug_dbus_id = connection.register_object(
+            path, info.lookup_interface(self._DEBUG_IFACE),
+            self.__debug_method_called_cb)
+        # A single subscription for all the clients: the bus daemon only
+        # needs one match rule regardless of how many clients come and go.
+        self._name_owner_changed_id = connection.signal_subscribe(
+            "org.freedesktop.DBus", "org.freedesktop.DBus",
+            "NameOwnerChanged", "/org/freedesktop/DBus", None,
+            Gio.DBusSignalFlags.NONE, self.__name_owner_changed_cb)
         return True
 
+    def do_shutdown(self):
+        self.logger.info("Resource usage:\n%s",
+                         "\n".join(self.metrics.format_summary()))
+        self.workers.shutdown()
+        self.preload_workers.shutdown()
+        self.pipeline_pool.clear()
+        self.teardown.shutdown()
+        if self._recorder is not None:
+            self._recorder.close()
+        if self._profiler is not None:
+            # Keep what was profiled until the server quit.
+            self.stop_profiling()
+        Gio.Application.do_shutdown(self)
+
     def do_dbus_unregister(self, connection, path):
         Gio.Application.do_dbus_unregister(self, connection, path)
+        if self._name_owner_changed_id is not None:
+            connection.signal_unsubscribe(self._name_owner_changed_id)
+            self._name_owner_changed_id = None
+        if self._debug_dbus_id:
+            connection.unregister_object(self._debug_dbus_id)
+            self._debug_dbus_id = None
         if not self._dbus_id:
             return
         connection.unregister_object(self._dbus_id)
@@ -236,26 +432,113 @@ class Server(Gio.Application):
         self.cancel_countdown()
         self.hold()
         self.logger.info('All sounds done; starting timeout of {} '
-                         'seconds'.format(self._TIMEOUT_S))
+                         'seconds'.format(self.release_timeout_s))
         self._countdown_id = GLib.timeout_add_seconds(
-            self._TIMEOUT_S, release, priority=GLib.PRIORITY_LOW)
+            self.release_timeout_s, release, priority=GLib.PRIORITY_LOW)
+
+    def _setup_memory_monitor(self):
+        # Gio.MemoryMonitor is only available since GLib 2.64.
+        memory_monitor_klass = getattr(Gio, "MemoryMonitor", None)
+        if memory_monitor_klass is None:
+            self.logger.info("Memory monitor not available.")
+            return
+        self._memory_monitor = memory_monitor_klass.dup_default()
+        self._memory_monitor.connect("low-memory-warning",
+                                     self.__low_memory_warning_cb)
+
+    def __low_memory_warning_cb(self, unused_monitor, level):
+        self.free_memory(int(level))
+
+    def free_memory(self, level):
+        """
+        Frees memory in tiers, according to the given warning level.
+
+        1. Low: tears down the pipelines kept in the pipeline pool.
+        2. Medium: also suspends the paused background sounds buried under
+           the playing one, keeping their positions.
+        3. Critical: also shortens the time pooled pipelines are kept and
+           the auto-quit timeout, until no warning is received for a while.
+
+        Args:
+            level (int): A `Gio.MemoryMonitorWarningLevel` value.
+        """
+        # The pipelines are torn down by a worker thread, so each tier is
+        # measured once the pipelines it freed are gone, before running the
+        # next tier.
+        rss = [get_rss()]
+        tiers = []
+
+        def measure_tier(description):
+            rss_now = get_rss()
+            freed = None
+            if rss[-1] is not None and rss_now is not None:
+                freed = rss[-1] - rss_now
+            rss.append(rss_now)
+            tiers.append("{} ({} freed)".format(description,
+                                                format_size(freed)))
+
+        def pool_cleared_cb():
+            measure_tier("{} pooled pipelines".format(n_pipelines))
+            if level < Gio.MemoryMonitorWarningLevel.MEDIUM:
+                report()
+                return
+            buried_sounds = self.registry.background_sounds[:-1]
+            n_suspended = sum(1 for sound in buried_sounds
+                              if sound.suspend())
+            self.teardown.flush(
+                lambda: sounds_suspended_cb(n_suspended))
+
+        def sounds_suspended_cb(n_suspended):
+            measure_tier("{} buried bg sounds".format(n_suspended))
+            report()
+
+        def report():
+            if level >= Gio.MemoryMonitorWarningLevel.CRITICAL:
+                tiers.append("shorter timeouts")
+            self.logger.warning("Low memory warning (level %d). Freed: %s. "
+                                "Memory in use: %s before, %s after.",
+                                level, ", ".join(tiers),
+                                format_size(rss[0]), format_size(rss[-1]))
+
+        if level >= Gio.MemoryMonitorWarningLevel.CRITICAL:
+            self.pipeline_pool.idle_expiry_s = self._LOW_MEMORY_POOL_EXPIRY_S
+            self.release_timeout_s = self._LOW_MEMORY_TIMEOUT_S
+            if self._low_memory_restore_id is not None:
+                GLib.Source.remove(self._low_memory_restore_id)
+            self._low_memory_restore_id = GLib.timeout_add_seconds(
+                self._LOW_MEMORY_RESTORE_S, self.__restore_timeouts_cb,
+                priority=GLib.PRIORITY_LOW)
+
+        n_pipelines = self.pipeline_pool.clear()
+        self.teardown.flush(pool_cleared_cb)
+
+    def __restore_timeouts_cb(self):
+        self._low_memory_restore_id = None
+        self.pipeline_pool.idle_expiry_s = PipelinePool.IDLE_EXPIRY_S
+        self.release_timeout_s = self._TIMEOUT_S
+        self.logger.info("Timeouts restored after the low memory warnings.")
+        return GLib.SOURCE_REMOVE
 
     def new_sound(self, sound_klass, *args, **kwargs):
         self.cancel_countdown()
         self.hold()
         return sound_klass(*args, **kwargs)
 
-    def _play_sound(self, sound):
+    def _play_sound(self, sound, play=True):
         sound_to_pause = self.registry.add_sound(sound)
         self.watch_sound_bus_name(sound)
         self.ref(sound)
         if sound_to_pause is not None:
             sound_to_pause.pause_with_fade_out()
-        sound.play()
+        if sound.duck_bg is not None:
+            self.mixer.duck(sound.uuid, sound.duck_bg)
+        self.renew_lease(sound)
+        if play:
+            sound.play()
         return sound
 
     def play_sound(self, sound_event_id, connection, sender, path, iface,
-                   invocation, options=None):
+                   invocation, options=None, arrival_time=None):
         try:
             self.ensure_not_too_many_sounds(sound_event_id)
             sound = self.get_sound(sound_event_id=sound_event_id,
@@ -263,15 +546,119 @@ class Server(Gio.Application):
             if sound is not None:
                 self.try_overlap_behaviour(sound)
             else:
-                sound = self.new_sound(Sound, self, sender, sound_event_id,
-                                       metadata_extras=options)
+                location = self.pick_sound_file(sound_event_id)
+                sound = self.new_sound(self.sound_klass, self, sender,
+                                       sound_event_id,
+                                       metadata_extras=options,
+                                       location=location)
+                sound.usage.request_time = arrival_time
+                # The pipeline is built in a worker thread, so the reply
+                # below is sent as soon as the sound is in the registry.
+                start_time = self.get_start_time(sound, options)
+                if start_time is None:
+                    sound.prepare()
+                else:
+                    sound.schedule(start_time)
             self._play_sound(sound)
-            invocation.return_value(GLib.Variant("(s)", (sound.uuid, )))
+            invocation.return_value(GLib.Variant("(s)", (str(sound.uuid), )))
         except UnknownSoundEventIDException as ex:
             invocation.return_dbus_error(ex.INTERFACE, str(ex))
-        except TooManySoundsException:
+        except (TooManySoundsException, FailingSoundFilesException):
             invocation.return_value(GLib.Variant("(s)", ("", )))
 
+    def play_group(self, sound_event_ids, connection, sender, path, iface,
+                   invocation, options=None, arrival_time=None):
+        """
+        Plays several sounds starting at the very same time.
+
+        The new sounds are prerolled and then started together on a shared
+        clock and base time (see `SoundGroup`). Existing sounds of
+        non-overlapping sound events just follow their overlap behavior.
+        The delay of the sound events is ignored.
+
+        Returns (through the invocation):
+            The uuids of the sounds, in the order of `sound_event_ids`. Empty
+            strings stand for the sounds that could not be played.
+        """
+        for sound_event_id in sound_event_ids:
+            if sound_event_id not in self.metadata:
+                ex = UnknownSoundEventIDException(
+                    "sound event with id %s does not exist" % sound_event_id)
+                invocation.return_dbus_error(ex.INTERFACE, str(ex))
+                return
+
+        uuids = []
+        members = []
+        for sound_event_id in sound_event_ids:
+            try:
+                self.ensure_not_too_many_sounds(sound_event_id)
+                sound = self.get_sound(sound_event_id=sound_event_id,
+                                       bus_name=sender)
+                if sound is not None:
+                    self.try_overlap_behaviour(sound)
+                    self._play_sound(sound)
+                else:
+                    location = self.pick_sound_file(sound_event_id)
+                    sound = self.new_sound(self.sound_klass, self, sender,
+                                           sound_event_id,
+                                           metadata_extras=options,
+                                           location=location)
+                    sound.usage.request_time = arrival_time
+                    sound.prepare()
+                    self._play_sound(sound, play=False)
+                    members.append(sound)
+                uuids.append(str(sound.uuid))
+            except (TooManySoundsException, FailingSoundFilesException):
+                uuids.append("")
+        SoundGroup(self, members).start()
+        invocation.return_value(GLib.Variant("(as)", (uuids, )))
+
+    def get_start_time(self, sound, options=None):
+        """
+        Gets the time at which a new sound should start.
+
+        Args:
+            sound (Sound): The new sound.
+
+        Optional Arguments:
+            options (dict): The `PlayFull` options. The "start-at" option is
+                            a time in microseconds of the monotonic clock
+                            (`g_get_monotonic_time`), which overrides the
+                            delay of the sound event metadata.
+
+        Returns:
+            int: The start time in microseconds of the monotonic clock, or
+            None if the sound should start right away.
+        """
+        now = self.scheduler.now()
+        start_time = None
+        if options and "start-at" in options:
+            start_time = options["start-at"]
+        elif sound.delay:
+            start_time = now + sound.delay * 1000
+        if start_time is None or start_time <= now:
+            return None
+        return start_time
+
+    def pick_sound_file(self, sound_event_id):
+        """
+        Picks a random sound file of a sound event id among the healthy ones.
+
+        Returns:
+            str: The path of the sound file.
+
+        Raises:
+            FailingSoundFilesException: If all the sound files of the sound
+                                        event id failed recently.
+        """
+        sound_files = self.metadata[sound_event_id]["sound-files"]
+        healthy_sound_files = self.negative_cache.filter(sound_files)
+        if not healthy_sound_files:
+            self.logger.info("All the sound files failed recently, "
+                             "ignoring.", sound_event_id=sound_event_id)
+            raise FailingSoundFilesException
+        return random.choice(healthy_sound_files)
+
     def ensure_not_too_many_sounds(self, sound_event_id):
         # Use before creating a sound.
         if not self.registry.sound_events.has_sound_event_id(sound_event_id):
@@ -287,25 +674,45 @@ class Server(Gio.Application):
 
     def watch_sound_bus_name(self, sound):
         """
-        Watches a sound bus name for the given sound..
+        Watches a sound bus name for the given sound.
 
-        If a watcher already exists no bus name watcher will be created.
+        Bus names are not watched individually. Instead, the server keeps a
+        single `NameOwnerChanged` subscription and only tracks the bus names
+        it has to react to.
 
         Args:
             sound (Sound): A sound object
         """
         if sound.bus_name not in self.registry.watcher_by_bus_name:
-            watcher_id = Gio.bus_watch_name(Gio.BusType.SESSION,
-                                            sound.bus_name,
-                                            Gio.DBusProxyFlags.NONE,
-                                            None,
-                                            self._bus_name_disconnect_cb)
-
             # Tracks a sound UUID called by its respective DBus names.
-            uuids = set()
-            self.registry.watcher_by_bus_name[sound.bus_name] = \
-                DBusWatcher(watcher_id, uuids)
-        self.registry.watcher_by_bus_name[sound.bus_name].uuids.add(sound.uuid)
+            self.registry.watcher_by_bus_name[sound.bus_name] = set()
+        self.registry.watcher_by_bus_name[sound.bus_name].add(sound.uuid)
+
+    def __name_owner_changed_cb(self, connection, unused_sender_name,
+                                unused_object_path, unused_interface_name,
+                                unused_signal_name, parameters):
+        bus_name, unused_old_owner, new_owner = parameters.unpack()
+        if new_owner:
+            return
+        self.bus_name_vanished(connection, bus_name)
+
+    def bus_name_vanished(self, connection, bus_name):
+        """
+        Drops everything a client left behind when leaving the bus.
+        """
+        if self._recorder is not None:
+            self._recorder.record_disconnect(bus_name)
+        # Calls queued by a client that has already gone away are not served.
+        for request in self._requests.drop_sender(bus_name):
+            request.invocation.return_error_literal(
+                Gio.dbus_error_quark(), Gio.DBusError.DISCONNECTED,
+                "The caller has disconnected from the bus")
+        self._unload_sound_events(
+            self.registry.preloads.remove_bus_name(bus_name))
+        self.metrics.bus_name_vanished(bus_name)
+        if bus_name not in self.registry.watcher_by_bus_name:
+            return
+        self._bus_name_disconnect_cb(connection, bus_name)
 
     def _bus_name_disconnect_cb(self, unused_connection, bus_name):
         # When a dbus name dissappears (for example, when an application that
@@ -313,7 +720,10 @@ class Server(Gio.Application):
         # due to this application will be stopped.
         if bus_name not in self.registry.watcher_by_bus_name:
             return
-        for uuid_ in self.registry.watcher_by_bus_name[bus_name].uuids:
+        # Stop tracking the bus name. Unreferencing the sounds below may
+        # remove their uuids from the set, so iterate over a copy.
+        uuids = self.registry.watcher_by_bus_name.pop(bus_name)
+        for uuid_ in list(uuids):
             try:
                 sound = self.get_sound(uuid_)
             except UnregisteredUUID as ex:
@@ -322,10 +732,6 @@ class Server(Gio.Application):
                                      ex, uuid=uuid_)
                 continue
             self.unref(sound, clear_all=True)
-        # Remove the watcher.
-        watcher_id = self.registry.watcher_by_bus_name[bus_name].watcher_id
-        Gio.bus_unwatch_name(watcher_id)
-        del self.registry.watcher_by_bus_name[bus_name]
 
     def try_overlap_behaviour(self, sound):
         overlap_behavior = self.metadata[sound.sound_event_id].get(
@@ -399,25 +805,431 @@ class Server(Gio.Application):
     def unref_on_stop(self, sound, term_sound=False):
         self.unref(sound, clear_all=term_sound)
 
-    def update_properties(self, uuid_, transition_time_ms, options, connection,
-                          sender, path, iface, invocation):
+    def renew_lease(self, sound):
+        """
+        Extends the lease of a sound, if it has one, by its full duration.
+        """
+        max_duration_ms = sound.max_duration_ms
+        if max_duration_ms is None:
+            return
+        expiry_time = self.scheduler.now() + max_duration_ms * 1000
+        lease = self._leases.get(sound.uuid)
+        if lease is not None:
+            # Renewals can be as frequent as the updates of the sound, so
+            # move the lease instead of scheduling a new one each time.
+            self.scheduler.reschedule(lease, expiry_time)
+            return
+        self._leases[sound.uuid] = self.scheduler.add(
+            expiry_time, self.__lease_expired_cb, sound)
+
+    def __lease_expired_cb(self, sound):
+        self._leases.pop(sound.uuid, None)
+        if self.registry.refcount.get(sound.uuid, 0) == 0:
+            # Already released or being stopped.
+            return
+        self.logger.info("Lease of %d ms expired; stopping.",
+                         sound.max_duration_ms, bus_name=sound.bus_name,
+                         sound_event_id=sound.sound_event_id, uuid=sound.uuid)
+        self.unref(sound, clear_all=True)
 
+    def renew(self, uuid_, connection, sender, path, iface, invocation):
         try:
             sound = self.get_sound(uuid_)
-            sound.update_properties(transition_time_ms, options)
+        except UnregisteredUUID:
+            self.logger.info("Lease of sound {} was supposed to be renewed, "
+                             "but did not exist".format(uuid_))
+        else:
+            if sender != sound.bus_name:
+                self.logger.info("Lease of this sound cannot be renewed. It "
+                                 "was supposed to be refcounted by the bus "
+                                 "name %s but it wasn\'t. Skipping.", sender,
+                                 uuid=sound.uuid)
+            else:
+                self.renew_lease(sound)
+        invocation.return_value(None)
+
+    def get_recent_events(self, max_events, connection, sender, path, iface,
+                          invocation):
+        """
+        Returns the events kept by the flight recorder.
+
+        Args:
+            max_events (int): The number of most recent events to return, or
+                              0 to return all of them.
+
+        Returns (through the invocation):
+            The formatted events, oldest first.
+        """
+        events = flight_recorder.format_events(max_events)
+        invocation.return_value(GLib.Variant("(as)", (events, )))
+
+    def get_resource_usage(self, connection, sender, path, iface,
+                           invocation):
+        """
+        Returns the resources used by the process and the sounds.
+
+        Returns (through the invocation):
+            A JSON object, see `ResourceAccounting.get_usage`.
+        """
+        usage = json.dumps(self.metrics.get_usage())
+        invocation.return_value(GLib.Variant("(s)", (usage, )))
+
+    def dump_recent_events(self, reason):
+        """
+        Writes the events kept by the flight recorder to stderr.
+
+        Args:
+            reason (str): What caused the dump, written in its header.
+
+        Returns:
+            bool: `GLib.SOURCE_CONTINUE`, so this can be used as a signal
+            handler.
+        """
+        flight_recorder.dump(sys.stderr, reason)
+        return GLib.SOURCE_CONTINUE
+
+    def update_properties(self, uuid_, updates, connection, sender, path,
+                          iface, invocation):
+        """
+        Args:
+            updates (dict): See `get_property_updates`.
+        """
+        try:
+            sound = self.get_sound(uuid_)
+            # Only the owner of the sound can keep it alive.
+            if sender == sound.bus_name:
+                self.renew_lease(sound)
+            sound.update_properties(updates)
         except UnregisteredUUID:
             self.logger.info("Properties of sound {} was supposed to be "
                              "updated, but did not exist".format(uuid_))
         invocation.return_value(None)
 
+    def resolve_sound_event_ids(self, ids_or_prefixes):
+        """
+        Resolves sound event ids and prefixes to the matching sound event ids.
+
+        Args:
+            ids_or_prefixes (list): Sound event ids or prefixes such as
+                                    "fizzics/" or "fizzics/*". Entries which
+                                    are sound event ids are not considered
+                                    prefixes.
+
+        Returns:
+            list: The matching sound event ids, without duplicates.
+        """
+        sound_event_ids = []
+        for id_or_prefix in ids_or_prefixes:
+            if id_or_prefix in self.metadata:
+                matches = [id_or_prefix]
+            else:
+                prefix = id_or_prefix.rstrip("*")
+                matches = sorted(sound_event_id
+                                 for sound_event_id in self.metadata
+                                 if sound_event_id.startswith(prefix))
+            for sound_event_id in matches:
+                if sound_event_id not in sound_event_ids:
+                    sound_event_ids.append(sound_event_id)
+        if not sound_event_ids:
+            self.logger.info("No sound event ids match %s.", ids_or_prefixes)
+        return sound_event_ids
+
+    def preload(self, ids_or_prefixes, connection, sender, path, iface,
+                invocation):
+        """
+        Warms up the sound events a client is about to play.
+
+        Preloaded sound events are refcounted by bus name. Their sound files
+        are read to get them into the page cache and, when possible, a
+        prerolled pipeline is kept in the pipeline pool for each of them.
+        `PreloadFinished` is emitted to the sender once all the given sound
+        events are warmed up.
+        """
+        sound_event_ids = self.resolve_sound_event_ids(ids_or_prefixes)
+        invocation.return_value(None)
+
+        added = self.registry.preloads.add(sender, sound_event_ids)
+        if added and len(self.registry.preloads) == len(added):
+            # Keep the server alive while there are preloaded sound events.
+            self.hold()
+        for sound_event_id in added:
+            self.pipeline_pool.pin(self.get_pool_key(sound_event_id))
+
+        pending = set(sound_event_ids)
+
+        def preloaded_cb(sound_event_id, pipeline, error):
+            if error is not None:
+                self.logger.warning("Cannot preload: %s", error,
+                                    bus_name=sender,
+                                    sound_event_id=sound_event_id)
+            if pipeline is not None:
+                if self.registry.preloads.is_preloaded(sound_event_id):
+                    self.pipeline_pool.add(self.get_pool_key(sound_event_id),
+                                           pipeline)
+                else:
+                    self.teardown.push(pipeline)
+            pending.discard(sound_event_id)
+            if pending:
+                return
+            try:
+                connection.emit_signal(sender, path, iface, "PreloadFinished",
+                                       GLib.Variant("(as)",
+                                                    (sound_event_ids, )))
+            except GLib.Error as ex:
+                self.logger.info("Cannot emit PreloadFinished: %s",
+                                 ex.message, bus_name=sender)
+
+        if not pending:
+            preloaded_cb(None, None, None)
+            return
+        for sound_event_id in sound_event_ids:
+            def done_cb(pipeline, error, sound_event_id=sound_event_id):
+                preloaded_cb(sound_event_id, pipeline, error)
+
+            self.preload_workers.submit(
+                self._preload_sound_event, done_cb, sound_event_id,
+                self.pipeline_pool.has_room(
+                    self.get_pool_key(sound_event_id)))
+
+    def _preload_sound_event(self, sound_event_id, preroll):
+        # Runs in a preload worker thread.
+        metadata = self.metadata[sound_event_id]
+        locations = metadata["sound-files"]
+        for location in locations:
+            try:
+                with open(location, "rb") as file_:
+                    while file_.read(self._PRELOAD_READ_CHUNK_SIZE):
+                        pass
+            except OSError as ex:
+                self.logger.warning("Cannot read %s: %s", location, ex,
+                                    sound_event_id=sound_event_id)
+
+        if not preroll:
+            return None
+        return self.sound_klass.preroll_for_pool(
+            metadata, self.negative_cache.filter(locations),
+            self._PRELOAD_TIMEOUT_S)
+
+    def unload(self, ids_or_prefixes, connection, sender, path, iface,
+               invocation):
+        """
+        Drops the references of a client to preloaded sound events.
+        """
+        sound_event_ids = self.resolve_sound_event_ids(ids_or_prefixes)
+        self._unload_sound_events(
+            self.registry.preloads.remove(sender, sound_event_ids))
+        invocation.return_value(None)
+
+    def get_pool_key(self, sound_event_id):
+        """
+        Gets the key of the pipelines of a sound event id in the pool.
+
+        The sound events of a sprite play the same file, so they share their
+        pipelines.
+        """
+        return self.metadata[sound_event_id].get("sprite", sound_event_id)
+
+    def _unload_sound_events(self, sound_event_ids):
+        for sound_event_id in sound_event_ids:
+            pool_key = self.get_pool_key(sound_event_id)
+            if pool_key != sound_event_id and any(
+                    self.registry.preloads.is_preloaded(other_id)
+                    for other_id in self._sprite_sound_event_ids[pool_key]):
+                # Other sound events of the sprite are still preloaded.
+                continue
+            self.pipeline_pool.unpin(pool_key)
+        if sound_event_ids and len(self.registry.preloads) == 0:
+            if not self.registry.sounds:
+                self.ensure_release_countdown()
+            self.release()
+
+    def set_group_properties(self, group_name, transition_time_ms, options,
+                             connection, sender, path, iface, invocation):
+        """
+        Changes the properties of all the sounds of a mix group at once.
+
+        Only "volume" is supported. It multiplies the volume of the sounds of
+        the group, including the sounds played later. Only the "sfx" and "bg"
+        groups and the groups named by the metadata can be changed.
+        """
+        if group_name not in self.mixer.group_names:
+            ex = UnknownMixGroupException(
+                "mix group '{}' does not exist".format(group_name))
+            invocation.return_dbus_error(ex.INTERFACE, str(ex))
+            return
+        if "volume" in options:
+            group = self.mixer.get_group(group_name)
+            group.set_volume(options["volume"], transition_time_ms)
+        invocation.return_value(None)
+
     def __method_called_cb(self, connection, sender, path, iface,
                            method, params, invocation):
+        if method not in self._METHODS:
+            invocation.return_error_literal(
+                Gio.dbus_error_quark(), Gio.DBusError.UNKNOWN_METHOD,
+                "Method '%s' not available" % method)
+            return
+
+        arrival_time = GLib.get_monotonic_time()
+        if self._recorder is not None:
+            invocation = self._recorder.record_call(sender, method, params,
+                                                    arrival_time, invocation)
+        try:
+            params = parse_params(method, params.unpack())
+        except InvalidArgsException as ex:
+            invocation.return_dbus_error(ex.INTERFACE, str(ex))
+            return
+        request = Request(method, sender, params, connection, path, iface,
+                          invocation, arrival_time)
+        superseded = self._requests.push(request)
+        if superseded is not None:
+            # The properties of the superseded call are merged into the new
+            # one, which will reply to its own caller.
+            superseded.invocation.return_value(None)
+        if self._dispatch_id is None:
+            self._dispatch_id = GLib.idle_add(self.__dispatch_requests_cb,
+                                              priority=GLib.PRIORITY_DEFAULT)
+
+    def __debug_method_called_cb(self, connection, sender, path, iface,
+                                 method, params, invocation):
+        # Debug calls are served right away, out of the request queue, and
+        # are not recorded.
+        params = params.unpack()
+        try:
+            if method == "StartProfiling":
+                self.start_profiling(params[0], params[1])
+                invocation.return_value(None)
+            elif method == "StopProfiling":
+                path = self.stop_profiling()
+                invocation.return_value(GLib.Variant("(s)", (path, )))
+            else:
+                invocation.return_error_literal(
+                    Gio.dbus_error_quark(), Gio.DBusError.UNKNOWN_METHOD,
+                    "Method '%s' not available" % method)
+        except ProfilingException as ex:
+            invocation.return_dbus_error(ex.INTERFACE, str(ex))
+        except Exception as ex:
+            self.logger.exception("Cannot serve %s: %s", method, ex,
+                                  bus_name=sender)
+            invocation.return_error_literal(
+                Gio.dbus_error_quark(), Gio.DBusError.FAILED,
+                "{} failed: {}".format(method, ex))
+
+    def start_profiling(self, mode, options):
+        """
+        Starts profiling the server.
+
+        Args:
+            mode (str): "cprofile" or "sampling" (see `utils.profiler`).
+            options (dict): The options of the profiler. With the
+                            "keep-alive" option set, the server does not
+                            auto-quit until the profiling is stopped.
+
+        Raises:
+            ProfilingException: If the server is already being profiled, or
+                                the mode or an option is not valid.
+        """
+        if self._profiler is not None:
+            raise ProfilingException("The server is already being profiled")
+        try:
+            self._profiler = create_profiler(mode, options)
+        except ValueError as ex:
+            raise ProfilingException(str(ex))
+        if options.get("keep-alive", False):
+            self.hold()
+            self._profiler_holds = True
+        self._profiler.start()
+        self.logger.info("Started profiling in %s mode.", mode)
+
+    def stop_profiling(self):
+        """
+        Stops profiling the server and writes the profile.
+
+        Profiles are written in the user cache directory.
+
+        Returns:
+            str: The path of the profile.
+
+        Raises:
+            ProfilingException: If the server was not being profiled.
+        """
+        if self._profiler is None:
+            raise ProfilingException("The server is not being profiled")
+        profiler = self._profiler
+        self._profiler = None
+        if self._profiler_holds:
+            self._profiler_holds = False
+            self.release()
+        directory = os.path.join(GLib.get_user_cache_dir(),
+                                 "hack-sound-server")
+        path = os.path.join(directory, "profile-{}-{}.{}".format(
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid(), profiler.extension))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            profiler.stop(path)
+        except OSError as ex:
+            raise ProfilingException(
+                "Cannot write the profile to {}: {}".format(path, ex))
+        self.logger.info("Stopped profiling, profile written to %s.", path)
+        return path
+
+    def __dispatch_requests_cb(self):
+        # Serve only a few requests per main loop iteration, so the requests
+        # arriving in the meantime get queued and scheduled fairly.
+        pending = False
+        try:
+            for _ in range(self._MAX_REQUESTS_PER_ITERATION):
+                request = self._requests.pop()
+                if request is None:
+                    break
+                self._handle_request(request)
+            pending = len(self._requests) > 0
+        finally:
+            # The source is removed if this raises, so a new one has to be
+            # added by the next call.
+            if not pending:
+                self._dispatch_id = None
+        if pending:
+            return GLib.SOURCE_CONTINUE
+        return GLib.SOURCE_REMOVE
+
+    def _handle_request(self, request):
+        try:
+            self._serve_request(request)
+        except Exception as ex:
+            # A failing call must not keep the other calls from being served.
+            self.logger.exception("Cannot serve %s: %s", request.method, ex,
+                                  bus_name=request.sender)
+            request.invocation.return_error_literal(
+                Gio.dbus_error_quark(), Gio.DBusError.FAILED,
+                "{} failed: {}".format(request.method, ex))
+
+    def _serve_request(self, request):
+        method = request.method
+        params = request.params
+        connection = request.connection
+        sender = request.sender
+        path = request.path
+        iface = request.iface
+        invocation = request.invocation
+
         if method == "PlaySound":
             self.play_sound(params[0], connection, sender, path, iface,
-                            invocation)
-        if method == "PlayFull":
+                            invocation, arrival_time=request.arrival_time)
+        elif method == "PlayFull":
             self.play_sound(params[0], connection, sender, path,
-                            iface, invocation, params[1])
+                            iface, invocation, params[1],
+                            arrival_time=request.arrival_time)
+        elif method == "Renew":
+            self.renew(params[0], connection, sender, path, iface, invocation)
+        elif method == "SetGroupProperties":
+            self.set_group_properties(params[0], params[1], params[2],
+                                      connection, sender, path, iface,
+                                      invocation)
+        elif method == "PlayGroup":
+            self.play_group(params[0], connection, sender, path, iface,
+                            invocation, params[1],
+                            arrival_time=request.arrival_time)
         elif method == 'StopSound':
             self.terminate_sound_for_sender(params[0], connection, sender,
                                             invocation)
@@ -425,12 +1237,20 @@ class Server(Gio.Application):
             self.terminate_sound_for_sender(params[0], connection, sender,
                                             invocation, term_sound=True)
         elif method == "UpdateProperties":
-            self.update_properties(params[0], params[1], params[2], connection,
-                                   sender, path, iface, invocation)
-        else:
-            invocation.return_error_literal(
-                Gio.dbus_error_quark(), Gio.DBusError.UNKNOWN_METHOD,
-                "Method '%s' not available" % method)
+            self.update_properties(params[0], params[1], connection, sender,
+                                   path, iface, invocation)
+        elif method == "Preload":
+            self.preload(params[0], connection, sender, path, iface,
+                         invocation)
+        elif method == "Unload":
+            self.unload(params[0], connection, sender, path, iface,
+                        invocation)
+        elif method == "DumpRecentEvents":
+            self.get_recent_events(params[0], connection, sender, path,
+                                   iface, invocation)
+        elif method == "GetResourceUsage":
+            self.get_resource_usage(connection, sender, path, iface,
+                                    invocation)
 
     def sound_released_cb(self, sound):
         # This method is only called when a sound naturally reaches
@@ -452,12 +1272,23 @@ class Server(Gio.Application):
                           "%s: %s", error.message, debug,
                           sound_event_id=sound.sound_event_id,
                           uuid=sound.uuid)
+        now = GLib.get_monotonic_time()
+        if self._last_error_dump_time is None or \
+                now - self._last_error_dump_time >= \
+                self._ERROR_DUMP_INTERVAL_S * GLib.USEC_PER_SEC:
+            self._last_error_dump_time = now
+            self.dump_recent_events("GStreamer error")
 
         if sound.uuid not in self.registry.sounds:
             return
         self.__free_registry_with_countdown(sound)
 
     def __free_registry(self, sound):
+        self.metrics.untrack(sound)
+        self.mixer.unduck(sound.uuid)
+        lease = self._leases.pop(sound.uuid, None)
+        if lease is not None:
+            self.scheduler.cancel(lease)
         sound_to_resume = self.registry.remove_sound(sound)
         if sound_to_resume is not None:
             sound_to_resume.play()
@@ -0,0 +1,350 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Headless simulation of the server.
+
+The server runs with `SimulatedSound` objects instead of GStreamer backed
+sounds. They model durations, end-of-stream, fades and errors on the virtual
+clock of a `VirtualScheduler`, which only moves forward when told. This is
+enough to exercise the refcounting, the background sounds stack, the bus
+name cleanup and the rest of the bookkeeping of the server and the registry
+at scale, in a fraction of the real time:
+
+    simulation = Simulation(metadata)
+    uuid = simulation.call(":1.1", "PlaySound", "clubhouse/entry").value[0]
+    simulation.advance(500)
+    simulation.call(":1.1", "StopSound", uuid)
+    simulation.disconnect(":1.1")
+"""
+import gi
+
+from hack_sound_server.dispatcher import InvalidArgsException
+from hack_sound_server.dispatcher import parse_params
+from hack_sound_server.dispatcher import Request
+from hack_sound_server.scheduler import Scheduler
+from hack_sound_server.server import Server
+from hack_sound_server.sound import BaseSound
+from hack_sound_server.sound import when_ready
+
+gi.require_version('GLib', '2.0')  # noqa
+gi.require_version('Gst', '1.0')   # noqa
+from gi.repository import Gio  # noqa
+from gi.repository import GLib  # noqa
+from gi.repository import Gst  # noqa
+
+
+def _iterate_main_context():
+    # Runs the idle callbacks the server and the sounds added, such as the
+    # release of the sounds.
+    context = GLib.MainContext.default()
+    while context.pending():
+        context.iteration(False)
+
+
+class VirtualScheduler(Scheduler):
+    """
+    A scheduler on a virtual clock, in microseconds.
+    """
+
+    def __init__(self, start_time=0):
+        self._virtual_time = start_time
+        # The (time, callback) of the armed timeout.
+        self._timeout = None
+        super().__init__(lambda: self._virtual_time, self.__timeout_add,
+                         self.__source_remove)
+
+    def __timeout_add(self, delay_ms, callback):
+        # Timeouts are only run by `advance`.
+        self._timeout = (self._virtual_time + delay_ms * 1000, callback)
+        return callback
+
+    def __source_remove(self, unused_source_id):
+        self._timeout = None
+
+    def advance(self, duration_us):
+        """
+        Moves the clock forward, running the calls due in the meantime.
+        """
+        end_time = self._virtual_time + duration_us
+        while self._timeout is not None and self._timeout[0] <= end_time:
+            time, callback = self._timeout
+            self._timeout = None
+            self._virtual_time = max(self._virtual_time, time)
+            callback()
+            _iterate_main_context()
+        self._virtual_time = end_time
+
+
+class SimulatedSound(BaseSound):
+    """
+    A sound without pipeline, played on the virtual clock of the simulation.
+
+    Its duration and whether it fails are given by the `Simulation` of the
+    server.
+    """
+
+    def __init__(self, server, bus_name, sound_event_id, metadata_extras=None,
+                 location=None):
+        super().__init__(server, bus_name, sound_event_id, metadata_extras,
+                         location)
+        self._simulation = server.simulation
+        self._scheduler = server.scheduler
+        self._duration_us = self._simulation.get_duration_us(self.location)
+        if self.segment is not None:
+            self._duration_us = (self.segment[1] - self.segment[0]) // 1000
+        # The position reached when the sound was last paused and the time
+        # it was played since, if it is playing.
+        self._position_us = 0
+        self._playing_since = None
+        # The end-of-stream or the end of a fade.
+        self._timer = None
+        self.n_updates = 0
+
+    @property
+    def playing(self):
+        return self._playing_since is not None
+
+    def get_position_us(self):
+        position_us = self._position_us
+        if self._playing_since is not None:
+            position_us += self._scheduler.now() - self._playing_since
+        if self.loop and self._duration_us > 0:
+            position_us %= self._duration_us
+        return min(position_us, self._duration_us)
+
+    def prepare(self, position=None):
+        self._position_us = (position or 0) // 1000
+        self._scheduler.add(
+            self._scheduler.now() + self._simulation.preroll_us,
+            self.__prerolled_cb)
+
+    def __prerolled_cb(self):
+        if self._released:
+            return
+        if self._simulation.is_failing(self.location):
+            error = GLib.Error.new_literal(Gio.io_error_quark(),
+                                           "Simulated error",
+                                           Gio.IOErrorEnum.FAILED)
+            self.server.negative_cache.add(self.location, error.domain)
+            self._error = True
+            self._pending_calls = []
+            self.emit("error", error, self.location)
+            return
+        self.server.negative_cache.remove(self.location)
+        self.usage.set_state(self.usage.PAUSED)
+        self.emit("prerolled")
+        self._prepared()
+
+    def _free_resources(self):
+        self._set_timer(None)
+        self._pause()
+
+    def suspend(self):
+        if not self._ready or self._releasing or self._stop_loop:
+            return False
+        if self.playing or self._timer is not None:
+            return False
+        self._ready = False
+        self._suspended_position = self.get_position_us() * 1000
+        return True
+
+    def sync_to_clock(self, clock, base_time):
+        pass
+
+    def _set_timer(self, delay_us, callback=None):
+        if self._timer is not None:
+            self._scheduler.cancel(self._timer)
+            self._timer = None
+        if delay_us is not None:
+            self._timer = self._scheduler.add(
+                self._scheduler.now() + delay_us, callback)
+
+    def _pause(self):
+        self._position_us = self.get_position_us()
+        self._playing_since = None
+        self.usage.set_state(self.usage.PAUSED)
+
+    def _start(self):
+        self._playing_since = self._scheduler.now()
+        self.usage.set_state(self.usage.PLAYING)
+        if self.loop:
+            self._set_timer(None)
+        else:
+            self._set_timer(self._duration_us - self._position_us,
+                            self.__eos_cb)
+
+    def __eos_cb(self):
+        self._timer = None
+        self.release()
+
+    def __fade_out_done_cb(self):
+        self._timer = None
+        self._pause()
+        if self._stop_loop:
+            self.release()
+
+    @when_ready
+    def play(self):
+        if self._releasing:
+            return
+        self._stop_loop = False
+        if not self.playing:
+            self._start()
+
+    @when_ready
+    def pause_with_fade_out(self):
+        if self._releasing or self._stop_loop or not self.playing:
+            return
+        if self.loop and self.fade_out > 0:
+            self._set_timer(self.fade_out * 1000, self.__fade_out_done_cb)
+        else:
+            self._pause()
+
+    @when_ready
+    def _stop(self):
+        if not self.loop or self.fade_out == 0 or not self.playing:
+            self._stop_loop = True
+            self.release()
+            return
+        self._stop_loop = True
+        self._set_timer(self.fade_out * 1000, self.__fade_out_done_cb)
+
+    @when_ready
+    def reset(self):
+        playing = self.playing
+        self._pause()
+        self._position_us = 0
+        if playing:
+            self._start()
+
+    @when_ready
+    def update_properties(self, updates):
+        self.n_updates += 1
+
+
+class SimulatedInvocation:
+    """
+    Stands for a `Gio.DBusMethodInvocation`, keeping the reply.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+
+    def return_value(self, value):
+        self.value = value.unpack() if value is not None else None
+
+    def return_dbus_error(self, error_name, unused_error_message):
+        self.error = error_name
+
+    def return_error_literal(self, domain, code, unused_message):
+        self.error = "{}:{}".format(GLib.quark_to_string(domain), code)
+
+
+class SimulatedConnection:
+    """
+    Stands for a `Gio.DBusConnection`, keeping the emitted signals.
+    """
+
+    def __init__(self):
+        self.signals = []
+
+    def emit_signal(self, destination, unused_path, unused_iface, name,
+                    parameters):
+        self.signals.append((destination, name, parameters.unpack()))
+
+
+class Simulation:
+    """
+    Runs a server with simulated sounds on a virtual clock.
+
+    Calls are handled right away, as if each one was served alone by the
+    request queue.
+    """
+    _PATH = "/com/hack_computer/HackSoundServer"
+
+    def __init__(self, metadata, durations_ms=None, failing_locations=(),
+                 default_duration_ms=1000, preroll_ms=5):
+        """
+        Args:
+            metadata (dict): The sound events metadata.
+
+        Optional Arguments:
+            durations_ms (dict): The duration of the sound files by path.
+            failing_locations (iterable): The sound files that fail to play.
+            default_duration_ms (int): The duration of the other files.
+            preroll_ms (int): The time sounds take to be prepared.
+        """
+        # The mix groups use GStreamer control sources, which need GStreamer
+        # to be initialized. No pipeline is ever created.
+        Gst.init(None)
+        self._durations_ms = durations_ms or {}
+        self.failing_locations = set(failing_locations)
+        self._default_duration_ms = default_duration_ms
+        self.preroll_us = preroll_ms * 1000
+        self.scheduler = VirtualScheduler()
+        self.server = Server(metadata, sound_klass=SimulatedSound,
+                             scheduler=self.scheduler)
+        self.server.simulation = self
+        self.connection = SimulatedConnection()
+
+    def get_duration_us(self, location):
+        return self._durations_ms.get(location,
+                                      self._default_duration_ms) * 1000
+
+    def is_failing(self, location):
+        return location in self.failing_locations
+
+    def now(self):
+        return self.scheduler.now()
+
+    def advance(self, duration_ms):
+        """
+        Moves the virtual clock forward.
+        """
+        self.scheduler.advance(int(duration_ms * 1000))
+
+    def call(self, sender, method, *params):
+        """
+        Calls a method of the server.
+
+        Returns:
+            SimulatedInvocation: The invocation, with the reply.
+        """
+        invocation = SimulatedInvocation()
+        try:
+            params = parse_params(method, params)
+        except InvalidArgsException as ex:
+            invocation.return_dbus_error(ex.INTERFACE, str(ex))
+            return invocation
+        request = Request(method, sender, params, self.connection,
+                          self._PATH, Server._DBUS_NAME, invocation,
+                          self.now())
+        self.server._handle_request(request)
+        _iterate_main_context()
+        return invocation
+
+    def disconnect(self, sender):
+        """
+        Makes a client leave the bus.
+        """
+        self.server.bus_name_vanished(self.connection, sender)
+        _iterate_main_context()
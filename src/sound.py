@@ -19,10 +19,15 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import functools
 import gi
+import os
 import random
-import uuid
+import re
+from hack_sound_server import metrics
 
+from hack_sound_server.utils import curves
+from hack_sound_server.utils.handle import SoundHandle
 from hack_sound_server.utils.loggable import Logger
 from hack_sound_server.utils.loggable import SoundFormatter
 
@@ -35,19 +40,47 @@ from gi.repository import Gst  # noqa
 from gi.repository import GstController  # noqa
 
 
-class Sound(GObject.Object):
+def when_ready(method):
+    """
+    Defers calls to `method` until the sound has been prepared.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self._ready:
+            self._pending_calls.append((method, args, kwargs))
+            if self._suspended_position is not None:
+                self._resume()
+            return None
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class BaseSound(GObject.Object):
+    """
+    The interface of the sounds managed by the server.
+
+    It holds the logic that does not depend on how sounds are played: their
+    properties, the queueing of calls until they are prepared, scheduling and
+    releasing. `Sound` plays them with GStreamer, and the simulation backend
+    (see `hack_sound_server.simulation`) on a virtual clock.
+    """
     _DEFAULT_VOLUME = 1.0
     _DEFAULT_PITCH = 1.0
     _DEFAULT_RATE = 1.0
+    RATE_MODE_CHOICES = ("pitch", "seek")
     _DEFAULT_FADE_IN_MS = 1000
     _DEFAULT_FADE_OUT_MS = 1000
+    # How long before its start time a scheduled sound is prepared.
+    _PREPARE_LEAD_US = 200 * 1000
 
     __gsignals__ = {
         'released': (GObject.SignalFlags.RUN_FIRST, None, ()),
+        'prerolled': (GObject.SignalFlags.RUN_FIRST, None, ()),
         'error': (GObject.SignalFlags.RUN_FIRST, None, (GLib.Error, str))
     }
 
-    def __init__(self, server, bus_name, sound_event_id, metadata_extras=None):
+    def __init__(self, server, bus_name, sound_event_id, metadata_extras=None,
+                 location=None):
         super().__init__()
         self.server = server
         self.logger = Logger(SoundFormatter, self)
@@ -55,27 +88,110 @@ class Sound(GObject.Object):
         # used internally by the logger to format the log messages.
         self.bus_name = bus_name
         self.sound_event_id = sound_event_id
-        self.uuid = str(uuid.uuid4())
+        self.uuid = SoundHandle.new()
 
         assert sound_event_id in server.metadata
         self.metadata = server.metadata[sound_event_id]
         self.metadata_extras = metadata_extras or {}
+        # The file to play, one of the "sound-files" of the sound event id.
+        if location is None:
+            location = random.choice(self.metadata["sound-files"])
+        self.location = location
 
         self._stop_loop = False
-        self._n_loop = 0
-        self._is_initial_seek = False
-        self._pending_state_change = None
         self._releasing = False
+        self._released = False
         self._error = False
-
-        self.pipeline = self._build_pipeline()
-        bus = self.pipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message", self.__bus_message_cb)
+        # The monotonic time in microseconds at which a scheduled sound
+        # starts, and the scheduled call that will prepare or start it.
+        self._start_time = None
+        self._scheduled_call = None
+        # Until the sound is prepared (see `prepare`), calls to the methods
+        # decorated with `when_ready` are queued here.
+        self._ready = False
+        self._pending_calls = []
+        # The position of the sound while it is suspended to save memory
+        # (see `suspend`).
+        self._suspended_position = None
+        # The resources used by the sound, accounted by the server.
+        self.usage = server.metrics.track(self)
 
         self.connect("released", self.server.sound_released_cb)
         self.connect("error", self.server.sound_error_cb)
 
+    @classmethod
+    def preroll_for_pool(cls, metadata, locations, timeout_s):
+        """
+        Prepares a pipeline for the pipeline pool, to preload a sound event.
+
+        Called from a worker thread.
+
+        Returns:
+            The pipeline in the READY state, or None if the backend does not
+            pool pipelines or the sound event cannot use pooled pipelines.
+        """
+        return None
+
+    def prepare(self, position=None):
+        """
+        Prepares the sound to play without blocking the main context.
+
+        Backends call `_prepared` once done, or emit "error".
+
+        Optional Arguments:
+            position (int): The position in nanoseconds to prepare the sound
+                            at. Defaults to the start of the sound.
+        """
+        raise NotImplementedError
+
+    def schedule(self, start_time):
+        """
+        Starts the sound at the given time.
+
+        The sound is only prepared shortly before `start_time`. Until then,
+        it is just an entry in the server scheduler. Calls to `play`
+        and the like are queued until the start time.
+
+        Args:
+            start_time (int): The time in microseconds of the monotonic clock.
+        """
+        self._start_time = start_time
+        # The sound is expected to play at the start time, not earlier.
+        self.usage.request_time = start_time
+        self._scheduled_call = self.server.scheduler.add(
+            start_time - self._PREPARE_LEAD_US, self._scheduled_prepare_cb)
+
+    def _scheduled_prepare_cb(self):
+        self._scheduled_call = None
+        self.prepare()
+
+    def _start_cb(self):
+        self._scheduled_call = None
+        self._start_time = None
+        self._set_ready()
+
+    def _prepared(self):
+        """
+        Called by the backends once the sound is prepared to play.
+        """
+        if self._releasing:
+            self._pending_calls = []
+            self._release()
+            return
+        if self._start_time is not None:
+            # Wait for the start time to play.
+            self._scheduled_call = self.server.scheduler.add(
+                self._start_time, self._start_cb)
+            return
+        self._set_ready()
+
+    def _set_ready(self):
+        self._ready = True
+        pending_calls = self._pending_calls
+        self._pending_calls = []
+        for method, args, kwargs in pending_calls:
+            method(self, *args, **kwargs)
+
     def release(self):
         if self._error:
             return
@@ -83,22 +199,429 @@ class Sound(GObject.Object):
         # g_idle_add should be used.
         self.logger.debug("Releasing.")
         self._releasing = True
+        if self._scheduled_call is not None:
+            # Released before its start time.
+            self.server.scheduler.cancel(self._scheduled_call)
+            self._scheduled_call = None
+            self._pending_calls = []
+            GLib.idle_add(self._release)
+            return
+        if self._suspended_position is not None:
+            # There is nothing to wait for.
+            GLib.idle_add(self._release)
+            return
+        if not self._ready:
+            # The release is finished once the sound is prepared.
+            return
         GLib.idle_add(self._release)
 
     def _release(self):
+        if self._released or self._error:
+            return GLib.SOURCE_REMOVE
+        self._released = True
+        self._suspended_position = None
+        self._free_resources()
+        self.emit("released")
+        return GLib.SOURCE_REMOVE
+
+    def _free_resources(self):
+        """
+        Frees the resources used to play the sound once it is released.
+        """
+        raise NotImplementedError
+
+    @property
+    def suspended(self):
+        return self._suspended_position is not None
+
+    def suspend(self):
+        """
+        Frees the resources of a paused sound, keeping its position.
+
+        The sound is prepared again, at the same position, by the next call
+        that needs it, such as `play`.
+
+        Returns:
+            bool: True if the sound was suspended.
+        """
+        raise NotImplementedError
+
+    def _resume(self):
+        self.logger.info("Resuming suspended sound.")
+        position = self._suspended_position
+        self._suspended_position = None
+        self.prepare(position)
+
+    def sync_to_clock(self, clock, base_time):
+        """
+        Makes the sound follow the given clock and base time when played.
+        """
+        raise NotImplementedError
+
+    def play(self):
+        raise NotImplementedError
+
+    def pause_with_fade_out(self):
+        raise NotImplementedError
+
+    def stop(self):
+        if (self._start_time is not None or
+                self._suspended_position is not None):
+            # Sounds which have not started yet or are suspended are silent,
+            # so there is nothing to fade out.
+            self._stop_loop = True
+            self.release()
+            return
+        self._stop()
+
+    def _stop(self):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    def update_properties(self, updates):
+        raise NotImplementedError
+
+    @property
+    def loop(self):
+        return "loop" in self.metadata and self.metadata["loop"]
+
+    @property
+    def volume(self):
+        volume = self._get_multipliable_prop("volume")
+        if volume is None:
+            volume = self._DEFAULT_VOLUME
+        return volume
+
+    @property
+    def loudness_gain(self):
+        """
+        The gain normalizing the loudness of the sound file, measured offline.
+
+        Sprites have a gain for each segment.
+        """
+        key = self.location
+        if "sprite" in self.metadata and "segment" in self.metadata:
+            segment = self.metadata["segment"]
+            key = (self.location, segment["start"], segment["duration"])
+        return self.server.loudness_gains.get(key, self._DEFAULT_VOLUME)
+
+    @property
+    def pitch(self):
+        """
+        Changes pitch while keeping the tempo.
+        """
+        return self._get_multipliable_prop("pitch")
+
+    @property
+    def rate(self):
+        """
+        Changes tempo and pitch.
+        """
+        if "rate" in self.metadata:
+            return self.metadata["rate"]
+        return None
+
+    @property
+    def segment(self):
+        """
+        The part of its sprite file the sound plays, if it is a sprite.
+
+        Returns:
+            tuple: The start and stop positions in nanoseconds, or None.
+        """
+        segment = self.metadata.get("segment")
+        if "sprite" not in self.metadata or segment is None:
+            return None
+        start = segment["start"] * Gst.MSECOND
+        return (start, start + segment["duration"] * Gst.MSECOND)
+
+    @property
+    def rate_mode(self):
+        """
+        How the rate is applied.
+
+        In the "pitch" mode, the rate is applied by a pitch element, which
+        allows smooth transitions. In the "seek" mode, it is applied with rate
+        seeks, which is cheaper, but rate changes are instantaneous.
+        """
+        mode = self.metadata_extras.get("rate-mode",
+                                        self.metadata.get("rate-mode"))
+        if mode not in self.RATE_MODE_CHOICES:
+            return "pitch"
+        return mode
+
+    @property
+    def fade_in(self):
+        return self.metadata.get("fade-in",
+                                 self._DEFAULT_FADE_IN_MS if self.loop else 0)
+
+    @property
+    def fade_out(self):
+        pipeline_fade_out = 0
+        if self.loop:
+            pipeline_fade_out = self._DEFAULT_FADE_OUT_MS
+        metadata_fade_out = self.metadata.get("fade-out")
+        if metadata_fade_out is not None:
+            pipeline_fade_out = metadata_fade_out
+        return pipeline_fade_out
+
+    @property
+    def fade_curve(self):
+        """
+        The shape of the fade in and fade out effects.
+
+        Background sounds crossfade with equal-power curves by default.
+        """
+        default = curves.EQUAL_POWER if self.type_ == "bg" else curves.LINEAR
+        shape = self.metadata.get("fade-curve", default)
+        if shape not in curves.SHAPES:
+            return default
+        return shape
+
+    @property
+    def delay(self):
+        """
+        The time in milliseconds to wait before the sound starts.
+        """
+        if "delay" in self.metadata:
+            return self.metadata["delay"]
+        return None
+
+    @property
+    def sound_location(self):
+        return self.location
+
+    @property
+    def max_duration_ms(self):
+        """
+        The duration of the lease of the sound, or None if it has no lease.
+
+        A sound whose lease is not renewed in time is stopped.
+        """
+        return self.metadata_extras.get("max-duration-ms",
+                                        self.metadata.get("max-duration-ms"))
+
+    @property
+    def mix_group(self):
+        """
+        The name of the mix group of the sound. Defaults to its type.
+        """
+        return self.metadata.get("mix-group", self.type_)
+
+    @property
+    def duck_bg(self):
+        """
+        The gain applied to the background sounds while this sound plays.
+        """
+        return self.metadata.get("duck-bg")
+
+    @property
+    def type_(self):
+        type_ = self.metadata.get("type", "sfx")
+        if type_ not in ("sfx", "bg"):
+            return "sfx"
+        return type_
+
+    def _get_multipliable_prop(self, prop_name):
+        value = self.metadata.get(prop_name, None)
+        if prop_name in self.metadata_extras:
+            if value is None:
+                value = self.metadata_extras[prop_name]
+            else:
+                value *= self.metadata_extras[prop_name]
+        return value
+
+
+class Sound(BaseSound):
+    """
+    A sound played by a GStreamer pipeline.
+    """
+    _RESUME_PREROLL_TIMEOUT_S = 5
+
+    def __init__(self, server, bus_name, sound_event_id, metadata_extras=None,
+                 location=None):
+        super().__init__(server, bus_name, sound_event_id, metadata_extras,
+                         location)
+        # Looked up here, since pipelines are set up in worker threads.
+        self._mix_group = server.mixer.get_group(self.mix_group)
+
+        self._n_loop = 0
+        self._is_initial_seek = False
+        self._prerolled = False
+        self._pending_state_change = None
+
+        # The pipeline is built in a worker thread (see `prepare`).
+        self.pipeline = None
+        # Elements and control sources are looked up once, when the pipeline
+        # is built.
+        self._volume_elem = None
+        self._fade_control = None
+        self._pitch_elem = None
+        self._rate_control = None
+        # (element, handler id) pairs to disconnect when the pipeline is
+        # recycled.
+        self._handler_ids = []
+        # The pitch element is only added to the pipeline when needed. If a
+        # rate update arrives in the meantime, it waits here for the element.
+        self._splicing_pitch = False
+        self._rate_update_after_splice = None
+        # The rate applied through seeks in the "seek" rate mode.
+        self._playback_rate = self._DEFAULT_RATE
+        if self.rate_mode == "seek" and self.rate is not None:
+            self._playback_rate = self.rate
+        # Property updates waiting to be applied by `_apply_pending_updates`.
+        self._pending_updates = {}
+        self._updates_id = None
+
+    def prepare(self, position=None):
+        """
+        Builds and prerolls the pipeline without blocking the main context.
+
+        If the pipeline of a released sound of the same sound event id, or
+        of the same sprite, is available, it is reused instead of building a
+        new one.
+
+        Optional Arguments:
+            position (int): The position in nanoseconds to preroll the
+                            pipeline at. Defaults to the start of the sound.
+        """
+        recycled_pipeline = None
+        if not self._needs_pitch_element():
+            recycled_pipeline = self.server.pipeline_pool.take(
+                self.server.get_pool_key(self.sound_event_id))
+        self.server.workers.submit(self._build_and_preroll_pipeline,
+                                   self.__pipeline_built_cb,
+                                   recycled_pipeline, position)
+
+    def _build_and_preroll_pipeline(self, recycled_pipeline=None,
+                                    position=None):
+        # Runs in a worker thread.
+        if recycled_pipeline is not None:
+            pipeline = self._reuse_pipeline(recycled_pipeline)
+        else:
+            pipeline = self._build_pipeline()
+        pipeline.set_state(Gst.State.PAUSED)
+        segment = self.segment
+        if position is not None or segment is not None:
+            # Seeking requires the pipeline to be prerolled.
+            pipeline.get_state(self._RESUME_PREROLL_TIMEOUT_S * Gst.SECOND)
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+            if self.loop:
+                flags |= Gst.SeekFlags.SEGMENT
+            start_type, start, stop_type, stop = \
+                self._get_seek_range(position or 0)
+            pipeline.seek(self._playback_rate, Gst.Format.TIME, flags,
+                          start_type, start, stop_type, stop)
+        return pipeline
+
+    def __pipeline_built_cb(self, pipeline, error):
+        if error is not None:
+            if not isinstance(error, GLib.Error):
+                error = GLib.Error(str(error))
+            self.logger.warning("Cannot build the pipeline: %s", error)
+            self._error = True
+            self._pending_calls = []
+            self.emit("error", error, "Cannot build the pipeline")
+            return
+
+        self.pipeline = pipeline
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self.__bus_message_cb)
+        self._prepared()
+
+    def _free_resources(self):
         if self.pipeline is None:
             return
-        self.pipeline.set_state(Gst.State.NULL)
-        self.pipeline.get_bus().remove_signal_watch()
+        if self._can_recycle():
+            self._recycle_pipeline()
+        else:
+            self._teardown_pipeline()
+
+    def _can_recycle(self):
+        # Only short overlapping sound effects are played often enough for
+        # their pipelines to be worth keeping.
+        overlap_behavior = self.metadata.get("overlap-behavior", "overlap")
+        return (not self._error and not self.loop and self.type_ == "sfx" and
+                overlap_behavior == "overlap" and self._pitch_elem is None)
+
+    def _recycle_pipeline(self):
+        self.usage.stop_streaming_thread()
+        pipeline = self.pipeline
+        pipeline.get_bus().remove_signal_watch()
+        for element, handler_id in self._handler_ids:
+            element.disconnect(handler_id)
+        self._handler_ids = []
         self.pipeline = None
-        self.emit("released")
+        self.server.pipeline_pool.recycle(
+            self.server.get_pool_key(self.sound_event_id), pipeline)
+
+    def _teardown_pipeline(self):
+        # The NULL state change may block, so it is done by the server
+        # teardown worker. The sound is done with the pipeline right away.
+        self.usage.stop_streaming_thread()
+        pipeline = self.pipeline
+        pipeline.get_bus().remove_signal_watch()
+        self.pipeline = None
+        self.server.teardown.push(pipeline)
+
+    def suspend(self):
+        # The pipeline is built again, and prerolled at the same position,
+        # when resumed.
+        if not self._ready or self._releasing or self._stop_loop:
+            return False
+        if self._pending_state_change is not None or self._splicing_pitch:
+            return False
+        if self._updates_id is not None:
+            return False
+        if self.get_state() != Gst.State.PAUSED:
+            return False
+        try:
+            position = self.get_current_position()
+            # Looping sounds are resumed in their first loop.
+            if self.loop:
+                position %= self.get_duration()
+        except (ValueError, ZeroDivisionError):
+            position = 0
+
+        self.logger.info("Suspending at %d ns.", position)
+        for element, handler_id in self._handler_ids:
+            element.disconnect(handler_id)
+        self._handler_ids = []
+        self._teardown_pipeline()
+        self._ready = False
+        self._volume_elem = None
+        self._fade_control = None
+        self._pitch_elem = None
+        self._rate_control = None
+        self._n_loop = 0
+        self._suspended_position = position
+        return True
+
+    def _resume(self):
+        # The pipeline is prerolled at the position, so there is no need
+        # for the initial seek.
+        self._is_initial_seek = True
+        super()._resume()
+
+    def sync_to_clock(self, clock, base_time):
+        if self.pipeline is None:
+            return
+        self.pipeline.use_clock(clock)
+        # Keep the pipeline from picking its own base time.
+        self.pipeline.set_start_time(Gst.CLOCK_TIME_NONE)
+        self.pipeline.set_base_time(base_time)
 
     def get_state(self):
         return self.pipeline.get_state(timeout=0).state
 
+    @when_ready
     def play(self):
         self._play()
 
+    @when_ready
     def pause_with_fade_out(self):
         self.logger.info("Pausing.")
         if self._releasing:
@@ -108,8 +631,7 @@ class Sound(GObject.Object):
             self.logger.info("Cannot pause because being stopped.")
             return
 
-        volume_elem = self.pipeline.get_by_name("volume")
-        if volume_elem.props.volume == 0:
+        if self._volume_elem.props.volume == 0:
             self.pipeline.set_state(Gst.State.PAUSED)
             self._pending_state_change = None
         else:
@@ -136,7 +658,8 @@ class Sound(GObject.Object):
             self.logger.warning("Fade in effect could not be applied.")
         return GLib.SOURCE_REMOVE
 
-    def stop(self):
+    @when_ready
+    def _stop(self):
         if not self.loop:
             # Just stop immediately
             self.release()
@@ -156,56 +679,214 @@ class Sound(GObject.Object):
             self.logger.warning("Fade out effect could not be applied. Stop.")
             self.release()
 
+    @when_ready
     def reset(self):
         self.seek(0.0)
         # Reset keyframes.
         self._fade_control.unset_all()
-        self._rate_control.unset_all()
+        if self._rate_control is not None:
+            self._rate_control.unset_all()
         try:
             self._add_fade_in()
         except ValueError:
             self.logger.warning("Fade in effect could not be applied.")
 
-    def update_properties(self, transition_time_ms, options):
-        if "volume" in options:
-            self._update_property_with_keyframes("volume", self._fade_control,
-                                                 transition_time_ms, "volume",
-                                                 options["volume"])
-        if "rate" in options:
-            self._update_property_with_keyframes("pitch", self._rate_control,
-                                                 transition_time_ms, "rate",
-                                                 options["rate"])
-
-    def _update_property_with_keyframes(self, element_name, control,
-                                        transition_time_ms, prop_name,
-                                        prop_value):
-        element = self.pipeline.get_by_name(element_name)
-        if element is None:
-            return
-        current_value = element.get_property(prop_name)
+    @when_ready
+    def update_properties(self, updates):
+        # Updates are applied at most once per main loop iteration. If more
+        # updates arrive in the meantime, only the latest target of each
+        # property is applied.
+        self._pending_updates.update(updates)
+        if self._pending_updates and self._updates_id is None:
+            self._updates_id = GLib.idle_add(self._apply_pending_updates)
+
+    def _apply_pending_updates(self):
+        self._updates_id = None
+        updates = self._pending_updates
+        self._pending_updates = {}
+        if self.pipeline is None:
+            return GLib.SOURCE_REMOVE
         try:
             current_time = self.get_current_position()
         except ValueError:
-            self.logger.warning("Cannot update the property '%s'.", prop_name)
+            self.logger.warning("Cannot update the properties: %s.",
+                                ", ".join(updates))
+            return GLib.SOURCE_REMOVE
+
+        for prop_name, (transition_time_ms, value) in updates.items():
+            if prop_name == "rate" and self._pitch_elem is None:
+                self._update_rate_without_pitch_element(transition_time_ms,
+                                                        value)
+                continue
+            element, control = self._get_automation(prop_name)
+            if element is None:
+                continue
+            if transition_time_ms is None:
+                self._update_property_with_curve(element, control,
+                                                 current_time, prop_name,
+                                                 value)
+            else:
+                self._update_property_with_keyframes(element, control,
+                                                     current_time,
+                                                     transition_time_ms,
+                                                     prop_name, value)
+        return GLib.SOURCE_REMOVE
+
+    def _get_automation(self, prop_name):
+        """
+        Gets the element and the control source that automate a property.
+        """
+        if prop_name == "volume":
+            return self._volume_elem, self._fade_control
+        if prop_name == "rate":
+            return self._pitch_elem, self._rate_control
+        return None, None
+
+    def _update_rate_without_pitch_element(self, transition_time_ms, value):
+        if self.rate_mode == "seek":
+            if transition_time_ms is None:
+                # A curve. Rate seeks cannot be automated, so just jump to
+                # its target.
+                try:
+                    value = value[-1][1]
+                except (IndexError, TypeError):
+                    self.logger.warning("Cannot update the rate with a "
+                                        "malformed curve.")
+                    return
+            self._set_playback_rate(value)
             return
+
+        self._rate_update_after_splice = (transition_time_ms, value)
+        if not self._splicing_pitch:
+            self._splicing_pitch = True
+            self._splice_pitch_element()
+
+    def _set_playback_rate(self, rate):
+        if rate <= 0:
+            self.logger.warning("Cannot set a playback rate of %f.", rate)
+            return
+        try:
+            position = self.get_current_position()
+        except ValueError:
+            self.logger.warning("Cannot update the playback rate.")
+            return
+        self._playback_rate = rate
+        flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        if self.loop:
+            flags |= Gst.SeekFlags.SEGMENT
+        self.seek(position, flags=flags)
+
+    def _splice_pitch_element(self):
+        """
+        Inserts a pitch element between the converter and the volume element.
+
+        The pipeline is modified once no data is flowing out of the
+        converter. Then the pending rate update is applied.
+        """
+        convert_elem = self.pipeline.get_by_name("convert")
+        src_pad = convert_elem.get_static_pad("src")
+
+        def pad_idle_cb(pad, unused_info):
+            # May be called from a streaming thread.
+            if self.pipeline is None:
+                return Gst.PadProbeReturn.REMOVE
+            pitch_elem = Gst.ElementFactory.make("pitch", "pitch")
+            self.pipeline.add(pitch_elem)
+            pad.unlink(self._volume_elem.get_static_pad("sink"))
+            convert_elem.link(pitch_elem)
+            pitch_elem.link(self._volume_elem)
+            pitch_elem.sync_state_with_parent()
+            GLib.idle_add(self.__pitch_element_spliced_cb, pitch_elem)
+            return Gst.PadProbeReturn.REMOVE
+
+        src_pad.add_probe(Gst.PadProbeType.IDLE, pad_idle_cb)
+
+    def __pitch_element_spliced_cb(self, pitch_elem):
+        self._splicing_pitch = False
+        if self.pipeline is None:
+            return GLib.SOURCE_REMOVE
+        self._rate_control = self._create_control(pitch_elem, "rate")
+        self._pitch_elem = pitch_elem
+        self.logger.debug("Pitch element added to the pipeline.")
+
+        transition_time_ms, value = self._rate_update_after_splice
+        self._rate_update_after_splice = None
+        if "rate" not in self._pending_updates:
+            self._pending_updates["rate"] = (transition_time_ms, value)
+        if self._updates_id is None:
+            self._updates_id = GLib.idle_add(self._apply_pending_updates)
+        return GLib.SOURCE_REMOVE
+
+    def _update_property_with_keyframes(self, element, control, current_time,
+                                        transition_time_ms, prop_name,
+                                        prop_value):
+        current_value = element.get_property(prop_name)
         time_end = current_time + transition_time_ms * Gst.MSECOND
         try:
             self._add_keyframe_pair(control, current_time, current_value,
                                     time_end, prop_value,
-                                    consider_duration=False,
-                                    consider_delay=False)
+                                    consider_duration=False)
         except ValueError:
             self.logger.warning("Cannot update the property '%s'.", prop_name)
             return
 
+    def _update_property_with_curve(self, element, control, current_time,
+                                    prop_name, points):
+        """
+        Replaces the automation of a property by a curve.
+
+        Args:
+            points (list): (time_ms, value) pairs. Times are relative to the
+                           current position.
+        """
+        try:
+            keyframes = [(current_time + int(time_ms * Gst.MSECOND), value)
+                         for time_ms, value in points]
+        except (TypeError, ValueError):
+            self.logger.warning("Cannot update the property '%s' with a "
+                                "malformed curve.", prop_name)
+            return
+        if not keyframes:
+            return
+        keyframes.insert(0, (current_time, element.get_property(prop_name)))
+        if not self._set_keyframes(control, keyframes):
+            self.logger.warning("Cannot update the property '%s'.", prop_name)
+
+    def _set_keyframes(self, control, keyframes):
+        """
+        Replaces all the keyframes of a control source in one go.
+
+        Args:
+            keyframes (list): (time_ns, value) pairs.
+
+        Returns:
+            bool: True if all the keyframes could be set.
+        """
+        control.unset_all()
+        ok = True
+        for time_ns, value in keyframes:
+            ok = control.set(time_ns, value) and ok
+        return ok
+
     def seek(self, position=None, flags=None):
         if flags is None:
             flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT
-        if position is None:
-            self.pipeline.seek(self._DEFAULT_RATE, Gst.Format.TIME, flags,
-                               Gst.SeekType.NONE, -1, Gst.SeekType.NONE, -1)
-        else:
-            self.pipeline.seek_simple(Gst.Format.TIME, flags, position)
+        start_type, start, stop_type, stop = self._get_seek_range(position)
+        self.pipeline.seek(self._playback_rate, Gst.Format.TIME, flags,
+                           start_type, start, stop_type, stop)
+
+    def _get_seek_range(self, position):
+        # Positions are relative to the segment of sprites, which stop at
+        # the end of their segment.
+        segment = self.segment
+        start_type, start = Gst.SeekType.NONE, -1
+        if position is not None:
+            start_type, start = Gst.SeekType.SET, int(position)
+            if segment is not None:
+                start += segment[0]
+        if segment is None:
+            return start_type, start, Gst.SeekType.NONE, -1
+        return start_type, start, Gst.SeekType.SET, segment[1]
 
     def get_current_position(self):
         ok, current_time = self.pipeline.query_position(Gst.Format.TIME)
@@ -214,9 +895,17 @@ class Sound(GObject.Object):
                              "Current state is '%s'. ",
                              Gst.Element.state_get_name(self.get_state()))
             raise ValueError('error querying position')
+        # The position of sprites is relative to their segment, like the
+        # positions given to `seek` and the duration.
+        segment = self.segment
+        if segment is not None:
+            current_time = max(0, current_time - segment[0])
         return current_time
 
     def get_duration(self):
+        segment = self.segment
+        if segment is not None:
+            return segment[1] - segment[0]
         ok, duration = self.pipeline.query_duration(Gst.Format.TIME)
         if not ok:
             self.logger.info("Cannot get the current position. "
@@ -225,87 +914,21 @@ class Sound(GObject.Object):
             raise ValueError('error querying duration')
         return duration
 
-    @property
-    def loop(self):
-        return "loop" in self.metadata and self.metadata["loop"]
-
-    @property
-    def volume(self):
-        volume = self._get_multipliable_prop("volume")
-        if volume is None:
-            volume = self._DEFAULT_VOLUME
-        return volume
-
-    @property
-    def pitch(self):
-        """
-        Changes pitch while keeping the tempo.
-        """
-        return self._get_multipliable_prop("pitch")
-
-    @property
-    def rate(self):
-        """
-        Changes tempo and pitch.
-        """
-        if "rate" in self.metadata:
-            return self.metadata["rate"]
-        return None
-
-    @property
-    def fade_in(self):
-        return self.metadata.get("fade-in",
-                                 self._DEFAULT_FADE_IN_MS if self.loop else 0)
-
-    @property
-    def fade_out(self):
-        pipeline_fade_out = 0
-        if self.loop:
-            pipeline_fade_out = self._DEFAULT_FADE_OUT_MS
-        metadata_fade_out = self.metadata.get("fade-out")
-        if metadata_fade_out is not None:
-            pipeline_fade_out = metadata_fade_out
-        return pipeline_fade_out
-
-    @property
-    def delay(self):
-        if "delay" in self.metadata:
-            return self.metadata["delay"]
-        return None
-
-    @property
-    def sound_location(self):
-        return random.choice(self.metadata["sound-files"])
-
-    @property
-    def type_(self):
-        type_ = self.metadata.get("type", "sfx")
-        if type_ not in ("sfx", "bg"):
-            return "sfx"
-        return type_
-
     def _add_keyframe_pair(self, control, time_start_ns, value_start,
                            time_end_ns, value_end, consider_duration=True,
-                           consider_delay=False):
-        control.unset_all()
-        if not self._add_keyframe(control, time_start_ns, value_start,
-                                  consider_delay):
-            raise ValueError('bad start time')
+                           shape=curves.LINEAR):
         # Rather than deal with the case where we have to split the keyframes
         # over the sound's loop; if the end keyframe is greater than the sound
         # file duration, we just apply the end keyframe to the end.
         if consider_duration:
             duration = self.get_duration()
             time_end_ns = min(time_end_ns, duration * (self._n_loop + 1))
-        if not self._add_keyframe(control, time_end_ns, value_end,
-                                  consider_delay):
-            raise ValueError('bad end time')
-
-    def _add_keyframe(self, control, time_ns, value, consider_delay=False):
-        if consider_delay:
-            delay = 0 if not self.delay else self.delay * Gst.MSECOND
-            time_ns += delay
-        return control.set(time_ns, value)
+        curve = curves.get_fade_curve(shape, time_end_ns - time_start_ns,
+                                      value_start, value_end)
+        keyframes = [(time_start_ns + time_ns, value)
+                     for time_ns, value in curve]
+        if not self._set_keyframes(control, keyframes):
+            raise ValueError('bad keyframe time')
 
     def _add_fade_in(self):
         if not self.loop or self.loop and self.fade_in == 0:
@@ -318,12 +941,12 @@ class Sound(GObject.Object):
             # from the time 0.
             self.logger.info("Assume first PlaySound call. Current time=0.")
             current_time = 0
-        current_volume = self.pipeline.get_by_name("volume").props.volume
+        current_volume = self._volume_elem.props.volume
         end_time = current_time + self.fade_in * Gst.MSECOND
-        consider_delay = current_time == 0
         self._add_keyframe_pair(self._fade_control,
                                 current_time, current_volume,
-                                end_time, self.volume, False, consider_delay)
+                                end_time, self.volume, False,
+                                shape=self.fade_curve)
 
     def _add_fade_out(self):
         # This method may raise a ValueError usually if the pipeline is in
@@ -338,25 +961,23 @@ class Sound(GObject.Object):
             return
         self.logger.debug("Fading out.")
         current_time = self.get_current_position()
-        if self.delay and current_time < self.delay * Gst.MSECOND:
-            self.logger.warning("Cannot fade out while in an in-progress "
-                                "delay.")
-            raise AssertionError
-        current_volume = self.pipeline.get_by_name("volume").props.volume
+        current_volume = self._volume_elem.props.volume
         end_time = current_time + self.fade_out * Gst.MSECOND
         self._add_keyframe_pair(self._fade_control,
                                 current_time, current_volume,
                                 end_time, 0,
-                                consider_delay=False)
+                                shape=self.fade_curve)
 
-    def _get_multipliable_prop(self, prop_name):
-        value = self.metadata.get(prop_name, None)
-        if prop_name in self.metadata_extras:
-            if value is None:
-                value = self.metadata_extras[prop_name]
-            else:
-                value *= self.metadata_extras[prop_name]
-        return value
+    def _get_control(self, element, prop):
+        """
+        Gets the control source of an element property, creating it if needed.
+        """
+        binding = element.get_control_binding(prop)
+        if binding is None:
+            return self._create_control(element, prop)
+        control = binding.props.control_source
+        control.unset_all()
+        return control
 
     def _create_control(self, element, prop):
         fade_control = GstController.InterpolationControlSource(
@@ -367,49 +988,141 @@ class Sound(GObject.Object):
             raise ValueError('bad control binding')
         return fade_control
 
-    def _build_pipeline(self):
-        pitch_args = (self.pitch or self._DEFAULT_PITCH,
-                      self.rate or self._DEFAULT_RATE)
+    def _needs_pitch_element(self):
+        if self.pitch is not None:
+            return True
+        return self.rate is not None and self.rate_mode == "pitch"
+
+    @classmethod
+    def get_pipeline_description(cls, location,
+                                 volume=BaseSound._DEFAULT_VOLUME, pitch=None,
+                                 rate=None,
+                                 loudness_gain=BaseSound._DEFAULT_VOLUME):
+        """
+        Gets the description of a sound pipeline for `Gst.parse_launch`.
+
+        The pitch element is only included if `pitch` or `rate` are given.
+        The loudness gain has its own volume element, so the automation of
+        the volume of the sound never overrides it.
+        """
         elements = [
-            "filesrc name=src location=\"{}\"".format(self.sound_location),
+            "filesrc name=src location=\"{}\"".format(location),
             "decodebin name=decoder",
-            "identity single-segment=true",
-            "audioconvert",
-            "pitch name=pitch pitch={} rate={}".format(*pitch_args),
-            "volume name=volume volume={}".format(self.volume),
+            "identity name=identity single-segment=true",
+            "audioconvert name=convert",
+            "volume name=volume volume={}".format(volume),
+            "volume name=loudness volume={}".format(loudness_gain),
+            "volume name=group-volume",
             "autoaudiosink"
         ]
-        spipeline = " ! ".join(elements)
+        if pitch is not None or rate is not None:
+            pitch_args = (pitch or cls._DEFAULT_PITCH,
+                          rate or cls._DEFAULT_RATE)
+            elements.insert(
+                4, "pitch name=pitch pitch={} rate={}".format(*pitch_args))
+        return " ! ".join(elements)
+
+    @classmethod
+    def preroll_for_pool(cls, metadata, locations, timeout_s):
+        # Only the pipelines without a pitch element are ever taken from the
+        # pool.
+        rate_mode = metadata.get("rate-mode")
+        if rate_mode not in cls.RATE_MODE_CHOICES:
+            rate_mode = "pitch"
+        needs_pitch_element = "pitch" in metadata or \
+            ("rate" in metadata and rate_mode == "pitch")
+        if needs_pitch_element:
+            return None
+        location = next(
+            (location for location in locations if os.path.exists(location)),
+            None)
+        if location is None:
+            return None
+
+        pipeline = Gst.parse_launch(cls.get_pipeline_description(location))
+        pipeline.set_state(Gst.State.PAUSED)
+        result, unused_state, unused_pending = pipeline.get_state(
+            timeout_s * Gst.SECOND)
+        if result == Gst.StateChangeReturn.FAILURE:
+            pipeline.set_state(Gst.State.NULL)
+            raise RuntimeError("Cannot preroll {}".format(location))
+        pipeline.set_state(Gst.State.READY)
+        return pipeline
+
+    def _build_pipeline(self):
+        # SoundTouch is expensive, so the pitch element is only added if
+        # needed. Otherwise, it is spliced in by the first rate update.
+        pitch = None
+        rate = None
+        if self._needs_pitch_element():
+            pitch = self.pitch or self._DEFAULT_PITCH
+            if self.rate_mode == "pitch":
+                rate = self.rate
+        spipeline = self.get_pipeline_description(self.sound_location,
+                                                  self.volume, pitch, rate,
+                                                  self.loudness_gain)
         pipeline = Gst.parse_launch(spipeline)
+        self._setup_pipeline(pipeline)
+        return pipeline
 
+    def _reuse_pipeline(self, pipeline):
+        # The pipeline is in the READY state. Drop any message left on the
+        # bus by its previous sound.
+        bus = pipeline.get_bus()
+        bus.set_flushing(True)
+        bus.set_flushing(False)
+        # Its previous sound may have been synced to the clock of a group.
+        pipeline.auto_clock()
+        pipeline.set_start_time(0)
+        src_elem = pipeline.get_by_name("src")
+        src_elem.props.location = self.sound_location
+        self._setup_pipeline(pipeline)
+        return pipeline
+
+    def _setup_pipeline(self, pipeline):
         volume_elem = pipeline.get_by_name("volume")
         assert volume_elem is not None
+        volume_elem.props.volume = self.volume
         # Set the initial volume to 0 for looping sounds that fade in.
         if self.loop and self.fade_in > 0:
             volume_elem.props.volume = 0
-        volume_elem.connect("notify::volume", self.__volume_cb)
-        self._fade_control = self._create_control(volume_elem, "volume")
+        handler_id = volume_elem.connect("notify::volume", self.__volume_cb)
+        self._handler_ids.append((volume_elem, handler_id))
+        self._fade_control = self._get_control(volume_elem, "volume")
+        self._volume_elem = volume_elem
+        # Recycled pipelines may have played a file with another gain.
+        pipeline.get_by_name("loudness").props.volume = self.loudness_gain
+        self._mix_group.bind(pipeline.get_by_name("group-volume"))
+        if self.server.first_buffer_probe and \
+                metrics.ARRIVAL_TO_FIRST_BUFFER not in self.usage.latencies_us:
+            pad = pipeline.get_by_name("group-volume").get_static_pad("src")
+            pad.add_probe(Gst.PadProbeType.BUFFER, self.__first_buffer_cb)
 
         pitch_elem = pipeline.get_by_name("pitch")
-        assert pitch_elem is not None
-        self._rate_control = self._create_control(pitch_elem, "rate")
+        if pitch_elem is not None:
+            self._rate_control = self._get_control(pitch_elem, "rate")
+            self._pitch_elem = pitch_elem
 
         decoder_elem = pipeline.get_by_name("decoder")
         assert decoder_elem is not None
-        decoder_elem.connect("pad-added", self.__pad_added_cb)
+        handler_id = decoder_elem.connect("pad-added", self.__pad_added_cb)
+        self._handler_ids.append((decoder_elem, handler_id))
 
-        return pipeline
-
-    def __pad_added_cb(self, unused_decoder, pad):
-        if self.pipeline is None:
-            return
-        if not self.delay:
-            return
-        pad.set_offset(self.delay * Gst.MSECOND)
+    def __pad_added_cb(self, decoder, pad):
+        # Called from a streaming thread, possibly before the pipeline is
+        # handed to the sound. This thread keeps decoding the file.
+        self.usage.start_streaming_thread()
+        if not pad.is_linked():
+            # The decoder of a recycled pipeline creates new pads, which are
+            # not linked by the parse_launch delayed link anymore.
+            identity_elem = decoder.get_parent().get_by_name("identity")
+            pad.link(identity_elem.get_static_pad("sink"))
 
     def __volume_cb(self, volume_element, unused_volume):
         # In case of fade-out effects, release the pipeline as soon volume
         # reaches 0.
+        if self.pipeline is None:
+            return
         if volume_element.props.volume == 0:
             if self._pending_state_change is not None:
                 self.pipeline.set_state(self._pending_state_change)
@@ -417,6 +1130,59 @@ class Sound(GObject.Object):
             if self._stop_loop:
                 self.release()
 
+    def __first_buffer_cb(self, unused_pad, unused_info):
+        # Called from a streaming thread.
+        GLib.idle_add(self.__first_buffer_reached_cb,
+                      GLib.get_monotonic_time())
+        return Gst.PadProbeReturn.REMOVE
+
+    def __first_buffer_reached_cb(self, time):
+        if self.usage.request_time is not None:
+            self.usage.add_latency(metrics.ARRIVAL_TO_FIRST_BUFFER,
+                                   time - self.usage.request_time)
+        return GLib.SOURCE_REMOVE
+
+    def _measure_pipeline(self):
+        # Queries the latency of the pipeline, counts its elements and
+        # estimates the memory of the audio buffered by the sink, from the
+        # negotiated format.
+        query = Gst.Query.new_latency()
+        if self.pipeline.query(query):
+            unused_live, min_latency, unused_max_latency = \
+                query.parse_latency()
+            self.usage.add_latency(metrics.PIPELINE_LATENCY,
+                                   min_latency // Gst.USECOND)
+        elements = []
+        self.pipeline.iterate_recurse().foreach(elements.append)
+        self.usage.n_elements = len(elements)
+        buffer_time_us = None
+        for element in elements:
+            if element.find_property("buffer-time") is not None:
+                buffer_time_us = element.props.buffer_time
+        group_volume_elem = self.pipeline.get_by_name("group-volume")
+        caps = group_volume_elem.get_static_pad("src").get_current_caps()
+        if caps is None or buffer_time_us is None:
+            return
+        structure = caps.get_structure(0)
+        has_rate, rate = structure.get_int("rate")
+        has_channels, channels = structure.get_int("channels")
+        # The last number of the format is the width of a sample in memory,
+        # as in "S16LE", "F32LE" or "S24_32LE".
+        widths = re.findall(r"\d+", structure.get_string("format") or "")
+        if not has_rate or not has_channels or not widths:
+            return
+        bytes_per_second = rate * channels * int(widths[-1]) // 8
+        self.usage.buffer_bytes = \
+            bytes_per_second * buffer_time_us // GLib.USEC_PER_SEC
+
+    def _is_file_error(self, element):
+        # Errors reading or decoding the file, as opposed to errors of the
+        # audio sink, for example.
+        decoder_elem = self.pipeline.get_by_name("decoder")
+        return (element == self.pipeline.get_by_name("src") or
+                element == decoder_elem or
+                element.has_as_ancestor(decoder_elem))
+
     def __bus_message_cb(self, unused_bus, message):
         if message.type == Gst.MessageType.EOS:
             self.release()
@@ -431,17 +1197,32 @@ class Sound(GObject.Object):
         elif message.type == Gst.MessageType.ASYNC_DONE:
             if message.src != self.pipeline:
                 return
-            if self.loop and not self._is_initial_seek:
-                flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT |\
-                        Gst.SeekFlags.SEGMENT
+            # The file could be played.
+            self.server.negative_cache.remove(self.location)
+            if not self._is_initial_seek and (
+                    self.loop or self._playback_rate != self._DEFAULT_RATE):
+                flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT
+                if self.loop:
+                    flags |= Gst.SeekFlags.SEGMENT
                 self.seek(0.0, flags=flags)
                 self._is_initial_seek = True
+                # Prerolled again once the seek is done.
+                return
+            if not self._prerolled:
+                self._prerolled = True
+                self._measure_pipeline()
+                self.emit("prerolled")
         elif message.type == Gst.MessageType.ERROR:
             error, debug = message.parse_error()
             self.logger.warning("Error from %s: %s (%s)", message.src, error,
                                 debug)
-            self.pipeline.set_state(Gst.State.NULL)
+            if self._is_file_error(message.src):
+                backoff = self.server.negative_cache.add(self.location,
+                                                         error.domain)
+                self.logger.info("Skipping %s for %d seconds.", self.location,
+                                 backoff)
             self._error = True
+            self._teardown_pipeline()
             self.emit("error", error, debug)
         elif message.type == Gst.MessageType.STATE_CHANGED:
             if message.src != self.pipeline:
@@ -449,6 +1230,12 @@ class Sound(GObject.Object):
             st = message.get_structure()
             old_state = st.get_value("old-state")
             new_state = st.get_value("new-state")
+            if new_state == Gst.State.PLAYING:
+                self.usage.set_state(self.usage.PLAYING)
+            elif new_state == Gst.State.PAUSED:
+                self.usage.set_state(self.usage.PAUSED)
+            else:
+                self.usage.set_state(None)
             if (old_state == Gst.State.READY and new_state == Gst.State.PAUSED
                     and self._stop_loop):
                 self.release()
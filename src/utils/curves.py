@@ -0,0 +1,94 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import functools
+import math
+
+
+LINEAR = "linear"
+EQUAL_POWER = "equal-power"
+EXPONENTIAL = "exponential"
+S_CURVE = "s-curve"
+SHAPES = (LINEAR, EQUAL_POWER, EXPONENTIAL, S_CURVE)
+
+# Number of keyframes used to approximate the non-linear curves. The control
+# sources interpolate linearly between them.
+_N_POINTS = 32
+# Steepness of the exponential curve.
+_EXPONENTIAL_K = 4.0
+
+
+def _equal_power(t, rising):
+    if rising:
+        return math.sin(t * math.pi / 2)
+    return 1 - math.cos(t * math.pi / 2)
+
+
+def _exponential(t, rising):
+    if not rising:
+        return 1 - _exponential(1 - t, True)
+    return math.expm1(_EXPONENTIAL_K * t) / math.expm1(_EXPONENTIAL_K)
+
+
+def _s_curve(t, unused_rising):
+    return (1 - math.cos(t * math.pi)) / 2
+
+
+_PROGRESS_FUNCS = {
+    EQUAL_POWER: _equal_power,
+    EXPONENTIAL: _exponential,
+    S_CURVE: _s_curve,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def get_fade_curve(shape, duration_ns, value_start, value_end):
+    """
+    Gets the keyframes of a fade.
+
+    Curves are computed once and cached, so starting a fade that was already
+    done before costs just a dictionary look up.
+
+    Args:
+        shape (str): One of `SHAPES`. Unknown shapes are considered linear.
+        duration_ns (int): The duration of the fade in nanoseconds.
+        value_start (float): The value at the start of the fade.
+        value_end (float): The value at the end of the fade.
+
+    Returns:
+        tuple: (time_ns, value) pairs, with times relative to the start of
+        the fade.
+    """
+    progress_func = _PROGRESS_FUNCS.get(shape)
+    if progress_func is None or duration_ns <= 0:
+        return ((0, value_start), (duration_ns, value_end))
+
+    # Whether the curve goes from the quiet end to the loud end.
+    rising = value_end >= value_start
+    delta = value_end - value_start
+    keyframes = [(0, value_start)]
+    for i in range(1, _N_POINTS):
+        t = i / _N_POINTS
+        keyframes.append((duration_ns * i // _N_POINTS,
+                          value_start + delta * progress_func(t, rising)))
+    # The end value must be exact: reaching a volume of 0 is what finishes
+    # the fade out effects.
+    keyframes.append((duration_ns, value_end))
+    return tuple(keyframes)
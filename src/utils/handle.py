@@ -0,0 +1,88 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import itertools
+import random
+import re
+
+
+# The first 64 bits of every handle string are a random salt picked once per
+# process, so handles minted by a previous instance of the server never
+# collide with the ones minted by the current one.
+_SALT = random.SystemRandom().getrandbits(64)
+_PREFIX = "{:08x}-{:04x}-{:04x}".format(_SALT >> 32,
+                                        (_SALT >> 16) & 0xffff,
+                                        _SALT & 0xffff)
+_COUNTER = itertools.count(1)
+# The counter part of a handle string, in the canonical form given by
+# `SoundHandle.__str__`, so each handle has a single string.
+_COUNTER_RE = re.compile(r"-([0-9a-f]{4})-([0-9a-f]{12})")
+
+
+class SoundHandle(int):
+    """
+    Identifies a sound.
+
+    Internally a handle is just an int taken from a monotonic counter, which
+    makes it cheap to mint, hash and store as a key in the registry. Clients
+    see it as a UUID-like string (the per-process salt followed by the
+    counter), e.g. "5f0e4c3a-91d2-7b6e-0000-00000000002a".
+    """
+    __slots__ = ()
+
+    @classmethod
+    def new(cls):
+        """
+        Mints a new handle.
+
+        Returns:
+            SoundHandle: A handle that is unique for this process.
+        """
+        return cls(next(_COUNTER))
+
+    @classmethod
+    def from_string(cls, string):
+        """
+        Gets the handle represented by the given string.
+
+        Args:
+            string (str): The D-Bus visible representation of a handle.
+
+        Returns:
+            SoundHandle: The handle, or None if `string` does not represent
+            a handle minted by this process.
+        """
+        if not string.startswith(_PREFIX):
+            return None
+        match = _COUNTER_RE.fullmatch(string, len(_PREFIX))
+        if match is None:
+            return None
+        return cls(int(match.group(1) + match.group(2), 16))
+
+    def __str__(self):
+        value = int(self)
+        return "{}-{:04x}-{:012x}".format(_PREFIX, value >> 48,
+                                          value & 0xffffffffffff)
+
+    def __repr__(self):
+        return "<SoundHandle {}>".format(self)
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
@@ -18,8 +18,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+import collections
+import datetime
 import logging
 import os
+import time
 
 
 DEFAULT_LOG_LEVEL = logging.WARNING
@@ -160,6 +163,86 @@ class ServerFormatter(ObjectFormatter):
         return super().format(record, show_object_id=False)
 
 
+class FlightRecorder:
+    """
+    Keeps the most recent log events in memory, at any level.
+
+    Events are stored as plain tuples and only formatted when dumped, so
+    recording them is cheap enough to be always on, even for the debug
+    messages that are not written to stderr. Messages with arguments other
+    than plain values are formatted right away instead, so the recorder
+    keeps no GStreamer element or sound alive and dumps show them as they
+    were when the event happened.
+    """
+    _SIZE = 4096
+    _PLAIN_TYPES = (str, int, float, type(None))
+
+    def __init__(self, size=_SIZE):
+        # Tuples of (time, level, source, bus name, sound event id, uuid,
+        # message template, arguments).
+        self._events = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._events)
+
+    def record(self, level, source, bus_name, sound_event_id, uuid, msg,
+               args):
+        if not isinstance(msg, str) or \
+                any(not isinstance(arg, self._PLAIN_TYPES) for arg in args):
+            msg, args = self._format_message(msg, args), ()
+        self._events.append((time.time(), level, source, bus_name,
+                             sound_event_id, uuid, msg, args))
+
+    def format_events(self, max_events=0):
+        """
+        Formats the recorded events, oldest first.
+
+        Optional Arguments:
+            max_events (int): Only format the given number of most recent
+                              events. 0 means all of them.
+
+        Returns:
+            list: The formatted events, as strings.
+        """
+        events = list(self._events)
+        if max_events > 0:
+            events = events[-max_events:]
+        return [self._format_event(*event) for event in events]
+
+    @staticmethod
+    def _format_message(msg, args):
+        try:
+            return str(msg) % args if args else str(msg)
+        except (TypeError, ValueError):
+            return "{} {!r}".format(msg, args)
+
+    @classmethod
+    def _format_event(cls, timestamp, level, source, bus_name,
+                      sound_event_id, uuid, msg, args):
+        message = cls._format_message(msg, args)
+        prefix = "".join("{}: ".format(value)
+                         for value in (bus_name, sound_event_id, uuid)
+                         if value is not None)
+        time_str = datetime.datetime.fromtimestamp(timestamp).isoformat(
+            sep=" ", timespec="milliseconds")
+        return "{} {:<8} {}: {}{}".format(time_str,
+                                          logging.getLevelName(level),
+                                          source, prefix, message)
+
+    def dump(self, stream, reason):
+        """
+        Writes all the recorded events to a stream.
+        """
+        stream.write("---- Recent events ({}) ----\n".format(reason))
+        for line in self.format_events():
+            stream.write(line + "\n")
+        stream.write("---- End of recent events ----\n")
+        stream.flush()
+
+
+flight_recorder = FlightRecorder()
+
+
 class Logger(logging.Logger):
     DEFAULT_FORMATTER = DefaultFormatter
 
@@ -172,7 +255,14 @@ class Logger(logging.Logger):
             formatter = formatter(obj)
         ch.setFormatter(formatter)
         self.addHandler(ch)
-        self.setLevel(get_log_level())
+        # Every message reaches `_log` to be kept by the flight recorder, but
+        # only the ones at the configured level build a record for stderr.
+        self.setLevel(logging.DEBUG)
+        self._stream_level = get_log_level()
+        self._source = type(obj).__name__ if obj is not None else "global"
+        # Sound loggers take the bus name, sound event id and uuid from the
+        # sound itself.
+        self._sound = obj if isinstance(formatter, SoundFormatter) else None
 
     def _log(self, level, msg, args, exc_info=None, extra=None,
              stack_info=False, **kwargs):
@@ -182,6 +272,17 @@ class Logger(logging.Logger):
         Users can do the following:
             logger.info("%d-%s-%s", 3, "pigs", "fly", trump=None)
         """
+        if self._sound is not None:
+            flight_recorder.record(level, self._source, self._sound.bus_name,
+                                   self._sound.sound_event_id,
+                                   self._sound.uuid, msg, args)
+        else:
+            flight_recorder.record(level, self._source,
+                                   kwargs.get("bus_name"),
+                                   kwargs.get("sound_event_id"),
+                                   kwargs.get("uuid"), msg, args)
+        if level < self._stream_level:
+            return
         extra = extra or {}
         extra.update(kwargs)
         super()._log(level, msg, args, exc_info, extra, stack_info)
@@ -20,6 +20,7 @@
 #
 import json
 import os
+from hack_sound_server.utils.misc import get_loudness_index_path
 from hack_sound_server.utils.misc import get_metadata_path
 from hack_sound_server.utils.misc import get_sounds_dir
 from hack_sound_server.utils.loggable import logger
@@ -33,6 +34,9 @@ def _read_in_metadata(metadata, user_type):
         # the available sounds.
         if "sound-file" in metadata[sound_event_id]:
             sound_files.append(metadata[sound_event_id]["sound-file"])
+        # Sprites play a segment of a file shared by several sound events.
+        if "sprite" in metadata[sound_event_id]:
+            sound_files = [metadata[sound_event_id]["sprite"]]
 
         metadata[sound_event_id]["sound-files"] =\
             [os.path.join(sounds_dir, path) for path in set(sound_files)]
@@ -68,3 +72,40 @@ def read_and_parse_metadata():
     user_metadata = load_metadata("user")
     system_metadata.update(user_metadata)
     return system_metadata
+
+
+def load_loudness_index(user_type):
+    """
+    Loads the gains written by `tools/analyze-loudness.py`.
+
+    Returns:
+        dict: The gain of each sound file, by absolute path, and of each
+        sprite segment, by (absolute path, start, duration) triplets.
+    """
+    index_path = get_loudness_index_path(user_type)
+    if not os.path.exists(index_path):
+        return {}
+
+    sounds_dir = get_sounds_dir(user_type)
+    try:
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+        gains = {os.path.join(sounds_dir, path): entry["gain"]
+                 for path, entry in index["files"].items()}
+        for path, segments in index.get("segments", {}).items():
+            for segment in segments:
+                key = (os.path.join(sounds_dir, path), segment["start"],
+                       segment["duration"])
+                gains[key] = segment["gain"]
+        return gains
+    except Exception as e:
+        logger.error(
+            "Not possible to decode loudness index at '%s'.\n"
+            "%s" % (index_path, e))
+    return {}
+
+
+def read_and_parse_loudness_index():
+    gains = load_loudness_index("system")
+    gains.update(load_loudness_index("user"))
+    return gains
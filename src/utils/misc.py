@@ -39,3 +39,8 @@ def get_metadata_path(user_type):
 def get_sounds_dir(user_type):
     data_dir = get_datadir(user_type)
     return os.path.join(data_dir, "sounds")
+
+
+def get_loudness_index_path(user_type):
+    data_dir = get_datadir(user_type)
+    return os.path.join(data_dir, "loudness.json")
@@ -0,0 +1,99 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import functools
+import os
+import time
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve(path):
+    return os.path.realpath(path)
+
+
+class NegativeCache:
+    """
+    Remembers the sound files that failed to play.
+
+    Failures are recorded by resolved file path and error domain. A failing
+    file is skipped for a backoff time which doubles on each new failure, up
+    to a maximum. Once the backoff time is over, the file gets another chance;
+    a successful play forgets all its failures.
+    """
+    _INITIAL_BACKOFF_S = 1
+    _MAX_BACKOFF_S = 300
+
+    def __init__(self, time_func=time.monotonic):
+        self._time_func = time_func
+        # Maps resolved paths to dictionaries mapping error domains to
+        # (number of failures, time until which the path is skipped) pairs.
+        self._failures = {}
+
+    def __len__(self):
+        return len(self._failures)
+
+    def add(self, path, domain):
+        """
+        Records a failure of a file.
+
+        Args:
+            path (str): The path of the file.
+            domain (str): The domain of the error.
+
+        Returns:
+            float: The number of seconds the file will be skipped.
+        """
+        failures = self._failures.setdefault(_resolve(path), {})
+        n_failures, unused_retry_time = failures.get(domain, (0, None))
+        n_failures += 1
+        backoff = min(self._INITIAL_BACKOFF_S * 2 ** (n_failures - 1),
+                      self._MAX_BACKOFF_S)
+        failures[domain] = (n_failures, self._time_func() + backoff)
+        return backoff
+
+    def remove(self, path):
+        """
+        Forgets the failures of a file.
+        """
+        if not self._failures:
+            return
+        self._failures.pop(_resolve(path), None)
+
+    def is_failing(self, path):
+        """
+        Checks whether a file failed recently and should be skipped.
+        """
+        if not self._failures:
+            return False
+        failures = self._failures.get(_resolve(path))
+        if not failures:
+            return False
+        now = self._time_func()
+        return any(retry_time > now
+                   for unused_n_failures, retry_time in failures.values())
+
+    def filter(self, paths):
+        """
+        Gets the files that are not failing.
+
+        Returns:
+            list: The paths in `paths` which should not be skipped.
+        """
+        return [path for path in paths if not self.is_failing(path)]
@@ -0,0 +1,145 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import cProfile
+import collections
+import math
+import os
+import sys
+import threading
+
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+MODES = (CPROFILE, SAMPLING)
+
+
+class CProfileProfiler:
+    """
+    Profiles every call run by the main thread with cProfile.
+
+    This covers the D-Bus requests, the timeouts and the bus messages of the
+    pipelines, which are all dispatched by the main context. Callbacks run by
+    the GStreamer streaming threads are only covered by the sampling mode.
+    The profile is written in the pstats format.
+    """
+    extension = "pstats"
+
+    def __init__(self, unused_options):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self, path):
+        self._profile.disable()
+        self._profile.dump_stats(path)
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of all the threads at a regular interval.
+
+    Threads created by GStreamer, such as the streaming threads running the
+    pad and volume callbacks, only have a Python stack while they run one of
+    these callbacks, so they are sampled too. Stacks are written in the
+    collapsed format taken by flamegraph tools, one line per stack with its
+    number of samples, rooted at the name of its thread. The time the main
+    thread is idle shows up as the stack running the main loop.
+    """
+    extension = "folded"
+    _DEFAULT_INTERVAL_MS = 5
+    # Shorter intervals would keep the sampling thread busy.
+    _MIN_INTERVAL_MS = 1
+
+    def __init__(self, options):
+        interval_ms = options.get("interval-ms", self._DEFAULT_INTERVAL_MS)
+        # `Event.wait` raises or spins on infinite or NaN timeouts, which
+        # would silently end the sampling thread.
+        if isinstance(interval_ms, bool) or \
+                not isinstance(interval_ms, (int, float)) or \
+                not math.isfinite(interval_ms) or interval_ms <= 0:
+            raise ValueError("The 'interval-ms' option must be a positive "
+                             "number")
+        self._interval_s = max(interval_ms, self._MIN_INTERVAL_MS) / 1000
+        self._stacks = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler",
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self._interval_s):
+            thread_names = {thread.ident: thread.name
+                            for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                thread_name = thread_names.get(ident,
+                                               "thread-{}".format(ident))
+                self._stacks[self._collapse(thread_name, frame)] += 1
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("{} ({}:{})".format(code.co_name,
+                                             os.path.basename(
+                                                 code.co_filename),
+                                             code.co_firstlineno))
+            frame = frame.f_back
+        names.append(thread_name)
+        return ";".join(reversed(names))
+
+    def stop(self, path):
+        self._stop_event.set()
+        self._thread.join()
+        with open(path, "w") as stacks_file:
+            for stack, n_samples in sorted(self._stacks.items()):
+                stacks_file.write("{} {}\n".format(stack, n_samples))
+
+
+_PROFILERS = {
+    CPROFILE: CProfileProfiler,
+    SAMPLING: SamplingProfiler,
+}
+
+
+def create_profiler(mode, options):
+    """
+    Creates a profiler.
+
+    Args:
+        mode (str): One of `MODES`.
+        options (dict): The options of the profiler. The sampling profiler
+                        takes the interval between samples as "interval-ms".
+
+    Raises:
+        ValueError: If `mode` is unknown or an option is not valid.
+    """
+    if mode not in _PROFILERS:
+        raise ValueError("Unknown profiling mode '{}', expected one of: "
+                         "{}".format(mode, ", ".join(MODES)))
+    return _PROFILERS[mode](options)
@@ -0,0 +1,139 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import gi
+import itertools
+import json
+import os
+
+gi.require_version('GLib', '2.0')  # noqa
+from gi.repository import GLib  # noqa
+
+
+class RecordingInvocation:
+    """
+    Wraps a `Gio.DBusMethodInvocation` to record the outcome of a call.
+    """
+
+    def __init__(self, recorder, call_id, invocation):
+        self._recorder = recorder
+        self._call_id = call_id
+        self._invocation = invocation
+
+    def return_value(self, value):
+        text = value.print_(True) if value is not None else None
+        self._recorder.record_reply(self._call_id, value=text)
+        self._invocation.return_value(value)
+
+    def return_dbus_error(self, error_name, error_message):
+        self._recorder.record_reply(self._call_id, error=error_name)
+        self._invocation.return_dbus_error(error_name, error_message)
+
+    def return_error_literal(self, domain, code, message):
+        self._recorder.record_reply(
+            self._call_id, error="{}:{}".format(GLib.quark_to_string(domain),
+                                                code))
+        self._invocation.return_error_literal(domain, code, message)
+
+
+class TrafficRecorder:
+    """
+    Records the D-Bus traffic of the server in a JSON lines file.
+
+    Each line is one of the following events, with `time` in microseconds of
+    the monotonic clock:
+
+    - `{"event": "session", "session", "time"}`, written when the server
+      starts recording. The file is appended to, so a recording can span
+      several runs of the server. Call ids are only unique within a session.
+    - `{"event": "call", "id", "time", "sender", "method", "params"}`, where
+      `params` is the text form of the parameters variant, with types.
+    - `{"event": "reply", "id", "time", "value"}` or
+      `{"event": "reply", "id", "time", "error"}`.
+    - `{"event": "disconnect", "time", "sender"}`, when a client that made
+      calls leaves the bus.
+
+    Lines are buffered and written at most once per second.
+    """
+    _FLUSH_INTERVAL_S = 1
+
+    def __init__(self, path):
+        """
+        Raises:
+            OSError: If the file cannot be opened.
+        """
+        self._file = open(path, "a")
+        self._ids = itertools.count()
+        self._senders = set()
+        self._flush_id = None
+        time = GLib.get_monotonic_time()
+        self._write({"event": "session",
+                     "session": "{}-{}".format(os.getpid(), time),
+                     "time": time})
+
+    def record_call(self, sender, method, params, time, invocation):
+        """
+        Records a method call.
+
+        Returns:
+            RecordingInvocation: The invocation to reply through, so the
+            outcome of the call is recorded too.
+        """
+        call_id = next(self._ids)
+        self._senders.add(sender)
+        self._write({"event": "call", "id": call_id, "time": time,
+                     "sender": sender, "method": method,
+                     "params": params.print_(True)})
+        return RecordingInvocation(self, call_id, invocation)
+
+    def record_reply(self, call_id, value=None, error=None):
+        event = {"event": "reply", "id": call_id,
+                 "time": GLib.get_monotonic_time()}
+        if error is not None:
+            event["error"] = error
+        else:
+            event["value"] = value
+        self._write(event)
+
+    def record_disconnect(self, sender):
+        if sender not in self._senders:
+            return
+        self._senders.remove(sender)
+        self._write({"event": "disconnect", "sender": sender,
+                     "time": GLib.get_monotonic_time()})
+
+    def _write(self, event):
+        self._file.write(json.dumps(event, separators=(",", ":")))
+        self._file.write("\n")
+        if self._flush_id is None:
+            self._flush_id = GLib.timeout_add_seconds(
+                self._FLUSH_INTERVAL_S, self.__flush_cb,
+                priority=GLib.PRIORITY_LOW)
+
+    def __flush_cb(self):
+        self._flush_id = None
+        self._file.flush()
+        return GLib.SOURCE_REMOVE
+
+    def close(self):
+        if self._flush_id is not None:
+            GLib.Source.remove(self._flush_id)
+            self._flush_id = None
+        self._file.close()
@@ -0,0 +1,160 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import gi
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+gi.require_version('GLib', '2.0')  # noqa
+gi.require_version('Gst', '1.0')   # noqa
+from gi.repository import GLib  # noqa
+from gi.repository import Gst  # noqa
+
+
+class WorkerPool:
+    """
+    Runs blocking jobs in worker threads.
+
+    Results are handed back to the main context, so callbacks can safely touch
+    the registry and the sounds.
+    """
+
+    def __init__(self, max_workers, name):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=name)
+
+    def submit(self, func, callback, *args):
+        """
+        Runs `func(*args)` in a worker thread.
+
+        Args:
+            func (callable): The job to run.
+            callback (callable): Called from the main context as
+                                 `callback(result, error)` once the job is
+                                 done. `error` is the exception raised by
+                                 the job, if any, in which case `result` is
+                                 None.
+        """
+        def done_cb(future):
+            GLib.idle_add(self._dispatch, future, callback,
+                          priority=GLib.PRIORITY_DEFAULT)
+
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(done_cb)
+
+    @staticmethod
+    def _dispatch(future, callback):
+        error = future.exception()
+        result = None if error is not None else future.result()
+        callback(result, error)
+        return GLib.SOURCE_REMOVE
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class TeardownWorker:
+    """
+    Shuts pipelines down in a background thread.
+
+    Setting a pipeline to NULL may block while the sink drains and the
+    streaming threads join. Pipelines pushed while the worker is busy are torn
+    down together in the next batch.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def push(self, pipeline, state=Gst.State.NULL, callback=None):
+        """
+        Queues a pipeline to be shut down.
+
+        Args:
+            pipeline (Gst.Pipeline): The pipeline to shut down.
+
+        Optional Arguments:
+            state (Gst.State): The state to set the pipeline to. Defaults to
+                               NULL, in which case the pipeline is dropped.
+            callback (callable): Called from the main context as
+                                 `callback(pipeline)` once the pipeline has
+                                 reached `state`.
+        """
+        self._start()
+        self._queue.put((pipeline, state, callback))
+
+    def flush(self, callback):
+        """
+        Waits for the pipelines queued so far to be torn down.
+
+        Args:
+            callback (callable): Called from the main context as `callback()`
+                                 once the pipelines queued before are shut
+                                 down and dropped by the worker.
+        """
+        self._start()
+        self._queue.put((None, None, callback))
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="teardown", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            while True:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            flush_callbacks = []
+            for job in jobs:
+                if job is None:
+                    return
+                pipeline, state, callback = job
+                if pipeline is None:
+                    flush_callbacks.append(callback)
+                    continue
+                pipeline.set_state(state)
+                if callback is not None:
+                    GLib.idle_add(callback, pipeline)
+            # Drop the last references to the pipelines before waiting, and
+            # before telling the flushes they are done.
+            jobs = job = pipeline = None
+            for callback in flush_callbacks:
+                GLib.idle_add(self._dispatch_flush, callback)
+
+    @staticmethod
+    def _dispatch_flush(callback):
+        callback()
+        return GLib.SOURCE_REMOVE
+
+    def shutdown(self):
+        """
+        Tears down the queued pipelines and stops the worker thread.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,37 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import importlib.util
+import os
+import sys
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       os.pardir, "src")
+
+# The sources are installed as the hack_sound_server package, so make them
+# importable under that name without installing them.
+if "hack_sound_server" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "hack_sound_server", os.path.join(SRC_DIR, "__init__.py"),
+        submodule_search_locations=[SRC_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["hack_sound_server"] = module
+    spec.loader.exec_module(module)
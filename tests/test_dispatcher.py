@@ -0,0 +1,157 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import pytest
+
+from hack_sound_server.dispatcher import InvalidArgsException
+from hack_sound_server.dispatcher import parse_params
+from hack_sound_server.dispatcher import Request
+from hack_sound_server.dispatcher import RequestQueue
+
+
+def make_request(sender, method, *params):
+    return Request(method, sender, parse_params(method, params), None, None,
+                   None, None, 0)
+
+
+def drain(queue):
+    requests = []
+    request = queue.pop()
+    while request is not None:
+        requests.append(request)
+        request = queue.pop()
+    return requests
+
+
+def test_senders_are_served_round_robin():
+    queue = RequestQueue()
+    for i in range(3):
+        queue.push(make_request(":1.1", "PlaySound", "a{}".format(i)))
+    queue.push(make_request(":1.2", "PlaySound", "b"))
+
+    served = [(request.sender, request.params[0])
+              for request in drain(queue)]
+    assert served == [(":1.1", "a0"), (":1.2", "b"), (":1.1", "a1"),
+                      (":1.1", "a2")]
+    assert len(queue) == 0
+
+
+def test_updates_wait_for_the_calls_of_other_senders():
+    queue = RequestQueue()
+    queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                            {"volume": 0.5}))
+    queue.push(make_request(":1.2", "PlaySound", "b"))
+
+    assert [request.method for request in drain(queue)] == \
+        ["PlaySound", "UpdateProperties"]
+
+
+def test_calls_of_a_sender_are_served_in_arrival_order():
+    queue = RequestQueue()
+    queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                            {"volume": 0.5}))
+    queue.push(make_request(":1.1", "StopSound", "u"))
+    queue.push(make_request(":1.2", "PlaySound", "b"))
+
+    served = [(request.sender, request.method) for request in drain(queue)]
+    assert served.index((":1.1", "UpdateProperties")) < \
+        served.index((":1.1", "StopSound"))
+
+
+def test_adjacent_updates_keep_the_transition_of_each_property():
+    queue = RequestQueue()
+    first = make_request(":1.1", "UpdateProperties", "u", 1000,
+                         {"volume": 0.0})
+    assert queue.push(first) is None
+    superseded = queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                                         {"rate": 2.0}))
+
+    assert superseded is first
+    assert len(queue) == 1
+    request = queue.pop()
+    assert request.params == ("u", {"volume": (1000, 0.0),
+                                    "rate": (0, 2.0)})
+
+
+def test_updates_separated_by_another_call_are_not_merged():
+    queue = RequestQueue()
+    queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                            {"volume": 0.5}))
+    queue.push(make_request(":1.1", "PlaySound", "b"))
+    assert queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                                   {"volume": 1.0})) is None
+
+    assert [request.method for request in drain(queue)] == \
+        ["UpdateProperties", "PlaySound", "UpdateProperties"]
+
+
+def test_updates_of_other_sounds_are_not_merged():
+    queue = RequestQueue()
+    queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                            {"volume": 0.5}))
+    assert queue.push(make_request(":1.1", "UpdateProperties", "v", 0,
+                                   {"volume": 1.0})) is None
+    assert len(queue) == 2
+
+
+def test_a_target_replaces_a_curve_of_the_same_property():
+    queue = RequestQueue()
+    queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                            {"volume-curve": [(0.0, 1.0), (500.0, 0.0)]}))
+    queue.push(make_request(":1.1", "UpdateProperties", "u", 200,
+                            {"volume": 0.3}))
+
+    assert queue.pop().params == ("u", {"volume": (200, 0.3)})
+
+
+def test_drop_sender():
+    queue = RequestQueue()
+    queue.push(make_request(":1.1", "PlaySound", "a"))
+    queue.push(make_request(":1.1", "UpdateProperties", "u", 0,
+                            {"volume": 0.5}))
+    queue.push(make_request(":1.2", "PlaySound", "b"))
+
+    assert len(queue.drop_sender(":1.1")) == 2
+    assert len(queue) == 1
+    assert queue.pop().sender == ":1.2"
+    assert queue.pop() is None
+
+
+@pytest.mark.parametrize("method, params", [
+    ("PlayFull", ("a", {"start-at": "x"})),
+    ("PlayFull", ("a", {"max-duration-ms": "x"})),
+    ("PlayFull", ("a", {"volume": True})),
+    ("SetGroupProperties", ("bg", 0, {"volume": "x"})),
+    ("SetGroupProperties", ("bg", 0, {"volume": -0.5})),
+    ("SetGroupProperties", ("bg", 0, {"volume": 1.5})),
+    ("UpdateProperties", ("u", -1, {"volume": 0.5})),
+    ("UpdateProperties", ("u", 0, {"rate": 0.0})),
+    ("UpdateProperties", ("u", 0, {"volume-curve": [(0.0, "x")]})),
+    ("UpdateProperties", ("u", 0, {"volume-curve": [(-1.0, 1.0)]})),
+    ("UpdateProperties", ("u", 0, {"rate-curve": [1.0]})),
+])
+def test_invalid_params_are_rejected(method, params):
+    with pytest.raises(InvalidArgsException):
+        parse_params(method, params)
+
+
+def test_unknown_options_are_ignored():
+    assert parse_params("PlayFull", ("a", {"unknown": "x"})) == \
+        ("a", {"unknown": "x"})
@@ -0,0 +1,60 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import pytest
+
+from hack_sound_server.utils.handle import SoundHandle
+
+
+def test_string_round_trip():
+    handle = SoundHandle.new()
+    string = str(handle)
+
+    assert len(string) == 36
+    assert SoundHandle.from_string(string) == handle
+
+
+def test_handles_are_unique():
+    assert SoundHandle.new() != SoundHandle.new()
+
+
+@pytest.mark.parametrize("counter", [
+    "0000-00000000001F",
+    "0000-0x000000001f",
+    "0000- 0000000001f",
+    "0000-0_00000001f",
+    "0000-00000000001",
+    "0000-00000000001f ",
+    "00000000-0000001f",
+])
+def test_non_canonical_strings_are_rejected(counter):
+    prefix = str(SoundHandle.new())[:18]
+    assert SoundHandle.from_string("{}-{}".format(prefix, counter)) is None
+
+
+def test_handles_of_other_processes_are_rejected():
+    string = str(SoundHandle.new())
+    other_prefix = "{:08x}".format(int(string[:8], 16) ^ 1)
+    assert SoundHandle.from_string(other_prefix + string[8:]) is None
+
+
+def test_unrelated_strings_are_rejected():
+    assert SoundHandle.from_string("") is None
+    assert SoundHandle.from_string("clubhouse/entry") is None
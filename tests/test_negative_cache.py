@@ -0,0 +1,82 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+from hack_sound_server.utils.negative_cache import NegativeCache
+
+
+class Clock:
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+def test_failing_file_is_skipped_until_its_backoff_is_over():
+    clock = Clock()
+    cache = NegativeCache(time_func=clock)
+
+    assert cache.add("/sounds/a.webm", "g-io-error") == 1
+    assert cache.is_failing("/sounds/a.webm")
+    assert cache.filter(["/sounds/a.webm", "/sounds/b.webm"]) == \
+        ["/sounds/b.webm"]
+
+    clock.time = 1.0
+    assert not cache.is_failing("/sounds/a.webm")
+
+
+def test_backoff_doubles_up_to_the_maximum():
+    cache = NegativeCache(time_func=Clock())
+    backoffs = [cache.add("/sounds/a.webm", "g-io-error") for _ in range(12)]
+
+    assert backoffs[:4] == [1, 2, 4, 8]
+    assert backoffs[-1] == NegativeCache._MAX_BACKOFF_S
+
+
+def test_error_domains_back_off_separately():
+    clock = Clock()
+    cache = NegativeCache(time_func=clock)
+    for _ in range(3):
+        cache.add("/sounds/a.webm", "gst-stream-error")
+    cache.add("/sounds/a.webm", "g-io-error")
+
+    clock.time = 2.0
+    # The stream errors still keep the file out.
+    assert cache.is_failing("/sounds/a.webm")
+    clock.time = 4.0
+    assert not cache.is_failing("/sounds/a.webm")
+
+
+def test_success_forgets_the_failures():
+    cache = NegativeCache(time_func=Clock())
+    cache.add("/sounds/a.webm", "g-io-error")
+    cache.remove("/sounds/a.webm")
+
+    assert not cache.is_failing("/sounds/a.webm")
+    assert len(cache) == 0
+    assert cache.add("/sounds/a.webm", "g-io-error") == 1
+
+
+def test_failures_are_kept_by_resolved_path():
+    cache = NegativeCache(time_func=Clock())
+    cache.add("/sounds/../sounds/a.webm", "g-io-error")
+
+    assert cache.is_failing("/sounds/a.webm")
@@ -0,0 +1,173 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import gc
+import weakref
+
+import pytest
+
+from hack_sound_server.scheduler import Scheduler
+
+
+class MainLoop:
+    """
+    Runs the timeouts of a scheduler on a fake clock.
+    """
+
+    def __init__(self):
+        self.time = 0
+        self._timeouts = {}
+        self._next_id = 1
+
+    def now(self):
+        return self.time
+
+    def timeout_add(self, delay_ms, callback):
+        source_id = self._next_id
+        self._next_id += 1
+        self._timeouts[source_id] = (self.time + delay_ms * 1000, callback)
+        return source_id
+
+    def source_remove(self, source_id):
+        del self._timeouts[source_id]
+
+    def advance_to(self, time):
+        while True:
+            due = [(due_time, source_id)
+                   for source_id, (due_time, unused_callback)
+                   in self._timeouts.items() if due_time <= time]
+            if not due:
+                break
+            due_time, source_id = min(due)
+            self.time = max(self.time, due_time)
+            unused_time, callback = self._timeouts.pop(source_id)
+            assert callback() is False
+        self.time = time
+
+
+@pytest.fixture
+def loop():
+    return MainLoop()
+
+
+@pytest.fixture
+def scheduler(loop):
+    return Scheduler(loop.now, loop.timeout_add, loop.source_remove)
+
+
+def test_calls_run_in_time_order(loop, scheduler):
+    ran = []
+    scheduler.add(2000, ran.append, "b")
+    scheduler.add(1000, ran.append, "a")
+    scheduler.add(3000, ran.append, "c")
+
+    loop.advance_to(2500)
+    assert ran == ["a", "b"]
+    loop.advance_to(3000)
+    assert ran == ["a", "b", "c"]
+    assert len(scheduler) == 0
+
+
+def test_calls_do_not_run_early(loop, scheduler):
+    ran = []
+    scheduler.add(1500, ran.append, "a")
+
+    loop.advance_to(1499)
+    assert ran == []
+    loop.advance_to(2000)
+    assert ran == ["a"]
+
+
+def test_rescheduling_later(loop, scheduler):
+    ran = []
+    call = scheduler.add(100, ran.append, "lease")
+    for time in range(1000, 101000, 1000):
+        scheduler.reschedule(call, time)
+
+    assert len(scheduler) == 1
+    loop.advance_to(99999)
+    assert ran == []
+    assert len(scheduler) == 1
+    loop.advance_to(100000)
+    assert ran == ["lease"]
+    assert len(scheduler) == 0
+
+
+def test_rescheduling_earlier(loop, scheduler):
+    ran = []
+    call = scheduler.add(10000, ran.append, "lease")
+    scheduler.add(5000, ran.append, "other")
+    scheduler.reschedule(call, 1000)
+
+    loop.advance_to(1000)
+    assert ran == ["lease"]
+    loop.advance_to(10000)
+    assert ran == ["lease", "other"]
+
+
+def test_cancel(loop, scheduler):
+    ran = []
+    call = scheduler.add(1000, ran.append, "a")
+    scheduler.add(2000, ran.append, "b")
+    scheduler.cancel(call)
+
+    assert len(scheduler) == 1
+    loop.advance_to(2000)
+    assert ran == ["b"]
+
+
+def test_cancel_drops_the_arguments(loop, scheduler):
+
+    class Argument:
+        pass
+
+    argument = Argument()
+    ref = weakref.ref(argument)
+    call = scheduler.add(1000, print, argument)
+    del argument
+    scheduler.cancel(call)
+    gc.collect()
+
+    assert ref() is None
+
+
+def test_many_cancelled_calls(loop, scheduler):
+    ran = []
+    calls = [scheduler.add(1000 + i * 1000, ran.append, i)
+             for i in range(1000)]
+    for call in calls[:-1]:
+        scheduler.cancel(call)
+
+    assert len(scheduler) == 1
+    loop.advance_to(1000000)
+    assert ran == [999]
+    assert len(scheduler) == 0
+
+
+def test_cancel_after_running_is_a_no_op(loop, scheduler):
+    ran = []
+    call = scheduler.add(1000, ran.append, "a")
+    loop.advance_to(1000)
+    scheduler.cancel(call)
+    scheduler.reschedule(call, 2000)
+
+    assert len(scheduler) == 0
+    loop.advance_to(2000)
+    assert ran == ["a"]
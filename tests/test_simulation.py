@@ -0,0 +1,99 @@
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import pytest
+
+gi = pytest.importorskip("gi")
+try:
+    gi.require_version("Gst", "1.0")
+except ValueError:
+    pytest.skip("GStreamer is not available", allow_module_level=True)
+
+from hack_sound_server.simulation import Simulation  # noqa
+from hack_sound_server.utils.handle import SoundHandle  # noqa
+
+
+METADATA = {
+    "ambient": {
+        "sound-files": ["/sounds/ambient.webm"],
+        "loop": True,
+        "fade-out": 500,
+        "max-duration-ms": 1000,
+    },
+}
+
+
+def test_renewed_lease_keeps_a_single_scheduler_entry():
+    simulation = Simulation(METADATA)
+    uuid = simulation.call(":1.1", "PlaySound", "ambient").value[0]
+    handle = SoundHandle.from_string(uuid)
+
+    # Update the sound at 60Hz for 10 seconds, renewing its lease each time.
+    for _ in range(600):
+        invocation = simulation.call(":1.1", "UpdateProperties", uuid, 0,
+                                     {"volume": 0.5})
+        assert invocation.error is None
+        simulation.advance(16)
+
+    assert handle in simulation.server.registry.sounds
+    assert len(simulation.scheduler) <= 2
+
+    # Without renewals, the lease expires and the sound fades out.
+    simulation.advance(2000)
+    assert handle not in simulation.server.registry.sounds
+
+
+def test_foreign_sender_cannot_renew_the_lease():
+    simulation = Simulation(METADATA)
+    uuid = simulation.call(":1.1", "PlaySound", "ambient").value[0]
+    handle = SoundHandle.from_string(uuid)
+
+    # Another client tries to keep the sound alive.
+    for _ in range(100):
+        assert simulation.call(":1.2", "Renew", uuid).error is None
+        assert simulation.call(":1.2", "UpdateProperties", uuid, 0,
+                               {"volume": 0.5}).error is None
+        simulation.advance(50)
+
+    assert handle not in simulation.server.registry.sounds
+
+
+def test_invalid_options_get_an_error_and_the_server_keeps_serving():
+    simulation = Simulation(METADATA)
+    invocation = simulation.call(":1.1", "PlayFull", "ambient",
+                                 {"start-at": "x"})
+    assert invocation.error == "org.freedesktop.DBus.Error.InvalidArgs"
+
+    invocation = simulation.call(":1.1", "PlaySound", "ambient")
+    assert invocation.error is None
+    assert invocation.value[0]
+
+
+def test_unknown_mix_groups_cannot_be_changed():
+    simulation = Simulation(METADATA)
+    invocation = simulation.call(":1.1", "SetGroupProperties", "bg", 0,
+                                 {"volume": 0.5})
+    assert invocation.error is None
+
+    invocation = simulation.call(":1.1", "SetGroupProperties", "unknown", 0,
+                                 {"volume": 0.5})
+    assert invocation.error == \
+        "com.hack_computer.HackSoundServer.UnknownMixGroup"
+    assert "unknown" not in simulation.server.mixer.group_names
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Measures the loudness of the sound files and computes their gains.
+
+The integrated loudness (EBU R128) and the true peak of every sound file of
+the metadata are measured with ffmpeg. Each file gets the gain that brings it
+to the target loudness, limited so its true peak stays below the maximum. The
+index is written next to the metadata, where the server loads it from:
+
+    tools/analyze-loudness.py --target -23 -o data/loudness.json
+
+The segments of sprites are measured one by one, so each packed sound gets
+its own gain. Sounds shorter than the gating blocks of EBU R128 are looped to
+measure their integrated loudness. Silent sounds keep a gain of 1.
+"""
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+DATA_DIR = os.path.join(ROOT_DIR, "data")
+SOUNDS_DIR = os.path.join(DATA_DIR, "sounds")
+SYSTEM_METADATA_PATH = os.path.join(DATA_DIR, "metadata.json")
+LOUDNESS_INDEX_PATH = os.path.join(DATA_DIR, "loudness.json")
+# The absolute gate of EBU R128. ffmpeg reports it when nothing was gated in.
+ABSOLUTE_GATE_LUFS = -70.0
+# Shorter sounds are looped up to this duration to be measured.
+MIN_MEASURED_S = 3.0
+
+_INTEGRATED_RE = re.compile(r"^\s*I:\s*(-?[\d.]+|-inf)\s*LUFS", re.MULTILINE)
+_PEAK_RE = re.compile(r"^\s*Peak:\s*(-?[\d.]+|-inf)\s*dBFS", re.MULTILINE)
+# The time of the measurements ebur128 logs every 100 milliseconds.
+_TIME_RE = re.compile(r"\bt:\s*([\d.]+)")
+
+
+def get_sound_files(metadata):
+    """
+    Gets the sound files and the sprite segments to measure.
+
+    Returns:
+        tuple: The sorted sound files, and the sorted segments of each sprite
+        as (start, duration) pairs in milliseconds.
+    """
+    sound_files = set()
+    segments = {}
+    for entry in metadata.values():
+        if "sprite" in entry:
+            segment = entry["segment"]
+            segments.setdefault(entry["sprite"], set()).add(
+                (segment["start"], segment["duration"]))
+            continue
+        sound_files.update(entry.get("sound-files", []))
+        if "sound-file" in entry:
+            sound_files.add(entry["sound-file"])
+    return sorted(sound_files), OrderedDict(
+        (sprite, sorted(segments[sprite])) for sprite in sorted(segments))
+
+
+def run_ebur128(input_args):
+    """
+    Runs the ebur128 filter of ffmpeg.
+
+    Returns:
+        tuple: The integrated loudness in LUFS, the true peak in dBTP and the
+        measured duration in seconds.
+    """
+    result = subprocess.run(["ffmpeg", "-nostats"] + input_args +
+                            ["-filter_complex", "ebur128=peak=true",
+                             "-f", "null", "-"],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    # Only the summary has the final values.
+    log, unused_sep, summary = result.stderr.rpartition("Summary:")
+    integrated = _INTEGRATED_RE.search(summary)
+    peak = _PEAK_RE.search(summary)
+    if integrated is None or peak is None:
+        raise ValueError("Cannot parse the loudness of {}".format(input_args))
+    times = _TIME_RE.findall(log)
+    duration_s = float(times[-1]) if times else 0.0
+    return float(integrated.group(1)), float(peak.group(1)), duration_s
+
+
+def measure(path, segment=None):
+    """
+    Measures the loudness of a sound file, or of a segment of it.
+
+    Args:
+        path (str): The path of the sound file.
+
+    Optional Arguments:
+        segment (tuple): The start and duration of the segment, in
+                         milliseconds.
+
+    Returns:
+        tuple: The integrated loudness in LUFS and the true peak in dBTP.
+    """
+    clip_args = []
+    if segment is not None:
+        clip_args = ["-ss", str(segment[0] / 1000),
+                     "-t", str(segment[1] / 1000)]
+    clip_args += ["-i", path]
+    integrated_lufs, true_peak_dbtp, duration_s = run_ebur128(clip_args)
+    if segment is not None:
+        duration_s = segment[1] / 1000
+    if integrated_lufs > ABSOLUTE_GATE_LUFS or duration_s >= MIN_MEASURED_S:
+        return integrated_lufs, true_peak_dbtp
+
+    # Too short to fill the 400 ms gating blocks: loop the sound. The true
+    # peak of the sound itself is kept.
+    n_loops = math.ceil(MIN_MEASURED_S / max(duration_s, 0.05))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clip_path = os.path.join(tmp_dir, "clip.wav")
+        subprocess.run(["ffmpeg", "-v", "error", "-y"] + clip_args +
+                       ["-c:a", "pcm_f32le", "-vn", clip_path],
+                       stdin=subprocess.DEVNULL, check=True)
+        integrated_lufs, unused_peak, unused_duration = run_ebur128(
+            ["-stream_loop", str(n_loops - 1), "-i", clip_path])
+    return integrated_lufs, true_peak_dbtp
+
+
+def compute_gain(integrated_lufs, true_peak_dbtp, target_lufs, max_peak_dbtp):
+    if integrated_lufs <= ABSOLUTE_GATE_LUFS or math.isinf(true_peak_dbtp):
+        return 1.0
+    gain_db = min(target_lufs - integrated_lufs,
+                  max_peak_dbtp - true_peak_dbtp)
+    return round(10 ** (gain_db / 20), 4)
+
+
+def analyze(path, name, args, segment=None):
+    """
+    Measures a sound file or a segment, and computes its gain.
+
+    Returns:
+        OrderedDict: The index entry, or None if it cannot be measured.
+    """
+    try:
+        integrated_lufs, true_peak_dbtp = measure(path, segment)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print("Skipping {}: {}".format(name, e), file=sys.stderr)
+        return None
+    gain = compute_gain(integrated_lufs, true_peak_dbtp, args.target,
+                        args.max_peak)
+    print("{}: {} LUFS, {} dBTP, gain {}".format(
+        name, integrated_lufs, true_peak_dbtp, gain), file=sys.stderr)
+    return OrderedDict([
+        ("integrated-lufs", integrated_lufs),
+        ("true-peak-dbtp", true_peak_dbtp),
+        ("gain", gain),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measures the loudness of the sound files.")
+    parser.add_argument("-p", "--path",
+                        type=argparse.FileType("r"),
+                        help="Path to the metadata json file",
+                        default=SYSTEM_METADATA_PATH,
+                        required=False)
+    parser.add_argument("-s", "--sounds-dir", default=SOUNDS_DIR,
+                        help="Directory the sound files are relative to")
+    parser.add_argument("-o", "--output", default=LOUDNESS_INDEX_PATH,
+                        help="Path to the loudness index to write")
+    parser.add_argument("-t", "--target", type=float, default=-23.0,
+                        help="Target integrated loudness, in LUFS")
+    parser.add_argument("-m", "--max-peak", type=float, default=-1.0,
+                        help="Highest true peak after the gain, in dBTP")
+    args = parser.parse_args()
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg is required to measure the loudness.", file=sys.stderr)
+        sys.exit(1)
+
+    metadata = json.load(args.path)
+    args.path.close()
+    sound_files, segments_by_sprite = get_sound_files(metadata)
+    files = OrderedDict()
+    for sound_file in sound_files:
+        path = os.path.join(args.sounds_dir, sound_file)
+        if not os.path.exists(path):
+            print("Skipping missing file {}.".format(sound_file),
+                  file=sys.stderr)
+            continue
+        entry = analyze(path, sound_file, args)
+        if entry is not None:
+            files[sound_file] = entry
+
+    segments = OrderedDict()
+    for sprite, sprite_segments in segments_by_sprite.items():
+        path = os.path.join(args.sounds_dir, sprite)
+        if not os.path.exists(path):
+            print("Skipping missing sprite {}.".format(sprite),
+                  file=sys.stderr)
+            continue
+        for start_ms, duration_ms in sprite_segments:
+            name = "{} [{} ms, {} ms]".format(sprite, start_ms, duration_ms)
+            entry = analyze(path, name, args, (start_ms, duration_ms))
+            if entry is None:
+                continue
+            entry.update([("start", start_ms), ("duration", duration_ms)])
+            entry.move_to_end("duration", last=False)
+            entry.move_to_end("start", last=False)
+            segments.setdefault(sprite, []).append(entry)
+
+    index = OrderedDict([("target-lufs", args.target),
+                         ("max-peak-dbtp", args.max_peak),
+                         ("files", files),
+                         ("segments", segments)])
+    with open(args.output, "w") as index_file:
+        json.dump(index, index_file, indent=4)
+        index_file.write("\n")
+    print("Wrote the gains of {} sound files and {} sprite segments to "
+          "{}.".format(len(files), sum(len(entries)
+                                       for entries in segments.values()),
+                       args.output), file=sys.stderr)
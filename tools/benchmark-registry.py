@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Microbenchmarks of the registry and the request handling of the server.
+
+The server runs on the simulation backend (see `hack_sound_server.simulation`),
+so no pipeline is built and the numbers only account for the bookkeeping.
+Each benchmark is measured with a registry populated with a number of live
+sounds, sound events and bus names, and each of these dimensions is swept
+while the other two keep their default value:
+
+    tools/benchmark-registry.py --save baseline.json
+    # Change the code, then:
+    tools/benchmark-registry.py --compare baseline.json
+
+Results are appended to the baseline file on each `--save`, so it keeps the
+history of the runs. `--compare` checks against the last saved run and exits
+with an error if any benchmark got slower than the threshold.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+
+DEFAULT_PYTHON_PATH = "/app/lib/hack-sound-server/python"
+DEFAULT_SOUNDS = 400
+DEFAULT_EVENTS = 200
+DEFAULT_BUS_NAMES = 20
+SWEEPS = (
+    ("sounds", (100, 400, 800)),
+    ("events", (200, 1000, 5000)),
+    ("bus-names", (1, 20, 400)),
+)
+# The server plays at most 5 instances of each sound event.
+MAX_SOUNDS_PER_EVENT = 5
+# Sound events not used to populate the registry, so the benchmarks adding
+# and removing sounds always have room for them.
+N_SPARE_EVENTS = 8
+SPARE_BG_EVENT = "bench/spare-bg"
+SPARE_SENDER = ":9.0"
+
+
+def get_metadata(n_events):
+    metadata = {}
+    for i in range(n_events):
+        metadata["bench/{}".format(i)] = {
+            "sound-files": ["/bench/{}.wav".format(i)],
+            "type": "bg" if i % 10 == 0 else "sfx",
+            "overlap-behavior": "ignore" if i % 3 == 0 else "overlap",
+            "loop": True,
+        }
+    for i in range(N_SPARE_EVENTS):
+        metadata["bench/spare/{}".format(i)] = {
+            "sound-files": ["/bench/spare/{}.wav".format(i)],
+            "loop": True,
+        }
+    metadata[SPARE_BG_EVENT] = {
+        "sound-files": ["/bench/spare-bg.wav"],
+        "type": "bg",
+        "overlap-behavior": "ignore",
+        "loop": True,
+    }
+    return metadata
+
+
+class Environment:
+    """
+    A simulated server with a populated registry.
+    """
+
+    def __init__(self, n_sounds, n_events, n_bus_names):
+        from hack_sound_server.simulation import Simulation
+
+        self.simulation = Simulation(get_metadata(n_events))
+        self.server = self.simulation.server
+        self.event_ids = ["bench/{}".format(i) for i in range(n_events)]
+        self.spare_event_ids = ["bench/spare/{}".format(i)
+                                for i in range(N_SPARE_EVENTS)]
+        self._n_disconnects = 0
+        for i in range(n_sounds):
+            self.simulation.call(":1.{}".format(i % n_bus_names), "PlaySound",
+                                 self.event_ids[i % n_events])
+        self.simulation.advance(100)
+        self.uuids = list(self.server.registry.sounds)
+        self.unique_sounds = [(sound.sound_event_id, sound.bus_name)
+                              for sound in self.server.registry.sounds.values()
+                              if sound.sound_event_id in self.event_ids[::3]]
+
+    def new_sound(self, sound_event_id):
+        from hack_sound_server.simulation import SimulatedSound
+
+        location = self.server.metadata[sound_event_id]["sound-files"][0]
+        return SimulatedSound(self.server, SPARE_SENDER, sound_event_id,
+                              location=location)
+
+    def new_bus_name(self):
+        self._n_disconnects += 1
+        return ":3.{}".format(self._n_disconnects)
+
+
+def bench_get_sound_by_uuid(env, loops):
+    get_sound = env.server.get_sound
+    uuids = [str(uuid) for uuid in env.uuids]
+    n_uuids = len(uuids)
+    start = time.perf_counter()
+    for i in range(loops):
+        get_sound(uuids[i % n_uuids])
+    return time.perf_counter() - start
+
+
+def bench_get_sound_by_event(env, loops):
+    get_sound = env.server.get_sound
+    keys = env.unique_sounds
+    n_keys = len(keys)
+    start = time.perf_counter()
+    for i in range(loops):
+        sound_event_id, bus_name = keys[i % n_keys]
+        get_sound(sound_event_id=sound_event_id, bus_name=bus_name)
+    return time.perf_counter() - start
+
+
+def bench_ensure_not_too_many_sounds(env, loops):
+    from hack_sound_server.server import TooManySoundsException
+
+    ensure_not_too_many_sounds = env.server.ensure_not_too_many_sounds
+    event_ids = env.event_ids
+    n_event_ids = len(event_ids)
+    start = time.perf_counter()
+    for i in range(loops):
+        try:
+            ensure_not_too_many_sounds(event_ids[i % n_event_ids])
+        except TooManySoundsException:
+            pass
+    return time.perf_counter() - start
+
+
+def bench_registry_add_remove(env, loops):
+    registry = env.server.registry
+    sound = env.new_sound(env.spare_event_ids[0])
+    start = time.perf_counter()
+    for unused_i in range(loops):
+        registry.add_sound(sound)
+        registry.refcount[sound.uuid] = 1
+        registry.remove_sound(sound)
+    return time.perf_counter() - start
+
+
+def bench_try_add_bg_sound(env, loops):
+    registry = env.server.registry
+    sound = env.new_sound(SPARE_BG_EVENT)
+    start = time.perf_counter()
+    for unused_i in range(loops):
+        registry._try_add_bg_sound(sound)
+        registry.background_sounds.pop()
+    return time.perf_counter() - start
+
+
+def bench_bus_name_disconnect(env, loops):
+    # Each iteration plays one sound of every spare sound event from a new
+    # bus name and only the disconnection of that bus name is measured.
+    elapsed = 0
+    for unused_i in range(loops):
+        bus_name = env.new_bus_name()
+        for sound_event_id in env.spare_event_ids:
+            env.simulation.call(bus_name, "PlaySound", sound_event_id)
+        env.simulation.advance(100)
+        start = time.perf_counter()
+        env.server._bus_name_disconnect_cb(env.simulation.connection,
+                                           bus_name)
+        elapsed += time.perf_counter() - start
+        env.simulation.advance(100)
+    return elapsed
+
+
+def bench_play_stop(env, loops):
+    simulation = env.simulation
+    sound_event_id = env.spare_event_ids[0]
+    start = time.perf_counter()
+    for unused_i in range(loops):
+        uuid = simulation.call(SPARE_SENDER, "PlaySound",
+                               sound_event_id).value[0]
+        simulation.call(SPARE_SENDER, "StopSound", uuid)
+        simulation.advance(100)
+    return time.perf_counter() - start
+
+
+# Name, function and number of loops per run.
+BENCHMARKS = (
+    ("get_sound[uuid]", bench_get_sound_by_uuid, 20000),
+    ("get_sound[event]", bench_get_sound_by_event, 20000),
+    ("ensure_not_too_many_sounds", bench_ensure_not_too_many_sounds, 20000),
+    ("registry.add_sound+remove_sound", bench_registry_add_remove, 5000),
+    ("registry._try_add_bg_sound", bench_try_add_bg_sound, 5000),
+    ("_bus_name_disconnect_cb", bench_bus_name_disconnect, 50),
+    ("PlaySound+StopSound", bench_play_stop, 500),
+)
+
+
+def run_benchmark(func, env, loops, n_runs):
+    """
+    Runs a benchmark a few times, after a warm up run.
+
+    Returns:
+        list: The time per iteration of each run, in microseconds.
+    """
+    func(env, loops)
+    return [func(env, loops) / loops * 1e6 for unused_i in range(n_runs)]
+
+
+def get_configurations():
+    configs = []
+    for dimension, values in SWEEPS:
+        for value in values:
+            config = {
+                "sounds": DEFAULT_SOUNDS,
+                "events": DEFAULT_EVENTS,
+                "bus-names": DEFAULT_BUS_NAMES,
+            }
+            config[dimension] = value
+            # The default configuration is part of every sweep.
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+
+def run(n_runs, selected):
+    results = {}
+    for config in get_configurations():
+        if config["sounds"] > config["events"] * MAX_SOUNDS_PER_EVENT:
+            continue
+        env = Environment(config["sounds"], config["events"],
+                          config["bus-names"])
+        label = "sounds={sounds} events={events} bus-names={bus-names}" \
+            .format(**config)
+        for name, func, loops in BENCHMARKS:
+            if selected and not any(pattern in name for pattern in selected):
+                continue
+            key = "{} ({})".format(name, label)
+            values = run_benchmark(func, env, loops, n_runs)
+            results[key] = {
+                "mean": statistics.mean(values),
+                "stdev": statistics.stdev(values) if n_runs > 1 else 0.0,
+                "values": values,
+            }
+            print("{:<80} {:>9.3f} us +- {:.3f}".format(
+                key, results[key]["mean"], results[key]["stdev"]))
+    return results
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as history_file:
+        return json.load(history_file)["runs"]
+
+
+def save(path, results):
+    history = load_history(path)
+    history.append({
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "results": results,
+    })
+    with open(path, "w") as history_file:
+        json.dump({"runs": history}, history_file, indent=2)
+
+
+def compare(path, results, threshold):
+    """
+    Compares the results with the last run saved in a baseline file.
+
+    Returns:
+        bool: True if no benchmark regressed more than `threshold`.
+    """
+    history = load_history(path)
+    if not history:
+        print("No run saved in {}.".format(path), file=sys.stderr)
+        return False
+    baseline = history[-1]
+    print("\nCompared to the run of {}:".format(baseline["date"]))
+    ok = True
+    for key, result in results.items():
+        reference = baseline["results"].get(key)
+        if reference is None:
+            continue
+        change = result["mean"] / reference["mean"] - 1
+        # Differences within the noise of both runs are not regressions.
+        noise = result["stdev"] + reference["stdev"]
+        regressed = change > threshold and \
+            result["mean"] - reference["mean"] > noise
+        ok = ok and not regressed
+        print("{:<80} {:>+7.1%}{}".format(key, change,
+                                          "  REGRESSION" if regressed else ""))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the registry and the request handling.")
+    parser.add_argument("-p", "--python-path", default=DEFAULT_PYTHON_PATH,
+                        help="Directory of the installed hack_sound_server "
+                             "package")
+    parser.add_argument("-r", "--runs", type=int, default=10,
+                        help="Number of runs of each benchmark")
+    parser.add_argument("-b", "--bench", action="append", default=[],
+                        help="Only run the benchmarks whose name contains "
+                             "this string, can be repeated")
+    parser.add_argument("--save", metavar="PATH",
+                        help="Append the results to this baseline file")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="Compare the results with the last run of "
+                             "this baseline file")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                        help="Slowdown ratio flagged as a regression")
+    args = parser.parse_args()
+    if args.runs < 1:
+        parser.error("at least one run is needed")
+    sys.path.insert(0, args.python_path)
+    # The server logs every sound at the info level.
+    os.environ["HACK_SOUND_SERVER_LOGLEVEL"] = "WARNING"
+
+    results = run(args.runs, args.bench)
+    ok = True
+    if args.compare:
+        ok = compare(args.compare, results, args.threshold)
+    if args.save:
+        save(args.save, results)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Packs families of short sounds into sprite files.
+
+The sound events whose single sound file is under one of the given
+directories and lasts less than the maximum duration are packed into one
+sprite, with some silence between the sounds. Their metadata entries are
+rewritten to play their segment of the sprite:
+
+    tools/pack-sprites.py ui common/ system/ codeview/ --inplace
+
+writes data/sounds/sprites/ui.webm and, for example, replaces the
+"sound-file" of the sound events playing "common/click.webm" with:
+
+    "sprite": "sprites/ui.webm",
+    "segment": {"start": 1250, "duration": 180}
+
+Looping sound events and sound events with several sound files are left
+alone. The packed files are kept, since other metadata files may use them.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import wave
+from collections import OrderedDict
+
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+DATA_DIR = os.path.join(ROOT_DIR, "data")
+SOUNDS_DIR = os.path.join(DATA_DIR, "sounds")
+SYSTEM_METADATA_PATH = os.path.join(DATA_DIR, "metadata.json")
+SPRITES_DIR = "sprites"
+# Segments start on millisecond boundaries.
+SAMPLE_RATE = 48000
+FRAMES_PER_MS = SAMPLE_RATE // 1000
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+
+
+def get_sound_file(entry):
+    sound_files = list(entry.get("sound-files", []))
+    if "sound-file" in entry:
+        sound_files.append(entry["sound-file"])
+    if len(set(sound_files)) != 1:
+        return None
+    return sound_files[0]
+
+
+def find_candidates(metadata, prefixes):
+    """
+    Finds the sound files to pack.
+
+    Returns:
+        OrderedDict: The sound event ids playing each sound file.
+    """
+    candidates = OrderedDict()
+    for sound_event_id, entry in metadata.items():
+        if entry.get("loop", False) or "sprite" in entry:
+            continue
+        sound_file = get_sound_file(entry)
+        if sound_file is None or not sound_file.startswith(tuple(prefixes)):
+            continue
+        candidates.setdefault(sound_file, []).append(sound_event_id)
+    return candidates
+
+
+def decode(path, output_path):
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", path,
+                    "-ar", str(SAMPLE_RATE), "-ac", str(CHANNELS),
+                    "-c:a", "pcm_s16le", "-vn", output_path],
+                   stdin=subprocess.DEVNULL, check=True)
+    with wave.open(output_path, "rb") as wave_file:
+        return wave_file.readframes(wave_file.getnframes())
+
+
+def encode(path, output_path):
+    # Same settings as convert-sounds.sh.
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", path,
+                    "-c:a", "libopus", "-compression_level:a", "10",
+                    "-b:a", "128k", "-vn", output_path],
+                   stdin=subprocess.DEVNULL, check=True)
+
+
+def pack(candidates, output_path, max_duration_ms, gap_ms):
+    """
+    Packs the sound files into a sprite.
+
+    Returns:
+        dict: The segment of each packed sound file, as (start, duration)
+        pairs in milliseconds.
+    """
+    frame_size = CHANNELS * SAMPLE_WIDTH
+    segments = OrderedDict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        decoded_path = os.path.join(tmp_dir, "decoded.wav")
+        sprite_path = os.path.join(tmp_dir, "sprite.wav")
+        with wave.open(sprite_path, "wb") as sprite:
+            sprite.setnchannels(CHANNELS)
+            sprite.setsampwidth(SAMPLE_WIDTH)
+            sprite.setframerate(SAMPLE_RATE)
+            position_ms = 0
+            for sound_file in candidates:
+                frames = decode(os.path.join(SOUNDS_DIR, sound_file),
+                                decoded_path)
+                duration_ms = math.ceil(
+                    len(frames) / frame_size / FRAMES_PER_MS)
+                if duration_ms == 0 or duration_ms > max_duration_ms:
+                    continue
+                # Pad the sound to a whole number of milliseconds, and the
+                # gap, with silence.
+                padding_ms = duration_ms + gap_ms
+                frames += bytes(padding_ms * FRAMES_PER_MS * frame_size -
+                                len(frames))
+                sprite.writeframes(frames)
+                segments[sound_file] = (position_ms, duration_ms)
+                position_ms += padding_ms
+        if segments:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            encode(sprite_path, output_path)
+    return segments
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Packs short sounds into a sprite file.")
+    parser.add_argument("name", help="Name of the sprite file, without "
+                                     "extension")
+    parser.add_argument("prefixes", nargs="+",
+                        help="Directories of the sound files to pack, "
+                             "relative to the sounds directory")
+    parser.add_argument("-p", "--path",
+                        type=argparse.FileType("r+"),
+                        help="Path to the metadata json file",
+                        default=SYSTEM_METADATA_PATH,
+                        required=False)
+    parser.add_argument("-m", "--max-duration-ms", type=int, default=1000,
+                        help="Longest sound to pack")
+    parser.add_argument("-g", "--gap-ms", type=int, default=50,
+                        help="Silence between two sounds of the sprite")
+    parser.add_argument("--inplace", action="store_true",
+                        required=False)
+    args = parser.parse_args()
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg is required to pack sprites.", file=sys.stderr)
+        sys.exit(1)
+
+    metadata = json.loads(args.path.read(), object_pairs_hook=OrderedDict)
+    candidates = find_candidates(metadata, args.prefixes)
+    sprite = os.path.join(SPRITES_DIR, args.name + ".webm")
+    segments = pack(candidates, os.path.join(SOUNDS_DIR, sprite),
+                    args.max_duration_ms, args.gap_ms)
+    for sound_file, (start_ms, duration_ms) in segments.items():
+        segment = OrderedDict([("start", start_ms),
+                               ("duration", duration_ms)])
+        for sound_event_id in candidates[sound_file]:
+            # Like sort-metadata.py, put the sound first.
+            items = [(key, value)
+                     for key, value in metadata[sound_event_id].items()
+                     if key not in ("sound-file", "sound-files")]
+            metadata[sound_event_id] = OrderedDict(
+                [("sprite", sprite), ("segment", segment)] + items)
+    print("Packed {} sound files of {} sound events into {}.".format(
+        len(segments), sum(len(candidates[sound_file])
+                           for sound_file in segments), sprite),
+          file=sys.stderr)
+
+    packed_metadata = json.dumps(metadata, indent=4)
+    print(packed_metadata)
+    if args.inplace:
+        args.path.seek(0)
+        args.path.truncate(0)
+        args.path.write(packed_metadata)
+    args.path.close()
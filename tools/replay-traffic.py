@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+#
+# Copyright © 2020 Endless OS Foundation LLC.
+#
+# This file is part of hack-sound-server
+# (see https://github.com/endlessm/hack-sound-server).
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Replays the D-Bus traffic recorded by the server against a new server.
+
+Record some traffic by running the server with the HACK_SOUND_SERVER_RECORD
+environment variable set to the path of the recording. Then, replay it:
+
+    tools/replay-traffic.py recording.jsonl --speed 4
+
+A private bus is started and the server command is spawned on it, so the
+session bus is left alone. Each recorded client gets its own connection,
+which is closed when the client disconnected in the recording. The latency of
+the calls is reported by method, as well as the calls whose outcome diverges
+from the recording.
+
+Note that the server auto-quits when idle, so gaps in the recording longer
+than its timeout end the replay early unless it is accelerated.
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import sys
+import gi
+
+gi.require_version('GLib', '2.0')
+from gi.repository import Gio  # noqa
+from gi.repository import GLib  # noqa
+
+
+DBUS_NAME = "com.hack_computer.HackSoundServer"
+DBUS_PATH = "/com/hack_computer/HackSoundServer"
+DBUS_IFACE = "com.hack_computer.HackSoundServer"
+UUID_RE = re.compile("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-"
+                     "[0-9a-f]{12}")
+SERVER_TIMEOUT_S = 10
+CALL_TIMEOUT_MS = 5000
+
+
+def read_recording(path):
+    """
+    Reads a recording.
+
+    Returns:
+        list: The call and disconnect events, in time order. Calls have their
+        recorded reply in the "reply" key.
+    """
+    events = []
+    # Call ids restart with each session of the server.
+    calls = {}
+    session = None
+    with open(path) as file_:
+        for line in file_:
+            event = json.loads(line)
+            if event["event"] == "session":
+                session = event["session"]
+            elif event["event"] == "call":
+                calls[(session, event["id"])] = event
+                events.append(event)
+            elif event["event"] == "disconnect":
+                events.append(event)
+            elif event["event"] == "reply" and \
+                    (session, event["id"]) in calls:
+                calls[(session, event["id"])]["reply"] = event
+    events.sort(key=lambda event: event["time"])
+    return events
+
+
+def normalize_outcome(reply):
+    """
+    Gets the outcome of a reply, without the uuids which change every run.
+    """
+    if reply is None:
+        return "no reply"
+    if "error" in reply:
+        return "error " + reply["error"]
+    if reply["value"] is None:
+        return "()"
+    return UUID_RE.sub("<uuid>", reply["value"])
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+class Replayer:
+
+    def __init__(self, events, address, speed):
+        self._events = events
+        self._address = address
+        self._speed = speed
+        self._connections = {}
+        # Maps the recorded uuids to the ones of the replay.
+        self._uuids = {}
+        self._n_pending = 0
+        self._n_sent = 0
+        self._latencies = {}
+        self._divergences = []
+        self._loop = GLib.MainLoop()
+
+    def run(self):
+        start_time = GLib.get_monotonic_time()
+        first_time = self._events[0]["time"] if self._events else 0
+        for event in self._events:
+            offset_ms = (event["time"] - first_time) / self._speed / 1000
+            GLib.timeout_add(int(offset_ms), self._replay_event, event)
+        self._n_pending = len(self._events)
+        if self._n_pending:
+            self._loop.run()
+        elapsed_s = (GLib.get_monotonic_time() - start_time) / 1e6
+        self._report(elapsed_s)
+        return not self._divergences
+
+    def _get_connection(self, sender):
+        if sender not in self._connections:
+            flags = (Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT |
+                     Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION)
+            self._connections[sender] = \
+                Gio.DBusConnection.new_for_address_sync(self._address, flags,
+                                                        None, None)
+        return self._connections[sender]
+
+    def _replay_event(self, event):
+        if event["event"] == "disconnect":
+            connection = self._connections.pop(event["sender"], None)
+            if connection is not None:
+                connection.close_sync(None)
+            self._event_done()
+            return GLib.SOURCE_REMOVE
+
+        params_text = UUID_RE.sub(
+            lambda match: self._uuids.get(match.group(0), match.group(0)),
+            event["params"])
+        params = GLib.Variant.parse(None, params_text, None, None)
+        connection = self._get_connection(event["sender"])
+        send_time = GLib.get_monotonic_time()
+        self._n_sent += 1
+        connection.call(DBUS_NAME, DBUS_PATH, DBUS_IFACE, event["method"],
+                        params, None, Gio.DBusCallFlags.NONE, CALL_TIMEOUT_MS,
+                        None, self._call_done_cb, (event, send_time))
+        return GLib.SOURCE_REMOVE
+
+    def _call_done_cb(self, connection, result, data):
+        event, send_time = data
+        latency_us = GLib.get_monotonic_time() - send_time
+        self._latencies.setdefault(event["method"], []).append(latency_us)
+        try:
+            value = connection.call_finish(result)
+            reply = {"value": value.print_(True) if value.n_children() else
+                     None}
+        except GLib.Error as error:
+            reply = {"error": Gio.DBusError.get_remote_error(error) or
+                     "{}:{}".format(GLib.quark_to_string(error.domain),
+                                    error.code)}
+
+        recorded = event.get("reply")
+        if recorded is not None and "value" in recorded and "value" in reply:
+            # Map the recorded uuids to the new ones, in order.
+            recorded_uuids = UUID_RE.findall(recorded["value"] or "")
+            new_uuids = UUID_RE.findall(reply["value"] or "")
+            self._uuids.update(zip(recorded_uuids, new_uuids))
+        expected = normalize_outcome(recorded)
+        actual = normalize_outcome(reply)
+        if expected != actual:
+            self._divergences.append((event, expected, actual))
+        self._event_done()
+
+    def _event_done(self):
+        self._n_pending -= 1
+        if self._n_pending == 0:
+            self._loop.quit()
+
+    def _report(self, elapsed_s):
+        print("Replayed {} calls in {:.2f} s.".format(self._n_sent,
+                                                      elapsed_s))
+        print("{:<20} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "method", "calls", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for method, latencies in sorted(self._latencies.items()):
+            print("{:<20} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                method, len(latencies), percentile(latencies, 0.5) / 1000,
+                percentile(latencies, 0.9) / 1000,
+                percentile(latencies, 0.99) / 1000, max(latencies) / 1000))
+        print("{} divergences.".format(len(self._divergences)))
+        for event, expected, actual in self._divergences:
+            print("  {} {} {}: expected {}, got {}".format(
+                event["id"], event["method"], event["params"], expected,
+                actual))
+
+
+def wait_for_server(address):
+    flags = (Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT |
+             Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION)
+    connection = Gio.DBusConnection.new_for_address_sync(address, flags, None,
+                                                         None)
+    loop = GLib.MainLoop()
+    appeared = []
+
+    def name_appeared_cb(*unused_args):
+        appeared.append(True)
+        loop.quit()
+
+    def timeout_cb():
+        loop.quit()
+        return GLib.SOURCE_REMOVE
+
+    watch_id = Gio.bus_watch_name_on_connection(
+        connection, DBUS_NAME, Gio.BusNameWatcherFlags.NONE, name_appeared_cb,
+        None)
+    GLib.timeout_add_seconds(SERVER_TIMEOUT_S, timeout_cb)
+    loop.run()
+    Gio.bus_unwatch_name(watch_id)
+    return bool(appeared)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replays the D-Bus traffic recorded by the server.")
+    parser.add_argument("recording", help="Path to the recorded traffic")
+    parser.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Speed factor, 2 replays twice as fast")
+    parser.add_argument("-c", "--server-command", default="hack-sound-server",
+                        help="Command to run the server on the private bus")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("the speed factor must be positive")
+
+    events = read_recording(args.recording)
+    bus = Gio.TestDBus.new(Gio.TestDBusFlags.NONE)
+    bus.up()
+    address = bus.get_bus_address()
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+    # Do not record the replay.
+    env.pop("HACK_SOUND_SERVER_RECORD", None)
+    launcher = Gio.SubprocessLauncher.new(Gio.SubprocessFlags.NONE)
+    launcher.set_environ(["{}={}".format(key, value)
+                          for key, value in env.items()])
+    server = launcher.spawnv(shlex.split(args.server_command))
+    try:
+        if not wait_for_server(address):
+            print("The server did not show up on the bus.", file=sys.stderr)
+            sys.exit(1)
+        ok = Replayer(events, address, args.speed).run()
+    finally:
+        server.send_signal(15)
+        server.wait(None)
+        bus.down()
+    sys.exit(0 if ok else 1)